@@ -0,0 +1,89 @@
+import numpy as np
+from scipy import linalg
+
+'''
+#################################################
+Anderson (DIIS) acceleration of the VUMPS outer loop
+One VUMPS iteration is a map x -> F(x) of x = (A_L, A_R, C): the environments are
+built from x, and F(x) are A_L, A_R (min_Ac_C) and C of the new eigenvectors Ac, C.
+The plain iteration takes x_{k+1} = F(x_k) and converges linearly, slowly near
+critical points. Anderson mixing keeps the last `depth` pairs (F(x_i), r_i) with the
+residuals r_i = F(x_i) - x_i and takes
+  x_{k+1} = sum_i c_i F(x_i),  c minimizes ||sum_i c_i r_i||  with  sum_i c_i = 1
+(least squares in the differences of the residuals). vumps.retract then takes the
+closest isometries A_L, A_R and normalizes C.
+The eigenvectors are only defined up to a phase (a sign for eigsh), so each tensor
+of F(x) is aligned with the one of x first.
+Safeguards, each falls back to the plain update F(x_k) and clears the history:
+  ||r_k|| > growth*||r_{k-1}|| or delta_k > growth*delta_{k-1} after an extrapolated step,
+  coefficients larger than max_coefficient (ill-conditioned history),
+and no extrapolation while delta > start_delta (far from the fixed point the map is
+too nonlinear). The history is also cleared when the shape or dtype of x changes
+(bond dimension, single -> double precision) and on a restart of the solver.
+Usage:
+vumps.vumps_mpo(W, A, acceleration=anderson.Anderson(depth=5))
+#################################################
+'''
+class Anderson:
+    def __init__(self, depth=5, start_delta=1e-2, growth=2., max_coefficient=50., rcond=1e-10):
+        '''
+        :param depth: number of previous iterates in the extrapolation
+        :param start_delta: extrapolate only once delta < start_delta
+        :param growth: reject the extrapolation if it increased the residual by more than this factor
+        :param max_coefficient: reject the extrapolation if a coefficient is larger
+        :param rcond: cutoff of the least squares problem (linalg.lstsq)
+        '''
+        self.depth = depth
+        self.start_delta = start_delta
+        self.growth = growth
+        self.max_coefficient = max_coefficient
+        self.rcond = rcond
+        self.reset()
+
+    def reset(self):
+        '''Clear the history (called by the solvers at the start and on restarts)'''
+        self.G = []
+        self.R = []
+        self.extrapolated = False
+        self.delta = None
+
+    def update(self, x_in, x_out, delta):
+        '''
+        :param x_in: list of the tensors of the iterate x_k, e.g. [A_L, A_R, C]
+        :param x_out: the same tensors of F(x_k)
+        :param delta: delta of F(x_k) (for start_delta)
+        :return: list of the tensors of the next iterate, status 'plain', 'extrapolated' or 'rejected'
+        '''
+        x_out = [align_phase(T_out, T_in) for T_in, T_out in zip(x_in, x_out)]
+        g = np.concatenate([T.reshape(-1) for T in x_out])
+        r = g - np.concatenate([T.reshape(-1) for T in x_in])
+        if self.G and (self.G[-1].shape != g.shape or self.G[-1].dtype != g.dtype):
+            self.reset()
+        status = 'plain'
+        if self.extrapolated and (linalg.norm(r) > self.growth * linalg.norm(self.R[-1]) or
+                                  delta > self.growth * self.delta):
+            self.reset()
+            status = 'rejected'
+        self.delta = delta
+        self.G = (self.G + [g])[-(self.depth+1):]
+        self.R = (self.R + [r])[-(self.depth+1):]
+        self.extrapolated = False
+        if status == 'rejected' or len(self.R) < 2 or delta > self.start_delta:
+            return x_out, status
+        dG = np.array(self.G[1:]) - np.array(self.G[:-1])
+        dR = np.array(self.R[1:]) - np.array(self.R[:-1])
+        gamma = linalg.lstsq(dR.T, r, cond=self.rcond)[0]
+        if np.max(abs(gamma)) > self.max_coefficient:
+            self.G, self.R = [g], [r]
+            return x_out, 'rejected'
+        x = g - gamma @ dG
+        self.extrapolated = True
+        sizes = np.cumsum([T.size for T in x_out])[:-1]
+        return [T.reshape(T_out.shape) for T, T_out in zip(np.split(x, sizes), x_out)], 'extrapolated'
+
+def align_phase(v, v_ref):
+    ''':return: v times the phase (sign) which makes <v_ref, v> real and positive'''
+    overlap = np.vdot(v_ref.reshape(-1), v.reshape(-1))
+    if abs(overlap) == 0:
+        return v
+    return v * (np.conj(overlap) / abs(overlap)).astype(v.dtype)
@@ -0,0 +1,222 @@
+import os
+import glob
+import json
+import time
+import hashlib
+import argparse
+import itertools
+import contextlib
+import traceback
+import multiprocessing
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor, FIRST_COMPLETED, wait
+from concurrent.futures.process import BrokenProcessPool
+import constants
+import vumps
+import checkpoint
+import parallel
+
+'''
+#################################################
+Batch runs of independent jobs
+A job is one dict of parameters: the model ('TFIM', 'XX', 'XXZ' with d, hz_field, delta,
+or the fixed point models 'AKLT', 'RVB'), D, eta, the momenta of the dispersion,
+num_of_excite, pinv and the seed of the random initial A (missing keys take
+JOB_DEFAULTS). A job runs vumps_mpo (vumps_fixed_points for AKLT, RVB) and then
+dispersion_mpo if it has momenta.
+The jobs are scheduled on a pool of worker processes, each started with blas_threads
+BLAS threads (default cores // blas_threads workers), so the cores are partitioned
+between the jobs and not oversubscribed. The jobs do not communicate, so the throughput
+grows with the number of workers as long as memory bandwidth allows; blas_threads > 1
+only pays off for large D, where one job alone saturates several cores.
+A job which raises (or whose worker dies) is run again up to `retries` times, attempt k
+with the seed + k (most failures are ARPACK runs which did not converge from one start).
+Output store (one directory):
+  results.jsonl     one line per finished job: its parameters, id, status ('done',
+                    'failed'), e (lam1 for AKLT, RVB), e_exact, delta_vumps, steps, time, attempts
+  states/<id>/      A_L, A_R, C, Ac, L_W, R_W and the dispersion p, omega (checkpoint.write_bundle)
+  logs/<id>.log     output of the solvers of the job
+Jobs which are already 'done' in the store are skipped, so a killed batch is continued
+by running it again. Several nodes can share one store with shard=(index, count):
+every node runs every count-th job and writes its own results_<index>.jsonl.
+The workers are started with 'spawn', so the script has to start the batch under
+if __name__ == '__main__':
+Usage:
+jobs = batch.job_grid(momenta=np.linspace(0, np.pi, 11), model=['TFIM'], hz_field=[0.5, 0.9, 1.1], D=[16, 32])
+batch.run_batch(jobs, 'tfim_runs', blas_threads=2)
+results = batch.load_results('tfim_runs')
+python batch.py jobs.jsonl tfim_runs --blas-threads 2 --shard 0 4
+#################################################
+'''
+## parameters of a job and their defaults
+JOB_DEFAULTS = {'model': 'TFIM', 'd': 2, 'hz_field': 0., 'delta': 1., 'D': 16, 'eta': 1e-8,
+                'momenta': [], 'num_of_excite': 1, 'pinv': 'scipy', 'seed': 0}
+FIXED_POINT_MODELS = ['AKLT', 'RVB']
+
+def job_grid(momenta=(), **axes):
+    '''
+    :param momenta: momenta of the dispersion, the same for all jobs
+    :param axes: parameter name -> list of values
+    :return: list of jobs, one per element of the product of the axes
+    '''
+    return [dict(zip(axes, values), momenta=list(momenta)) for values in itertools.product(*axes.values())]
+
+def read_jobs(path):
+    ''':return: list of jobs of a JSONL file (one job per line)'''
+    with open(path) as f:
+        return [json.loads(line) for line in f if line.strip()]
+
+def normalize_job(job):
+    ''':return: job with the defaults filled in, plain python values and its id (job['id'] if given)'''
+    unknown = set(job) - set(JOB_DEFAULTS) - {'id'}
+    if unknown:
+        raise ValueError('unknown job parameters ' + ', '.join(sorted(unknown)))
+    normalized = {key: np.asarray(job.get(key, value)).tolist() for key, value in JOB_DEFAULTS.items()}
+    key = hashlib.sha1(json.dumps(normalized, sort_keys=True).encode()).hexdigest()[:10]
+    normalized['id'] = job.get('id', '%s_D%d_%s' % (normalized['model'], normalized['D'], key))
+    return normalized
+
+def get_operator(job):
+    ''':return: W, fixed_points (True for AKLT and RVB), exact energy (None if not known)'''
+    if job['model'] in FIXED_POINT_MODELS:
+        return constants.get_double_layer(job['model']), True, None
+    _, W, e_exact = constants.Model(job['model'], job['d'], job['hz_field'], job['delta']).get_h_W_E()
+    return vumps.real_if_real(W), False, e_exact
+
+def solve_job(job, seed):
+    '''
+    :return: dict of the scalar results, dict of the arrays of the job
+    '''
+    W, fixed_points, e_exact = get_operator(job)
+    d = W.shape[-1]
+    A = np.random.default_rng(seed).random((job['D'], d, job['D']))
+    deltas = []
+    def count(i, delta, e):
+        deltas.append(delta)
+    solver = vumps.vumps_fixed_points if fixed_points else vumps.vumps_mpo
+    e, Ac, C, A_L, A_R, L_W, R_W = solver(W, A, eta=job['eta'], callback=count)
+    arrays = {'A_L': A_L, 'A_R': A_R, 'C': C, 'Ac': Ac, 'L_W': L_W, 'R_W': R_W}
+    if job['momenta']:
+        system = job['model'] if fixed_points else '1D'
+        dispersion = vumps.dispersion_mpo(W, A_L, A_R, L_W, R_W, job['momenta'], num_of_excite=job['num_of_excite'],
+                                          system=system, pinv=job['pinv'])
+        arrays['p'], arrays['omega'] = dispersion['p'], dispersion['omega']
+    e = complex(np.ravel(e)[0])
+    result = {'e': e.real, 'e_imag': e.imag, 'e_exact': None if e_exact is None else float(e_exact),
+              'delta_vumps': float(deltas[-1]) if deltas else None, 'steps': len(deltas)}
+    return result, arrays
+
+def run_job(job, attempt, store):
+    '''
+    Runs one attempt of a job in a worker and writes its arrays to the store
+    Exceptions are returned as status 'error' (not raised, not every exception can be pickled)
+    :return: dict of the results
+    '''
+    start = time.time()
+    path = os.path.join(store, 'logs', job['id'] + '.log')
+    with open(path, 'a') as log, contextlib.redirect_stdout(log):
+        print('>' * 30, 'attempt', attempt, 'of', job)
+        try:
+            result, arrays = solve_job(job, job['seed'] + attempt)
+            checkpoint.write_bundle(os.path.join(store, 'states', job['id']), arrays)
+            result['status'] = 'done'
+        except Exception:
+            traceback.print_exc(file=log)
+            result = {'status': 'error', 'error': traceback.format_exc(limit=-1).strip().splitlines()[-1]}
+    result.update(time=time.time() - start, pid=os.getpid())
+    return result
+
+def load_results(store):
+    ''':return: dict id -> result of all results files of the store (the last line of a job wins)'''
+    results = {}
+    for path in sorted(glob.glob(os.path.join(store, 'results*.jsonl'))):
+        with open(path) as f:
+            for line in f:
+                if line.strip():
+                    result = json.loads(line)
+                    results[result['id']] = result
+    return results
+
+def load_job(store, job_id, mmap_mode=None):
+    ''':return: dict of the arrays of a finished job'''
+    return checkpoint.load_checkpoint(os.path.join(store, 'states', job_id), mmap_mode=mmap_mode)
+
+def run_batch(jobs, store, workers=None, blas_threads=1, retries=2, shard=None, start_method='spawn'):
+    '''
+    :param jobs: list of jobs (dicts of parameters, see JOB_DEFAULTS)
+    :param store: output directory (created, jobs which are done there are skipped)
+    :param workers: number of worker processes (default: cores // blas_threads)
+    :param blas_threads: BLAS threads of each worker
+    :param retries: number of reruns of a failed job
+    :param shard: (index, count) to run only the jobs index, index + count, ... (one shard per node)
+    :param start_method: of multiprocessing ('spawn', 'forkserver'; with 'fork' the workers keep
+                         the BLAS threads of the parent)
+    :return: dict id -> result of the jobs
+    '''
+    jobs = [normalize_job(job) for job in jobs]
+    ids = [job['id'] for job in jobs]
+    if len(set(ids)) != len(ids):
+        raise ValueError('duplicate jobs ' + ', '.join(sorted({i for i in ids if ids.count(i) > 1})))
+    results_file = 'results.jsonl'
+    if shard is not None:
+        index, count = shard
+        jobs = jobs[index::count]
+        results_file = 'results_%d.jsonl' % index
+    for directory in ['states', 'logs']:
+        os.makedirs(os.path.join(store, directory), exist_ok=True)
+    done = {job_id for job_id, result in load_results(store).items() if result['status'] == 'done'}
+    todo = [job for job in jobs if job['id'] not in done]
+    workers = workers or max(1, (os.cpu_count() or 1) // blas_threads)
+    print('batch: %d jobs, %d done, %d workers x %d BLAS threads' % (len(jobs), len(jobs) - len(todo),
+                                                                   workers, blas_threads))
+    start = time.time()
+    context = multiprocessing.get_context(start_method)
+    running = {}
+    with parallel.blas_environment(blas_threads), open(os.path.join(store, results_file), 'a') as output:
+        executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+        def submit(job, attempt):
+            running[executor.submit(run_job, job, attempt, store)] = (job, attempt, executor)
+        try:
+            for job in todo:
+                submit(job, 0)
+            while running:
+                finished, _ = wait(running, return_when=FIRST_COMPLETED)
+                for future in finished:
+                    job, attempt, job_executor = running.pop(future)
+                    try:
+                        result = future.result()
+                    except BrokenProcessPool:
+                        ## a worker died (e.g. out of memory), all its pending jobs are lost
+                        result = {'status': 'error', 'error': 'worker died', 'time': float('nan'), 'pid': None}
+                        if job_executor is executor:
+                            executor.shutdown(wait=False)
+                            executor = ProcessPoolExecutor(max_workers=workers, mp_context=context)
+                    if result['status'] == 'error' and attempt < retries:
+                        print('job %s failed (%s), retry %d' % (job['id'], result['error'], attempt + 1))
+                        submit(job, attempt + 1)
+                        continue
+                    if result['status'] == 'error':
+                        result['status'] = 'failed'
+                    result = dict(job, **result, attempts=attempt + 1)
+                    output.write(json.dumps(result) + '\n')
+                    output.flush()
+                    print('job %s %s after %.1f s, e = %s, delta = %s' % (job['id'], result['status'], result['time'],
+                                                                        result.get('e'), result.get('delta_vumps')))
+        finally:
+            executor.shutdown(cancel_futures=True)
+    results = load_results(store)
+    failed = [job['id'] for job in jobs if results.get(job['id'], {}).get('status') != 'done']
+    print('batch: %.1f s, %d failed' % (time.time() - start, len(failed)), failed if failed else '')
+    return {job['id']: results.get(job['id']) for job in jobs}
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Batch runs of independent VUMPS jobs')
+    parser.add_argument('jobs', help='JSONL file with one job per line')
+    parser.add_argument('store', help='output directory')
+    parser.add_argument('--workers', type=int, default=None)
+    parser.add_argument('--blas-threads', type=int, default=1)
+    parser.add_argument('--retries', type=int, default=2)
+    parser.add_argument('--shard', type=int, nargs=2, default=None, metavar=('INDEX', 'COUNT'))
+    args = parser.parse_args()
+    run_batch(read_jobs(args.jobs), args.store, workers=args.workers, blas_threads=args.blas_threads,
+              retries=args.retries, shard=args.shard)
@@ -0,0 +1,186 @@
+import constants
+import vumps
+import mpo
+import pinv_manual
+from ncon_plan import ncon
+import numpy as np
+import argparse
+import json
+import platform
+import time
+import tracemalloc
+
+'''
+#################################################
+Microbenchmarks of the tensor network primitives
+Every kernel is timed on a canonical uMPS from a fixed seed (not a converged state,
+the cost of the kernels does not depend on it) for a grid of D per model:
+  TFIM, XXZ: Hamiltonian MPOs (d = 2, d_w = 3, 5)
+  AKLT, RVB: double layer transfer matrices of the PEPS (d = d_w = 4, 9)
+Kernels: map_Hac, map_Hc (the matvecs of vumps_mpo / vumps_fixed_points),
+get_Lh_Rh_mpo, min_Ac_C, lam_gamma_to_canonical, fixed_boundary, sum_right_left
+and one matvec of the quasiparticle effective Hamiltonian (lgmres pinv).
+Reported: median time of `repeat` calls, peak memory of one call (tracemalloc, numpy
+allocations only) and per kernel the exponent of time ~ D^x fitted over the grid.
+The results can be saved as a baseline (json) and later runs compared against it.
+Usage:
+python benchmark.py --save baseline.json          (on a quiet machine)
+python benchmark.py --compare baseline.json       (before a production run)
+python benchmark.py --models TFIM AKLT --quick
+#################################################
+'''
+## D grid per model, the quick grid keeps the smallest two
+GRID = {'TFIM': [16, 32, 64], 'XXZ': [16, 32, 64], 'AKLT': [8, 16, 32], 'RVB': [6, 12, 24]}
+HAMILTONIANS = ['TFIM', 'XXZ']
+
+def get_model(name):
+    '''
+    :return: W (dense MPO or double layer tensor), fixed_points (True for AKLT and RVB)
+    '''
+    if name in HAMILTONIANS:
+        _, W, _ = constants.Model(name, 2, hz_field=0.9).get_h_W_E()
+        return vumps.real_if_real(W), False
+    return constants.get_double_layer(name), True
+
+def get_state(D, d, seed=0):
+    rng = np.random.default_rng(seed)
+    A = rng.random((D, d, D))
+    return A, vumps.canonical_form(A)
+
+def get_kernels(name, D, seed=0):
+    '''
+    :return: dict kernel name -> function without arguments, and (d, d_w)
+    '''
+    W, fixed_points = get_model(name)
+    d_w, _, d, _ = W.shape
+    A, (A_L, A_R, C, Ac) = get_state(D, d, seed)
+    if fixed_points:
+        _, L_W, _ = vumps.fixed_boundary(A_L, W, 1e-8)
+        _, R_W, _ = vumps.fixed_boundary(A_R, W.transpose([1, 0, 2, 3]), 1e-8)
+        L_W = L_W / vumps.overlap_fixed_boundary(L_W, R_W, C)
+        def map_Hac():
+            return ncon([L_W, Ac, W, R_W],
+                        [[-1,3,1], [1,5,2], [3,4,5,-2], [-3,4,2]])
+    else:
+        L_W, R_W, _ = vumps.get_Lh_Rh_mpo(A_L, A_R, C, W)
+        W_sparse = mpo.SparseMPO(W)
+        def map_Hac():
+            return W_sparse.apply_Hac(L_W, Ac, R_W)
+    def map_Hc():
+        return ncon([L_W, C, R_W],
+                    [[-1,3,1], [1,2], [-2,3,2]])
+    lam, gamma = vumps.A_to_lam_gamma(A)
+    def lam_gamma_to_canonical():
+        np.random.seed(seed) ## initial vectors of its eigs
+        return vumps.lam_gamma_to_canonical(lam, gamma)
+    x = np.random.default_rng(seed).random((D, D))
+    x = x + x.T ## like h_R
+    context = vumps.quasiparticle_mpo_setup(W, A_L, A_R, L_W, R_W, pinv='manual')
+    map_effective_H, _ = vumps.quasiparticle_mpo_map(context, 0.5)
+    X = np.random.default_rng(seed).random(D**2 * (d-1))
+    kernels = {'map_Hac': map_Hac,
+               'map_Hc': map_Hc,
+               'min_Ac_C': lambda: vumps.min_Ac_C(Ac, C),
+               'lam_gamma_to_canonical': lam_gamma_to_canonical,
+               'sum_right_left': lambda: pinv_manual.sum_right_left(x, A_R, C),
+               'quasiparticle_matvec': lambda: map_effective_H(X)}
+    if fixed_points:
+        kernels['fixed_boundary'] = lambda: vumps.fixed_boundary(A_L, W, 1e-8)
+    else:
+        kernels['get_Lh_Rh_mpo'] = lambda: vumps.get_Lh_Rh_mpo(A_L, A_R, C, W_sparse)
+    return kernels, (d, d_w)
+
+def time_kernel(f, repeat=5):
+    '''
+    :return: median time of repeat calls (after one warm up call), peak memory of one call in bytes
+    '''
+    f()
+    times = []
+    for i in range(repeat):
+        t = time.perf_counter()
+        f()
+        times.append(time.perf_counter() - t)
+    tracemalloc.start()
+    f()
+    _, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    return float(np.median(times)), int(peak)
+
+def fit_exponents(results):
+    ''':return: {model/kernel: x} with time ~ D^x (least squares in log-log), for at least two D'''
+    exponents = {}
+    keys = sorted(set((r['model'], r['kernel']) for r in results))
+    for model, kernel in keys:
+        rows = [r for r in results if r['model'] == model and r['kernel'] == kernel]
+        if len(rows) < 2:
+            continue
+        D = np.log([r['D'] for r in rows])
+        t = np.log([r['time'] for r in rows])
+        exponents[model + '/' + kernel] = float(np.polyfit(D, t, 1)[0])
+    return exponents
+
+def run(models=None, grid=None, repeat=5, quick=False, seed=0):
+    '''
+    :param models: list of model names (default all of GRID)
+    :param grid: dict model -> list of D (default GRID)
+    :return: {'meta': ..., 'results': [one dict per model, D and kernel], 'exponents': fit_exponents}
+    '''
+    grid = GRID if grid is None else grid
+    models = list(grid) if models is None else models
+    results = []
+    for model in models:
+        for D in (grid[model][:2] if quick else grid[model]):
+            kernels, (d, d_w) = get_kernels(model, D, seed)
+            for kernel, f in kernels.items():
+                t, peak = time_kernel(f, repeat)
+                results.append({'model': model, 'kernel': kernel, 'D': D, 'd': d, 'd_w': d_w,
+                                'time': t, 'peak_bytes': peak})
+                print('%-5s D = %3d d = %d d_w = %d  %-24s %10.3e s %10.1f kB'
+                      % (model, D, d, d_w, kernel, t, peak/1024))
+    exponents = fit_exponents(results)
+    for key in sorted(exponents):
+        print('%-40s time ~ D^%.2f' % (key, exponents[key]))
+    meta = {'numpy': np.__version__, 'python': platform.python_version(), 'machine': platform.machine(),
+            'processor': platform.processor(), 'repeat': repeat, 'seed': seed}
+    return {'meta': meta, 'results': results, 'exponents': exponents}
+
+def save_baseline(report, path):
+    with open(path, 'w') as f:
+        json.dump(report, f, indent=1)
+    print('baseline saved to ', path)
+
+def compare(report, path, tolerance=1.5):
+    '''
+    Compare with a saved baseline
+    :param tolerance: a kernel is a regression if time > tolerance * baseline time
+    :return: list of the regressions (model, D, kernel, time, baseline time)
+    '''
+    with open(path) as f:
+        baseline = json.load(f)
+    base = {(r['model'], r['D'], r['kernel']): r['time'] for r in baseline['results']}
+    regressions = []
+    for r in report['results']:
+        key = (r['model'], r['D'], r['kernel'])
+        if key in base and r['time'] > tolerance*base[key]:
+            regressions.append(key + (r['time'], base[key]))
+    for model, D, kernel, t, t_base in regressions:
+        print('REGRESSION %s D = %d %s: %.3e s (baseline %.3e s, x%.2f)' % (model, D, kernel, t, t_base, t/t_base))
+    if not regressions:
+        print('no regressions against ', path)
+    return regressions
+
+if __name__ == '__main__':
+    parser = argparse.ArgumentParser(description='Microbenchmarks of the VUMPS primitives')
+    parser.add_argument('--models', nargs='+', choices=list(GRID), default=None)
+    parser.add_argument('--repeat', type=int, default=5)
+    parser.add_argument('--quick', action='store_true', help='only the two smallest D per model')
+    parser.add_argument('--save', default=None, help='write the results to this json file')
+    parser.add_argument('--compare', default=None, help='compare with this baseline json file')
+    parser.add_argument('--tolerance', type=float, default=1.5)
+    args = parser.parse_args()
+    report = run(args.models, repeat=args.repeat, quick=args.quick)
+    if args.save is not None:
+        save_baseline(report, args.save)
+    if args.compare is not None:
+        regressions = compare(report, args.compare, args.tolerance)
+        exit(1 if regressions else 0)
@@ -0,0 +1,116 @@
+import os
+import shutil
+import threading
+import time
+import numpy as np
+
+'''
+#################################################
+Checkpoint and resume of the VUMPS solvers
+A checkpoint is a directory with one uncompressed .npy file per array
+(A_L.npy, A_R.npy, Ac.npy, C.npy, the environments, count.npy, delta.npy, ...),
+so every array can be memory-mapped with load_checkpoint(path, mmap_mode='r').
+The arrays are copied in the iteration loop and written by a background thread
+into path.tmp, which then replaces path, so a killed job always leaves a complete
+checkpoint. The loop only waits for the copy and, if the previous write is still
+running, for that write. This stall time is measured and reported.
+Usage:
+e, Ac, C, A_L, A_R, L_W, R_W = vumps.vumps_mpo(W, A, save_to='run_D40')
+e, Ac, C, A_L, A_R, L_W, R_W = vumps.vumps_mpo(W, None, save_to='run_D40', resume_from='run_D40')
+#################################################
+'''
+def write_bundle(path, state):
+    '''Write the dict of arrays state to the directory path (atomic replacement)'''
+    path = os.path.abspath(path)
+    tmp, old = path + '.tmp', path + '.old'
+    shutil.rmtree(tmp, ignore_errors=True)
+    os.makedirs(tmp)
+    for key, value in state.items():
+        np.save(os.path.join(tmp, key + '.npy'), value)
+    if os.path.isdir(path):
+        shutil.rmtree(old, ignore_errors=True)
+        os.rename(path, old)
+    os.rename(tmp, path)
+    shutil.rmtree(old, ignore_errors=True)
+
+def load_checkpoint(path, mmap_mode=None):
+    '''
+    :param mmap_mode: None to read into memory, 'r' to memory-map the arrays
+    :return: dict of arrays, 0-d arrays (count, delta, ...) are returned as numbers
+    '''
+    if not os.path.isdir(path) and os.path.isdir(path + '.old'):
+        path = path + '.old' ## killed between the two renames of write_bundle
+    state = {}
+    for name in sorted(os.listdir(path)):
+        if name.endswith('.npy'):
+            value = np.load(os.path.join(path, name), mmap_mode=mmap_mode)
+            state[name[:-4]] = value[()] if value.ndim == 0 else value
+    return state
+
+def load_state(resume_from):
+    ''':param resume_from: checkpoint directory, or a dict which is returned as it is'''
+    if isinstance(resume_from, dict):
+        return resume_from
+    return load_checkpoint(resume_from)
+
+class Checkpoint:
+    def __init__(self, path, every=10):
+        '''
+        :param path: directory of the checkpoint
+        :param every: write every `every` iterations
+        '''
+        self.path = path
+        self.every = every
+        self.thread = None
+        self.writes = 0
+        self.stall_time = 0.
+        self.write_time = 0.
+        self.t_start = None
+        self.t_last = None
+
+    def step(self, iteration, **state):
+        '''Called once per iteration, saves state when iteration % every == 0'''
+        now = time.perf_counter()
+        if self.t_start is None:
+            self.t_start = now
+        self.t_last = now
+        if iteration % self.every == 0:
+            self.save(**state)
+
+    def save(self, **state):
+        t0 = time.perf_counter()
+        state = {key: np.array(value) for key, value in state.items() if value is not None}
+        self.wait()
+        self.thread = threading.Thread(target=self._write, args=(state,))
+        self.thread.start()
+        self.writes += 1
+        self.stall_time += time.perf_counter() - t0
+
+    def _write(self, state):
+        t0 = time.perf_counter()
+        write_bundle(self.path, state)
+        self.write_time += time.perf_counter() - t0
+
+    def wait(self):
+        if self.thread is not None:
+            self.thread.join()
+            self.thread = None
+
+    def close(self, **state):
+        '''Write the final state (if given), wait for the writer and print the stall time'''
+        if state:
+            self.save(**state)
+        self.wait()
+        self.report()
+
+    def stats(self):
+        loop_time = 0. if self.t_start is None else self.t_last - self.t_start
+        fraction = self.stall_time / loop_time if loop_time > 0 else 0.
+        return {'writes': self.writes, 'stall_time': self.stall_time, 'write_time': self.write_time,
+                'loop_time': loop_time, 'stall_fraction': fraction}
+
+    def report(self):
+        stats = self.stats()
+        print('checkpoint ', self.path, ': writes = ', stats['writes'],
+              'stall = %.3fs (%.2f%% of the iteration time), background write = %.3fs'
+              % (stats['stall_time'], 100*stats['stall_fraction'], stats['write_time']))
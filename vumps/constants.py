@@ -83,13 +83,30 @@ class Model:
             d_w = 5
             W = np.zeros([d_w, d_w, d, d], dtype=complex)
             W[0, 0] = W[4, 4] = sI
-            W[1, 0] = W[4,1] = sX
-            W[2, 0] = W[4,2] = sY
+            W[1, 0] = W[4, 2] = sP/2**0.5 ## sX sX + sY sY = (sP sM + sM sP)/2, conserves S^z
+            W[2, 0] = W[4, 1] = sM/2**0.5
             W[3, 0] = sZ; W[4,3] = delta*sZ
             # W = W
             Exact = E_XXZ[delta]*4
         return hloc, W, Exact
 
+    def get_symmetric_W(self, symmetry, block=1):
+        '''
+        MPO of get_h_W_E as block sparse tensor (symmetric.py)
+        :param symmetry: 'Z2' (spin flip, TFIM) or 'U1' (S^z, XX and XXZ) with the charges 2S^z
+        :param block: number of sites blocked into one (d**block), e.g. 2 for U1 and spin-1/2
+        '''
+        _, W, _ = self.get_h_W_E()
+        d_w, d = W.shape[0], self.d
+        charges_site = d - 1 - 2*np.arange(d) if symmetry == 'U1' else np.arange(d) % 2
+        W_site, charges = W, charges_site
+        for n in range(1, block):
+            W = ncon([W, W_site],
+                     [[-1,1,-3,-5], [1,-2,-4,-6]]).reshape(d_w, d_w, d**(n+1), d**(n+1))
+            charges = (charges[:, None] + charges_site[None, :]).reshape(-1)
+        import symmetric ## here and not at the top, constants is imported by vumps and symmetric
+        return symmetric.mpo_from_dense(W, charges, symmetry)
+
 def get_AKLT():
     a0 =1; a2 = np.sqrt(6); a1 = np.sqrt(3/2)
     d = 5; D = 2
@@ -116,6 +133,29 @@ def get_RVB():
 
     return RVB
 
+## dominant eigenvalue of the double layer transfer matrices, W is divided by it (as in mainAKLT.py, mainRVB.py)
+DOUBLE_LAYER_LAM = {'AKLT': 1.30574308, 'RVB': 5.70804057}
+
+def get_double_layer(name):
+    '''
+    :param name: 'AKLT' or 'RVB'
+    :return: double layer tensor W (d, d, d, d) of the PEPS for vumps_fixed_points, d = D_peps^2,
+             normalized so that the largest eigenvalue of the transfer matrix is 1
+    '''
+    if name == 'AKLT':
+        T = get_AKLT()
+        W = ncon([T, np.conj(T)],
+                 [[1, -1, -3, -5, -7], [1, -2, -4, -6, -8]])
+    elif name == 'RVB':
+        T = get_RVB()
+        W = ncon([T, np.conj(T)],
+                 [[1, 2, 3, -1, -3, -5, -7], [1, 2, 3, -2, -4, -6, -8]])
+    else:
+        raise ValueError('unknown model ' + name)
+    d = int(round(W.size**0.25))
+    W = W.reshape(d, d, d, d).transpose([0, 2, 1, 3])
+    return W / DOUBLE_LAYER_LAM[name]
+
 def create_loop_gas_operator(d):
     """Returns loop gas (LG) operator Q_LG for spin=1/2 or spin=1 Kitaev model."""
 
@@ -0,0 +1,145 @@
+import numpy as np
+
+'''
+#################################################
+Adaptive solver precision of the VUMPS outer loop
+The inner solvers only have to be as accurate as the next outer step can use:
+early iterations with delta ~ 1e-2 do not need eigenvectors to 1e-3, but near
+the fixed point loose eigenvectors are the error which the outer loop converges
+to (and slowly so near critical points). The Controller predicts the next delta
+from the last ones (delta_next = delta*rate, rate = geometric mean of the last
+ratios) and sets
+  eig_tol = eig_factor*delta_next    tolerance of the Ac and C eigensolvers
+  env_tol = env_factor*delta_next    lgmres of the environments, fixed points of T_W
+both clipped to [tol_min, tol_max], and per eigenproblem the Krylov size ncv
+(grown after a solve which needed restarts, shrunk after one which did not) and
+maxiter (maxiter_loose restarts while eig_tol > loose_tol, ARPACK's default after).
+The loop stops as soon as
+  delta <= eta,  |e - e_previous| <= energy_tol,  max eigen-residual <= residual_tol
+or when delta has stalled (its minimum did not improve by 10% in `patience` iterations)
+with the energy converged, which happens at critical points where the attainable
+delta is limited by the smallest Schmidt values.
+Usage:
+vumps.vumps_mpo(W, A, control=controller.Controller(eta=1e-10, residual_tol=1e-9))
+#################################################
+'''
+class Controller:
+    def __init__(self, eta=1e-8, energy_tol=None, residual_tol=None, eig_factor=1e-3, env_factor=1e-4,
+                 tol_min=1e-13, tol_max=1e-4, ncv_min=6, ncv_max=40, loose_tol=1e-6, maxiter_loose=20,
+                 patience=50):
+        '''
+        :param eta: target of delta = ||Ac - A_L C||
+        :param energy_tol: target of the energy change per iteration (default eta/10)
+        :param residual_tol: target of the eigen-residuals ||H v - E v|| of Ac and C (default eta)
+        :param eig_factor, env_factor: tolerances relative to the predicted delta
+        :param tol_min, tol_max: range of the tolerances
+        :param ncv_min, ncv_max: range of the Krylov size of eigs/eigsh
+        :param loose_tol, maxiter_loose: maxiter of eigs/eigsh while eig_tol > loose_tol
+        :param patience: number of iterations after which a delta which does not decrease counts as stalled
+        '''
+        self.eta = eta
+        self.energy_tol = eta / 10 if energy_tol is None else energy_tol
+        self.residual_tol = eta if residual_tol is None else residual_tol
+        self.eig_factor = eig_factor
+        self.env_factor = env_factor
+        self.tol_min = tol_min
+        self.tol_max = tol_max
+        self.ncv_min = ncv_min
+        self.ncv_max = ncv_max
+        self.loose_tol = loose_tol
+        self.maxiter_loose = maxiter_loose
+        self.patience = patience
+        self.reset()
+
+    def reset(self, delta=None):
+        '''
+        Start of a solver (or a restart, or a new bond dimension)
+        :param delta: delta of the initial state if known (e.g. after resume), default tol_max for the first solves
+        '''
+        self.deltas = [] if delta is None else [delta]
+        self.energies = []
+        self.residual = np.inf
+        self.ncv = {}
+        self.matvecs = {}
+
+    def rate(self):
+        ''':return: predicted delta_next/delta from the last (up to 3) iterations, in [0.1, 1]'''
+        ratios = np.array(self.deltas[-4:][1:]) / np.array(self.deltas[-4:][:-1])
+        if len(ratios) == 0:
+            return 1.
+        return float(np.clip(np.exp(np.mean(np.log(ratios))), 0.1, 1.))
+
+    def tolerance(self, factor):
+        if not self.deltas:
+            return self.tol_max
+        return float(np.clip(factor * self.deltas[-1] * self.rate(), self.tol_min, self.tol_max))
+
+    def eig_tol(self):
+        ''':return: tolerance of the Ac and C eigensolvers'''
+        return self.tolerance(self.eig_factor)
+
+    def env_tol(self):
+        ''':return: tolerance of the environments (lgmres, eigs of the fixed points)'''
+        return self.tolerance(self.env_factor)
+
+    def krylov(self, name, n):
+        '''
+        :param name: eigenproblem 'Ac' or 'C'
+        :param n: its size
+        :return: dict(ncv=..., maxiter=...) for eigs/eigsh
+        '''
+        maxiter = self.maxiter_loose if self.eig_tol() > self.loose_tol else None
+        return {'ncv': min(self.ncv.get(name, 2*self.ncv_min), n), 'maxiter': maxiter}
+
+    def count(self, name, matvecs):
+        '''Adds matvecs of the eigenproblem name, for the adaptation of its ncv'''
+        self.matvecs[name] = self.matvecs.get(name, 0) + matvecs
+
+    def counted(self, name, f):
+        ''':return: f, counting its calls for the adaptation of ncv of the eigenproblem name'''
+        def f_counted(*args):
+            self.count(name, 1)
+            return f(*args)
+        return f_counted
+
+    def adapt_ncv(self):
+        '''Grow ncv of the problems which needed restarts, shrink it for those which did not'''
+        for name, matvecs in self.matvecs.items():
+            ncv = self.ncv.get(name, 2*self.ncv_min)
+            if matvecs > ncv + 1:
+                ncv = ncv + ncv // 2
+            else:
+                ncv = ncv - 2
+            self.ncv[name] = int(np.clip(ncv, self.ncv_min, self.ncv_max))
+        self.matvecs = {}
+
+    def update(self, delta, energy, residuals=()):
+        '''
+        End of an iteration
+        :param delta: delta of the new iterate
+        :param energy: energy (or lam1 of vumps_fixed_points)
+        :param residuals: eigen-residuals of Ac and C (none if the eigensolver guarantees eig_tol)
+        '''
+        self.deltas.append(delta)
+        self.energies.append(np.real(energy))
+        self.residual = max(residuals, default=0.)
+        self.adapt_ncv()
+
+    def energy_change(self):
+        return abs(self.energies[-1] - self.energies[-2]) if len(self.energies) > 1 else np.inf
+
+    def stalled(self):
+        ''':return: True if the last patience iterations did not improve the smallest delta by 10%'''
+        if len(self.deltas) <= self.patience:
+            return False
+        return min(self.deltas[-self.patience:]) > 0.9 * min(self.deltas[:-self.patience])
+
+    def converged(self):
+        if not self.deltas or self.energy_change() > self.energy_tol:
+            return False
+        if self.deltas[-1] <= self.eta and self.residual <= self.residual_tol:
+            return True
+        if self.stalled():
+            print('delta stalled at ', self.deltas[-1], 'after ', len(self.deltas), 'iterations')
+            return True
+        return False
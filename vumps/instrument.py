@@ -0,0 +1,138 @@
+import numpy as np
+import json
+import time
+from contextlib import contextmanager
+try:
+    import resource
+except ImportError: ## not available on Windows
+    resource = None
+
+'''
+#################################################
+Instrumentation of the solvers
+Every solver records one entry per outer iteration in a Tracer:
+  step, wall (seconds since the start of the solver),
+  time_<stage> (wall time of environments, eig_Ac, eig_C, gauge, bond, residuals, ...),
+  counters (matvecs_Ac, matvecs_C, matvecs_env, lgmres_iterations, lgmres_matvecs, ...),
+  peak_rss_MB (peak resident memory of the process so far),
+  and the values of the iteration (energy or lam1, delta, E_Ac, E_C, residual_Ac, residual_C, D,
+  eig_tol, env_tol).
+The records are kept in memory (Tracer.records() gives a numpy record array),
+optionally streamed to a JSONL file (one json object per iteration), and passed to
+the printer, which replaces the printing every 5 or 10 steps of the solvers.
+Usage:
+tracer = instrument.Tracer(path='tfim.jsonl', printer=instrument.Printer(every=10))
+vumps.vumps_mpo(W, A, tracer=tracer)
+trace = tracer.records()
+trace['time_eig_Ac'].sum(), trace['matvecs_Ac'], trace['delta']
+tracer.summary()
+Use printer=None for no output.
+#################################################
+'''
+def peak_memory_MB():
+    ''':return: peak resident memory of the process in MB (nan if resource is not available)'''
+    if resource is None:
+        return float('nan')
+    return resource.getrusage(resource.RUSAGE_SELF).ru_maxrss / 1024 ## kB on Linux
+
+def to_float(value):
+    '''Scalars, complex numbers (real part) and arrays of length 1 (e.g. eigs eigenvalues) as float'''
+    value = np.asarray(value).reshape(-1)[0]
+    return float(value.real)
+
+class Printer:
+    def __init__(self, every=5, keys=('energy', 'lam1', 'lam2', 'norm', 'delta', 'E_Ac', 'E_C', 'D')):
+        '''
+        :param every: print the iterations with step % every == 0
+        :param keys: entries of the record which are printed (if present)
+        '''
+        self.every = every
+        self.keys = keys
+
+    def __call__(self, record):
+        if record['step'] % self.every != 0:
+            return
+        print(50 * '-' + 'steps', record['step'], 50 * '-')
+        for key in self.keys:
+            if key in record:
+                print(key, ' = ', record[key])
+
+class Tracer:
+    def __init__(self, path=None, printer=Printer()):
+        '''
+        :param path: JSONL file the records are appended to (None: memory only)
+        :param printer: function called with every record (None: no printing)
+        '''
+        self.path = path
+        self.printer = printer
+        self.solver = None
+        self.trace = []
+        self.current = {}
+        self.t0 = time.perf_counter()
+
+    def begin(self, solver):
+        '''Called by the solver at its start, wall is measured from here'''
+        self.solver = solver
+        self.current = {}
+        self.t0 = time.perf_counter()
+
+    @contextmanager
+    def stage(self, name):
+        '''with tracer.stage('environments'): ... adds the wall time to time_environments'''
+        t = time.perf_counter()
+        try:
+            yield
+        finally:
+            self.add(**{'time_' + name: time.perf_counter() - t})
+
+    def add(self, **values):
+        '''Add to counters (or timers) of the current iteration'''
+        for key, value in values.items():
+            self.current[key] = self.current.get(key, 0) + value
+
+    def counted(self, name, f):
+        ''':return: f, counting its calls in the counter name (e.g. the matvec of eigs)'''
+        def f_counted(*args):
+            self.add(**{name: 1})
+            return f(*args)
+        return f_counted
+
+    def end_iteration(self, step, **values):
+        '''
+        Closes the record of the current iteration
+        :param step: iteration number
+        :param values: delta, energy, eigenvalues, ... (scalars, converted with to_float)
+        '''
+        record = {'step': int(step), 'wall': time.perf_counter() - self.t0}
+        record.update({key: to_float(value) for key, value in self.current.items()})
+        record.update({key: to_float(value) for key, value in values.items()})
+        record['peak_rss_MB'] = peak_memory_MB()
+        self.trace.append(record)
+        self.current = {}
+        if self.path is not None:
+            with open(self.path, 'a') as f:
+                f.write(json.dumps(dict(record, solver=self.solver)) + '\n')
+        if self.printer is not None:
+            self.printer(record)
+        return record
+
+    def records(self):
+        ''':return: numpy record array, one row per iteration, missing entries are nan'''
+        keys = []
+        for record in self.trace:
+            keys += [key for key in record if key not in keys]
+        trace = np.full(len(self.trace), np.nan, dtype=[(key, float) for key in keys])
+        for i, record in enumerate(self.trace):
+            for key, value in record.items():
+                trace[i][key] = value
+        return trace.view(np.recarray)
+
+    def summary(self):
+        '''Print the total time of each stage and the totals of the counters'''
+        trace = self.records()
+        if len(trace) == 0:
+            return
+        print('iterations = ', len(trace), 'wall = %.3f s' % trace['wall'][-1])
+        for key in trace.dtype.names:
+            if key.startswith('time_') or key.startswith('matvecs') or key.startswith('lgmres'):
+                print('%-22s %.6g' % (key, np.nansum(trace[key])))
@@ -0,0 +1,203 @@
+import numpy as np
+from scipy import linalg
+
+'''
+#################################################
+Thread-safe Krylov eigensolver
+scipy's eigs/eigsh hold one global lock around ARPACK (it is not re-entrant), so
+eigensolves submitted to a thread pool run one after another. This restarted
+Arnoldi only uses numpy/scipy.linalg, whose BLAS calls release the GIL, so several
+of them (e.g. the Ac and C problems of all sites of a unit cell) run concurrently.
+One eigenpair: after every Krylov space of dimension krylov_dim the Arnoldi is
+restarted from the selected Ritz vector, which is enough with a good initial
+guess (the Ac, C of the previous VUMPS iteration).
+Both ends of a spectrum (arnoldi_both_ends, the AKLT excitations): the wanted Ritz values
+at the two ends share one Krylov space, which is restarted Krylov-Schur style, keeping
+the Schur vectors of the Ritz values at both ends (more than the wanted ones, so the
+restarts keep the spectral information close to them). For a complex operator eigsh has
+no which='BE', so this replaces one eigs run for each end.
+Many eigenpairs (block_davidson, the excitations with dispersion_mpo(block=True)): the
+operator is applied to a block of vectors at once, so its contractions are matrix-matrix
+products, and the block can start from the eigenvectors of a neighbouring problem.
+Without a preconditioner the search space is a block Krylov space, which needs more
+operator applications than one Lanczos/Arnoldi sequence for the same accuracy; the block
+pays off when one application to b vectors is much cheaper than b applications.
+#################################################
+'''
+def arnoldi_eig(matvec, v0, which='SR', tol=1e-10, krylov_dim=20, maxiter=200):
+    '''
+    :param matvec: function x -> A x on flat complex vectors
+    :param v0: initial guess (flat)
+    :param which: 'SR' (smallest real part) or 'LM' (largest magnitude)
+    :param tol: relative residual ||A v - theta v|| < tol * max(|theta|, 1)
+    :param krylov_dim: dimension of the Krylov space before a restart
+    :param maxiter: maximal number of restarts
+    :return: theta, v (normalized), converged
+    '''
+    v = np.asarray(v0, dtype=complex).reshape(-1)
+    n = v.size
+    m = min(krylov_dim, n)
+    v = v / linalg.norm(v)
+    for restart in range(maxiter):
+        V = np.zeros([m + 1, n], dtype=complex)
+        H = np.zeros([m + 1, m], dtype=complex)
+        V[0] = v
+        k = m
+        for j in range(m):
+            w = matvec(V[j]).astype(complex)
+            for _ in range(2): ## classical Gram-Schmidt, twice
+                h = np.conj(V[:j+1]) @ w
+                w = w - h @ V[:j+1]
+                H[:j+1, j] += h
+            H[j+1, j] = linalg.norm(w)
+            if abs(H[j+1, j]) < 1e-14 * linalg.norm(H[:j+2, j]):
+                k = j + 1 ## invariant subspace
+                break
+            V[j+1] = w / H[j+1, j]
+        theta, Y = linalg.eig(H[:k, :k])
+        if which == 'SR':
+            i = np.argmin(theta.real)
+        elif which == 'LM':
+            i = np.argmax(abs(theta))
+        else:
+            raise ValueError('which must be SR or LM')
+        y = Y[:, i] / linalg.norm(Y[:, i])
+        residual = abs(H[k, k-1] * y[-1])
+        v = y @ V[:k]
+        v = v / linalg.norm(v)
+        if residual < tol * max(abs(theta[i]), 1.):
+            return theta[i], v, True
+    return theta[i], v, False
+
+def arnoldi_both_ends(matvec, v0, k, tol=1e-10, krylov_dim=None, keep=None, maxiter=300):
+    '''
+    The k eigenvalues with the largest and the k with the smallest real part from one Krylov space
+    (Krylov-Schur restarts: after every Krylov space of dimension krylov_dim the Schur form of the
+    Arnoldi matrix is reordered and truncated to the `keep` Ritz values at each end, and the
+    Arnoldi continues from there)
+    :param matvec: function x -> A x on flat complex vectors
+    :param v0: initial vector (flat)
+    :param tol: relative residual ||A v - theta v|| < tol * max(|theta|, 1) of all 2k Ritz pairs
+    :param krylov_dim: dimension of the Krylov space before a restart (default max(20, 6k))
+    :param keep: Ritz values kept at each end at a restart (default k + (krylov_dim - 2k) // 4)
+    :param maxiter: maximal number of restarts
+    :return: theta (2k values in ascending real part), X (columns: eigenvectors), converged
+    '''
+    v = np.asarray(v0, dtype=complex).reshape(-1)
+    n = v.size
+    m = min(krylov_dim or max(20, 6 * k), n)
+    keep = min(keep or k + (m - 2 * k) // 4, (m - 1) // 2)
+    V = np.zeros([m + 1, n], dtype=complex)
+    H = np.zeros([m + 1, m], dtype=complex)
+    V[0] = v / linalg.norm(v)
+    p = 0
+    for restart in range(maxiter):
+        size = m
+        for j in range(p, m):
+            w = matvec(V[j]).astype(complex)
+            for _ in range(2): ## classical Gram-Schmidt, twice
+                h = np.conj(V[:j+1]) @ w
+                w = w - h @ V[:j+1]
+                H[:j+1, j] += h
+            H[j+1, j] = linalg.norm(w)
+            if abs(H[j+1, j]) < 1e-14 * linalg.norm(H[:j+2, j]):
+                size = j + 1 ## invariant subspace
+                H[j+1, j] = 0
+                break
+            V[j+1] = w / H[j+1, j]
+        wanted = min(k, size // 2)
+        kept = min(keep, size // 2)
+        real = np.sort(linalg.eigvals(H[:size, :size]).real)
+        low, high = real[kept - 1], real[-kept]
+        T, Z, p = linalg.schur(H[:size, :size], output='complex', sort=lambda x: x.real <= low or x.real >= high)
+        b = H[size, size - 1] * Z[size - 1, :p]
+        theta, S = linalg.eig(T[:p, :p])
+        order = np.argsort(theta.real)
+        order = np.concatenate([order[:wanted], order[-wanted:]])
+        S = S[:, order] / linalg.norm(S[:, order], axis=0)
+        converged = size < m or np.all(abs(b @ S) < tol * np.maximum(abs(theta[order]), 1.))
+        if converged or restart == maxiter - 1:
+            X = V[:size].T @ (Z[:, :p] @ S)
+            return theta[order], X, bool(converged)
+        V[:p] = Z[:, :p].T @ V[:m]
+        V[p] = V[m]
+        H[:] = 0
+        H[:p, :p] = T[:p, :p]
+        H[p, :p] = b
+
+def select(theta, which, k):
+    ''':return: indices of the k wanted values of theta (for 'BE' k at each end), best first'''
+    if which == 'SR':
+        return np.argsort(theta.real)[:k]
+    if which == 'LR':
+        return np.argsort(-theta.real)[:k]
+    if which == 'LM':
+        return np.argsort(-abs(theta))[:k]
+    if which == 'BE':
+        order = np.argsort(theta.real)
+        k = min(k, len(theta) // 2)
+        return np.concatenate([order[:k], order[len(order)-k:]])
+    raise ValueError('which must be SR, LR, LM or BE')
+
+def orthonormalize(X, V=None):
+    ''':return: orthonormal basis of the columns of X orthogonal to the columns of V (columns of norm < 1e-10 dropped)'''
+    for _ in range(2): ## classical Gram-Schmidt, twice
+        if V is not None:
+            X = X - V @ (np.conj(V.T) @ X)
+        Q, R = linalg.qr(X, mode='economic')
+        X = Q[:, abs(np.diag(R)) > 1e-10 * max(np.max(abs(np.diag(R)), initial=0), 1e-300)]
+    return X
+
+def block_davidson(matmat, X0, k, which='SR', tol=1e-10, hermitian=False, max_dim=None, maxiter=500):
+    '''
+    Block Davidson (without preconditioner: a block Krylov method with thick restarts)
+    The search space starts from the block X0 and is extended in every iteration by the residuals
+    of the unconverged Ritz pairs, which are multiplied by A in one call (matrix-matrix products).
+    When it exceeds max_dim it is restarted with the best 2k Ritz vectors.
+    :param matmat: function X -> A X on blocks (n, b) of complex vectors
+    :param X0: initial block (n, b), e.g. the eigenvectors of a neighbouring problem, b >= k
+    :param k: number of eigenpairs ('BE': k at each end)
+    :param which: 'SR', 'LR', 'LM' (smallest, largest real part, largest magnitude) or 'BE'
+                  (k smallest and k largest real part)
+    :param tol: relative residual ||A v - theta v|| < tol * max(|theta|, 1) of all wanted Ritz pairs
+    :param hermitian: A is hermitian (Rayleigh-Ritz with eigh)
+    :param max_dim: dimension of the search space before a restart (default max(100, 3b + 2 wanted))
+    :param maxiter: maximal number of iterations
+    :return: theta, X (columns: eigenvectors, in the order of theta, best first; 'BE': ascending),
+             converged, number of columns multiplied by A
+    '''
+    X0 = np.asarray(X0, dtype=complex)
+    n, b = X0.shape
+    wanted = 2 * k if which == 'BE' else k
+    max_dim = min(max_dim or max(100, 3 * b + 2 * wanted), n)
+    V = orthonormalize(X0)
+    AV = matmat(V)
+    matvecs = V.shape[1]
+    for iteration in range(maxiter):
+        H = np.conj(V.T) @ AV
+        if hermitian:
+            theta, Y = linalg.eigh((H + np.conj(H.T)) / 2)
+        else:
+            theta, Y = linalg.eig(H)
+        order = select(theta, which, k)
+        if which == 'BE':
+            order = order[np.argsort(theta[order].real)]
+        X = V @ Y[:, order]
+        R = AV @ Y[:, order] - X * theta[order]
+        residuals = linalg.norm(R, axis=0) / linalg.norm(X, axis=0)
+        unconverged = residuals >= tol * np.maximum(abs(theta[order]), 1.)
+        if not np.any(unconverged) or V.shape[1] == n:
+            return theta[order], X / linalg.norm(X, axis=0), True, matvecs
+        R = R[:, np.argsort(-residuals)[:min(b, np.sum(unconverged))]]
+        if V.shape[1] + R.shape[1] > max_dim:
+            ## thick restart with the best 2k Ritz vectors (at each end for 'BE'), A V follows without matvecs
+            Q, _ = linalg.qr(Y[:, select(theta, which, min(2 * k, max_dim // 4 if which == 'BE' else max_dim // 2))],
+                             mode='economic')
+            V, AV = V @ Q, AV @ Q
+        R = orthonormalize(R, V)
+        if R.shape[1] == 0:
+            return theta[order], X / linalg.norm(X, axis=0), False, matvecs
+        V = np.hstack([V, R])
+        AV = np.hstack([AV, matmat(R)])
+        matvecs += R.shape[1]
+    return theta[order], X / linalg.norm(X, axis=0), False, matvecs
@@ -1,5 +1,6 @@
 import constants
 import vumps
+import ncon_plan
 from ncon import ncon
 import numpy as np
 from scipy import linalg
@@ -30,10 +31,11 @@ A = np.random.rand(D, d, D)
 e_cal, Ac, C, A_L, A_R, L_W, R_W = vumps.vumps_mpo(W,A, eta=1e-8)
 e_error = abs((e_cal - e_exact) / e_exact)
 print('e_error = ', e_error)
-for p in [0, np.pi]:
+dispersion = vumps.dispersion_mpo(W, A_L, A_R, L_W, R_W, [0, np.pi], num_of_excite=num_of_excite, system = '1D')
+for p, omega in dispersion:
     print('p = ', p)
-    omega, _ = vumps.quasiparticle_mpo(W, p, A_L, A_R, L_W, R_W, num_of_excite=num_of_excite, system = '1D')
     print('omega = ', (omega-e_cal).real)
+ncon_plan.report()
 
 '''A_L1 = A_L
 A_R2 = ncon([A_R, sZ],
@@ -1,5 +1,8 @@
+import os
+import sys
 import constants
 import vumps
+import ncon_plan
 from ncon import ncon
 import numpy as np
 from scipy import linalg
@@ -10,6 +13,7 @@ from scipy.sparse.linalg import LinearOperator
 D = 12;
 num_of_excite = 10
 num_of_p = 10
+resume = '--resume' in sys.argv ## python mainAKLT.py --resume continues from the checkpoint of an earlier run
 aklt = constants.get_AKLT()
 dim = aklt.shape[1]
 W = ncon([aklt, np.conj(aklt)],
@@ -24,16 +28,25 @@ print('vumps part begin')
 W = W/1.30574308 ## Make the largest eigenvalue equals 1 in vumps case
 print('d*D**2 = ', d*D**2)
 A = np.random.rand(D, d, D)
-eta_0, Ac, C, A_L, A_R, L_W, R_W = vumps.vumps_fixed_points(W, A, eta=1e-6)
+checkpoint_dir = 'aklt_D%d' % D
+resume_from = None
+if resume and os.path.isdir(checkpoint_dir):
+    resume_from = checkpoint_dir
+    print('resuming from the checkpoint ', os.path.abspath(checkpoint_dir))
+elif resume:
+    print('no checkpoint ', os.path.abspath(checkpoint_dir), ', starting from a random A')
+eta_0, Ac, C, A_L, A_R, L_W, R_W = vumps.vumps_fixed_points(W, A, eta=1e-6, save_to=checkpoint_dir,
+                                                             resume_from=resume_from)
 print('eta_0 = ', eta_0)
 
 # p = 0
 omega_kx0 = []
 omega_kxpi = []
 # for p in [0, np.pi]:
-for p in np.linspace(0,np.pi,11):
+momenta = np.linspace(0,np.pi,11)
+dispersion = vumps.dispersion_mpo(W, A_L, A_R, L_W, R_W, momenta, num_of_excite=num_of_excite, system='AKLT')
+for p, omega in dispersion:
     print('p = ', p)
-    omega, _ = vumps.quasiparticle_mpo(W, p, A_L, A_R, L_W, R_W, num_of_excite=num_of_excite, system='AKLT')
     omega_kx0_tmp = list(omega[omega > 0])
     omega_kxpi_tmp = list(omega[omega < 0])
     omega_kx0.append(omega_kx0_tmp)
@@ -51,3 +64,4 @@ print(omega_kx0)
 np.save('D12kx0.npy', omega_kx0)
 print(omega_kxpi)
 np.save('D12kxpi.npy', omega_kxpi)
+ncon_plan.report()
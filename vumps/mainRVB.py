@@ -1,5 +1,6 @@
 import constants
 import vumps
+import ncon_plan
 from ncon import ncon
 import numpy as np
 from scipy import linalg
@@ -28,13 +29,14 @@ eta_0, Ac, C, A_L, A_R, L_W, R_W = vumps.vumps_fixed_points(W, A, eta=1e-6)
 print('eta_0 = ', eta_0)
 
 
-for p in [0, np.pi*0.9]:
+dispersion = vumps.dispersion_mpo(W, A_L, A_R, L_W, R_W, [0, np.pi*0.9], num_of_excite=num_of_excite, system='RVB')
+for p, omega in dispersion:
     print('p = ', p)
-    omega, _ = vumps.quasiparticle_mpo(W, p, A_L, A_R, L_W, R_W, num_of_excite=num_of_excite, system='RVB')
     print('omega = ', omega)
     phi = np.angle(omega)/np.pi*180
     print('phi = ', np.array2string(phi, formatter={'float_kind':lambda phi: "%.2f" % phi}))
     min_ln = -np.log(abs(omega / eta_0))
     print('min_ln = ', min_ln)
     print('sorted(min_ln) = ', sorted(list(min_ln)))
+ncon_plan.report()
 exit()
\ No newline at end of file
@@ -0,0 +1,73 @@
+import numpy as np
+
+'''
+#################################################
+Sparse MPO
+The MPOs of constants.Model are lower triangular and most of the d_w x d_w blocks
+W[a,b] are zero or the identity. SparseMPO keeps only the nonzero blocks as terms
+(a, b, c, O) meaning W[a,b] = c*O, with O = None for c*identity, so that the
+environment recursion of get_Lh_Rh_mpo and the effective Hamiltonian of Ac cost
+O(number of terms) instead of O(d_w^2), and identity blocks skip the operator
+(one TransferOperator without O, no d x d multiplication in Heff).
+Legs as in vumps.py: W[a,b,ket physical,bra physical].
+Usage:
+W_sparse = mpo.SparseMPO(W)
+W_sparse.apply_Hac(L_W, Ac, R_W)    (= ncon([L_W,Ac,W,R_W],[[-1,3,1],[1,5,2],[3,4,5,-2],[-3,4,2]]))
+#################################################
+'''
+class SparseMPO:
+    def __init__(self, W, tol=1e-14):
+        '''
+        :param W: dense MPO tensor (d_w, d_w, d, d)
+        :param tol: blocks with max|W[a,b]| <= tol are dropped
+        '''
+        self.W = W
+        self.shape = W.shape
+        self.d_w, _, self.d, _ = W.shape
+        eye = np.eye(self.d)
+        self.terms = []
+        for a in range(self.d_w):
+            for b in range(self.d_w):
+                O = W[a, b]
+                c = O[0, 0].item()
+                if np.max(abs(O)) <= tol:
+                    continue
+                if np.max(abs(O - c*eye)) <= tol:
+                    self.terms.append((a, b, c, None))
+                else:
+                    self.terms.append((a, b, 1., O))
+        self.rows = sorted(set(a for a, _, _, _ in self.terms))
+        self.columns = sorted(set(b for _, b, _, _ in self.terms))
+
+    def __repr__(self):
+        return 'SparseMPO(d_w=%d, d=%d, %d nonzero blocks, %d identities)' % (
+            self.d_w, self.d, len(self.terms), sum(O is None for _, _, _, O in self.terms))
+
+    def left_terms(self, i):
+        ''':return: (j, c, O) of W[j,i] with j > i, i.e. the terms of L_W[i] = sum_j L_W[j] T[j,i]'''
+        return [(a, c, O) for a, b, c, O in self.terms if b == i and a > i]
+
+    def right_terms(self, i):
+        ''':return: (j, c, O) of W[i,j] with j < i, i.e. the terms of R_W[i] = sum_j T[i,j] R_W[j]'''
+        return [(b, c, O) for a, b, c, O in self.terms if a == i and b < i]
+
+    def apply_Hac(self, L_W, Ac, R_W):
+        '''
+        Effective Hamiltonian of Ac, L_W (D, d_w, D), Ac (D, d, D), R_W (D, d_w, D)
+        L_W[:,a,:] Ac is computed once per row a, and contracted with R_W[:,b,:] once per
+        column b, the operators act in between on the physical leg only.
+        '''
+        D_l, d, D_r = Ac.shape
+        Ac = Ac.reshape(D_l, d*D_r)
+        LA = {a: (L_W[:, a, :] @ Ac).reshape(D_l, d, D_r).transpose([1,0,2]).reshape(d, -1)
+              for a in self.rows}
+        Y = {}
+        for a, b, c, O in self.terms:
+            term = c*LA[a] if O is None else c*(O.T @ LA[a])
+            Y[b] = term if b not in Y else Y[b] + term
+        Ac_new = sum(Y[b].reshape(d*D_l, D_r) @ R_W[:, b, :].T for b in Y)
+        return Ac_new.reshape(d, D_l, -1).transpose([1,0,2])
+
+def as_sparse(W):
+    ''':return: W if it is already a SparseMPO, otherwise SparseMPO(W)'''
+    return W if isinstance(W, SparseMPO) else SparseMPO(W)
@@ -0,0 +1,119 @@
+import time
+import numpy as np
+from ncon import ncon as ncon_raw
+
+'''
+#################################################
+Precompiled contraction plans
+ncon re-parses the index lists and contracts in the order 1,2,3,... on every call.
+Inside the matvecs of the eigensolvers the same network with the same shapes is
+contracted thousands of times, so here every (connects, shapes) pair is compiled
+once into a list of pairwise tensordot steps (cheapest pair first) plus the final
+transpose, and cached.
+Usage is identical to ncon:
+from ncon_plan import ncon
+T = ncon([A_L, np.conj(A_L)],
+         [[-4,1,-2], [-3,1,-1]])
+#################################################
+'''
+_plans = {}
+_stats = {'misses': 0, 'compile_time': 0.}
+
+def compile_plan(connects, shapes):
+    '''
+    :param connects: index lists in ncon convention (positive: contracted, negative: open)
+    :param shapes: shapes of the tensors
+    :return: (steps, perm), or None if the network contains a trace (handled by ncon_raw)
+    Each step is (a, b, axes_a, axes_b): contract L[a] with L[b] (a < b), remove both
+    and append the result. perm is the final transpose to the order -1,-2,...
+    '''
+    v = [list(c) for c in connects]
+    dims = {}
+    for c, s in zip(v, shapes):
+        if len(set(c)) != len(c):
+            return None
+        for i, n in zip(c, s):
+            dims[i] = n
+    steps = []
+    while len(v) > 1:
+        best = None
+        for a in range(len(v)):
+            for b in range(a+1, len(v)):
+                shared = [i for i in v[a] if i in v[b]]
+                cost = int(np.prod([dims[i] for i in set(v[a]) | set(v[b])], dtype=float))
+                key = (len(shared) == 0, cost) # outer products only when nothing else is left
+                if best is None or key < best[0]:
+                    best = (key, a, b, shared)
+        _, a, b, shared = best
+        axes_a = [v[a].index(i) for i in shared]
+        axes_b = [v[b].index(i) for i in shared]
+        new_v = [i for i in v[a] if i not in shared] + [i for i in v[b] if i not in shared]
+        steps.append((a, b, axes_a, axes_b))
+        del v[b]
+        del v[a]
+        v.append(new_v)
+    perm = [v[0].index(i) for i in sorted(v[0], reverse=True)]
+    if perm == list(range(len(perm))):
+        perm = None
+    return steps, perm
+
+def run_plan(plan, tensors):
+    steps, perm = plan
+    L = list(tensors)
+    for a, b, axes_a, axes_b in steps:
+        new_A = np.tensordot(L[a], L[b], (axes_a, axes_b))
+        del L[b]
+        del L[a]
+        L.append(new_A)
+    A = L[0]
+    if perm is not None:
+        A = A.transpose(perm)
+    return A
+
+def ncon(tensors, connects, order=None, forder=None):
+    '''Drop-in replacement of ncon which runs through the plan cache'''
+    if order is not None or forder is not None:
+        return ncon_raw(tensors, connects, order=order, forder=forder)
+    key = (tuple(map(tuple, connects)), tuple(t.shape for t in tensors))
+    entry = _plans.get(key)
+    if entry is None:
+        ## compile, and time plain ncon against the plan once to know the gain per hit
+        t0 = time.perf_counter()
+        plan = compile_plan(connects, key[1])
+        t1 = time.perf_counter()
+        A_raw = ncon_raw(list(tensors), [list(c) for c in connects])
+        t2 = time.perf_counter()
+        if plan is None:
+            A, t3 = A_raw, t2
+        else:
+            A = run_plan(plan, tensors)
+            t3 = time.perf_counter()
+        _stats['compile_time'] += t1 - t0
+        _stats['misses'] += 1
+        _plans[key] = entry = [plan, (t2 - t1) - (t3 - t2), 0]
+        return A
+    entry[2] += 1
+    if entry[0] is None:
+        return ncon_raw(tensors, connects)
+    return run_plan(entry[0], tensors)
+
+def plan_stats():
+    '''
+    :return: dict with number of cached plans, hits, misses, total compile time and
+    saved time = sum over plans of (hits * (time of plain ncon - time of the plan)),
+    where both times are measured once when the plan is compiled
+    '''
+    stats = dict(_stats)
+    stats['plans'] = len(_plans)
+    stats['hits'] = sum(entry[2] for entry in _plans.values())
+    stats['saved_time'] = sum(entry[1]*entry[2] for entry in _plans.values()) - _stats['compile_time']
+    return stats
+
+def report():
+    stats = plan_stats()
+    print('ncon plans = ', stats['plans'], 'hits = ', stats['hits'], 'misses = ', stats['misses'])
+    print('compile time = %.3fs, saved time = %.3fs' % (stats['compile_time'], stats['saved_time']))
+
+def clear_plans():
+    _plans.clear()
+    _stats.update(misses=0, compile_time=0.)
@@ -0,0 +1,109 @@
+import os
+import multiprocessing
+import contextlib
+import numpy as np
+from concurrent.futures import ProcessPoolExecutor
+
+'''
+#################################################
+Concurrent pairs of independent solves
+Several steps of the solvers are pairs of independent problems: the left and the
+right environment of vumps_mpo, the fixed points of T_W from the left and from the
+right in vumps_fixed_points, the eigenproblems of Ac and C, and the fixed points of
+T_RL and T_LR in the quasiparticle setup. At moderate D one of them does not
+saturate the BLAS, but scipy's eigs/eigsh hold one global lock around ARPACK
+(see krylov.py), so in a thread pool the eigensolves of a pair would still run one
+after the other. A PairPool runs the two problems of a pair in two worker processes.
+The BLAS threads are partitioned explicitly: the workers are started with
+blas_threads BLAS threads each (OMP_NUM_THREADS, OPENBLAS_NUM_THREADS, MKL_NUM_THREADS;
+default: half of the cores), so a pair does not oversubscribe the node.
+The workers run the same module level functions on the same arrays as the
+sequential path (pool=None), and every ARPACK call gets an explicit start vector
+(start_vector, ARPACK's own random start depends on the previous calls in the
+process), so the results are bit-identical to a sequential run with the same
+number of BLAS threads. The default blas_threads (half of the cores) is not the
+thread count of the parent, which keeps all cores, so with the defaults the two
+paths differ in the last bits; for identical results start the parent with
+OMP_NUM_THREADS etc. set to blas_threads.
+When it pays off: a pair costs max(t_f, t_g) + overhead instead of t_f + t_g, where
+the overhead (pickling the arrays to the workers and back, ~2-5 ms for D <= 32,
+~10-15 ms at D = 64) must stay below the shorter solve. Measured per call on one core,
+critical TFIM (d_w = 3), tolerances 1e-9, states after 60 VUMPS steps:
+  D     left/right environment     Ac / C eigenproblem     overhead (env, Ac/C)
+  16    7.8 / 7.1 ms               1.3 / 0.9 ms             3 / 2 ms
+  32    14 / 13 ms                 1.5 / 0.9 ms             5 / 2 ms
+  64    53 / 53 ms                 7 / 3.5 ms               12 / 5 ms
+  128   210 / 215 ms               95 / 23 ms               (*) / 18 ms
+so the environments gain from D ~ 16 on and the Ac/C pair (with warm started
+eigensolvers the C problem is short) only from D ~ 128; below D ~ 16 the pool is
+slower than pool=None. (*) two workers on one core thrash the cache, the parallel
+speedup on a multi-core node was not measured.
+The workers are started with 'spawn', so the script has to start the solver under
+if __name__ == '__main__':
+Usage:
+with parallel.PairPool(blas_threads=16) as pool:
+    vumps.vumps_mpo(W, A, pool=pool)
+#################################################
+'''
+BLAS_VARIABLES = ['OMP_NUM_THREADS', 'OPENBLAS_NUM_THREADS', 'MKL_NUM_THREADS']
+
+class PairPool:
+    def __init__(self, blas_threads=None, start_method='spawn'):
+        '''
+        :param blas_threads: BLAS threads of each of the two workers (default: half of the cores;
+                             bit-identity with pool=None needs the same count in the parent)
+        :param start_method: of multiprocessing ('spawn', 'forkserver'; with 'fork' the workers keep
+                             the BLAS threads of the parent)
+        '''
+        self.blas_threads = max(1, (os.cpu_count() or 2) // 2) if blas_threads is None else blas_threads
+        with blas_environment(self.blas_threads):
+            self.executor = ProcessPoolExecutor(max_workers=2,
+                                                mp_context=multiprocessing.get_context(start_method))
+            ## start both workers now, while the variables are set
+            for job in [self.executor.submit(os.getpid) for _ in range(2)]:
+                job.result()
+
+    def run(self, f, args_f, g, args_g):
+        ''':return: f(*args_f), g(*args_g), computed in the two workers'''
+        job_f = self.executor.submit(f, *args_f)
+        job_g = self.executor.submit(g, *args_g)
+        return job_f.result(), job_g.result()
+
+    def close(self):
+        self.executor.shutdown()
+
+    def __enter__(self):
+        return self
+
+    def __exit__(self, *exc):
+        self.close()
+
+@contextlib.contextmanager
+def blas_environment(blas_threads):
+    '''
+    Sets the BLAS thread variables to blas_threads for the processes started inside the block
+    (the BLAS of the running process is already loaded and keeps its threads)
+    '''
+    environ = {key: os.environ.get(key) for key in BLAS_VARIABLES}
+    os.environ.update({key: str(blas_threads) for key in BLAS_VARIABLES})
+    try:
+        yield
+    finally:
+        for key, value in environ.items():
+            if value is None:
+                os.environ.pop(key)
+            else:
+                os.environ[key] = value
+
+def run_pair(pool, f, args_f, g, args_g):
+    '''
+    :param pool: PairPool, or None for sequential execution
+    :return: f(*args_f), g(*args_g)
+    '''
+    if pool is None:
+        return f(*args_f), g(*args_g)
+    return pool.run(f, args_f, g, args_g)
+
+def start_vector(n, dtype=float):
+    ''':return: fixed pseudo random start vector of size n for eigs/eigsh, the same in every process'''
+    return np.random.default_rng(0).random(n).astype(dtype)
@@ -1,11 +1,113 @@
 import constants
-from ncon import ncon
+import transfer
+import parallel
+from ncon_plan import ncon
 import numpy as np
 from scipy import linalg
 from scipy.sparse.linalg import eigs
 from scipy.sparse.linalg import eigsh
 from scipy.sparse.linalg import LinearOperator
-from scipy.sparse.linalg import bicgstab
+from scipy.sparse.linalg import lgmres
+
+'''
+#################################################
+Reusable solver of (1 - T + |l)(r|) y = x - (r|x)|l)
+(or of (1 - T) y = x if no fixed points are given, as in the domain part)
+One TransferSolver is bound to one transfer operator T and is called with many
+right hand sides x, e.g. twice per Lanczos step in the quasiparticle matvec.
+It keeps
+1. the previous solution as initial guess of the next solve,
+2. the augmentation vectors of lgmres (outer_v), i.e. a recycled Krylov subspace,
+3. an optional preconditioner which inverts the operator exactly on the
+   subspace of the dominant eigenvectors of T (precondition = number of them),
+and counts calls, lgmres iterations and matvecs.
+Ref: A. H. Baker et al., SIAM J. Matrix Anal. Appl. 26, 962 (2005) (LGMRES)
+#################################################
+'''
+class TransferSolver:
+    def __init__(self, T, r=None, l=None, tol=1e-8, precondition=0, outer_k=5, warm_start=True):
+        '''
+        :param T: transfer.TransferOperator (including the momentum phase if there is one)
+        :param r: vector of the projector (r|, same shape as T.vshape)
+        :param l: vector of the projector |l)
+        :param tol: relative tolerance of lgmres
+        :param precondition: number of dominant eigenvectors of T used for the preconditioner
+        :param outer_k: number of recycled vectors kept by lgmres
+        :param warm_start: start from the previous solution
+        '''
+        self.T = T
+        self.r = None if r is None else r.reshape(-1)
+        self.l = None if l is None else l.reshape(-1)
+        self.tol = tol
+        self.outer_k = outer_k
+        self.outer_v = []
+        self.warm_start = warm_start
+        self.y_prev = None
+        self.calls = 0
+        self.iterations = 0
+        self.matvecs = 0
+        dtype = T.dtype if r is None else np.result_type(T.dtype, r, l)
+        self.op = LinearOperator(T.shape, matvec=self.map_y, dtype=dtype)
+        self.M = None
+        if precondition > 0:
+            self.M = self.get_preconditioner(precondition)
+
+    def map_y(self, y): ## eqn(D13) in PRB 97, 045145 (2018)
+        self.matvecs += 1
+        y_out = y - self.T.apply(y).reshape(-1)
+        if self.r is not None:
+            y_out = y_out + np.dot(self.r, y)*self.l
+        return y_out
+
+    def get_preconditioner(self, k):
+        '''
+        With right/left dominant eigenvectors R, L (N x k) of T, G = L^T R and H = L^T A R,
+        M = 1 + R (H^-1 - G^-1) L^T is the exact inverse of A on span(R) and the
+        identity on the rest. Helps for the plain transfer matrices (2sites); the MPO
+        transfer matrices have Jordan blocks at the dominant eigenvalue, where it does not.
+        '''
+        k = min(k, self.T.size - 2)
+        v0 = parallel.start_vector(self.T.size)
+        _, R = eigs(self.T.linear_operator(), k=k, which='LM', v0=v0)
+        _, L = eigs(self.T.linear_operator(transpose=True), k=k, which='LM', v0=v0)
+        AR = np.stack([self.map_y(R[:, i]) for i in range(k)], axis=1)
+        G = L.T @ R
+        H = L.T @ AR
+        K = linalg.inv(H) - linalg.inv(G)
+        def precondition(x):
+            return x + R @ (K @ (L.T @ x))
+        return LinearOperator(self.T.shape, matvec=precondition, dtype=np.result_type(self.op.dtype, R))
+
+    def solve(self, x, tol=None, x0=None):
+        '''
+        :param x: right hand side with shape T.vshape
+        :param x0: initial guess (default: previous solution, or x_tilda for the first call)
+        :return: y with shape T.vshape
+        :raise RuntimeError: if lgmres does not converge (a batch job then fails and is retried)
+        '''
+        def count(_):
+            self.iterations += 1
+        x = x.reshape(-1)
+        if self.r is not None:
+            x_tilda = x - np.dot(self.r, x)*self.l
+        else:
+            x_tilda = x
+        if x0 is None:
+            x0 = self.y_prev if (self.warm_start and self.y_prev is not None) else x_tilda
+        tol = self.tol if tol is None else tol
+        y, info = lgmres(self.op, x_tilda, x0=x0.reshape(-1), tol=tol, atol=0., M=self.M, callback=count,
+                         outer_k=self.outer_k, outer_v=self.outer_v)
+        self.calls += 1
+        if info != 0:
+            raise RuntimeError('lgmres did not converge (info = %d)' % info)
+        self.y_prev = y
+        return y.reshape(self.T.vshape)
+
+    def stats(self):
+        return {'calls': self.calls, 'iterations': self.iterations, 'matvecs': self.matvecs}
+
+    def report(self, name='solver'):
+        print(name, ': calls = ', self.calls, 'iterations = ', self.iterations, 'matvecs = ', self.matvecs)
 
 '''
 #################################################
@@ -15,25 +117,20 @@ then solve y_R from (1-T_R)^inv @ x_R = y_R
 Ref: PRB 97, 045145 (2018) Appendix D
 #################################################
 '''
-def sum_right_left(x, A_R, C, tol=1e-8):
-    def map_y(y_R): ## eqn(D13) in PRB 97, 045145 (2018)
-        y_R = y_R.reshape(D,D)
-        term1 = y_R
-        term2 = ncon([y_R,A_R,np.conj(A_R)],
-                     [[3,1],[1,2,-2],[3,2,-1]])
-        term3 = ncon([y_R,L],
-                     [[1,2],[1,2]])*np.eye(D,D)
-        return (term1-term2+term3).reshape(-1)
+def sum_right_left(x, A_R, C, tol=1e-8, x0=None, stats=None):
+    '''
+    :param x0: initial guess, e.g. L_h/R_h of the previous VUMPS iteration (default: x_tilda)
+    :param stats: dict, the counters of the solver (TransferSolver.stats) are added to it
+    '''
     D,d,_ = A_R.shape
+    T_R = transfer.TransferOperator(A_R)
     L = ncon([np.conj(C), C],
              [[1,-1],[1,-2]]) # = C@np.conj(C.T)
-    x_tilda = x - ncon([x,L],
-                       [[1,2],[1,2]])
-    y_R, info = bicgstab(LinearOperator((D ** 2, D ** 2), matvec=map_y), x_tilda.reshape(-1),x0=x_tilda.reshape(-1), tol=tol)
-    y_R = y_R.reshape(D,D)
-    if info != 0:
-        print('bicgstab did not converge')
-        exit()
+    solver = TransferSolver(T_R, L, np.eye(D,D, dtype=L.dtype), tol=tol) ## dtype: keeps single precision
+    y_R = solver.solve(x, x0=x0)
+    if stats is not None:
+        for key, value in solver.stats().items():
+            stats[key] = stats.get(key, 0) + value
     return y_R
 '''
 #################################################
@@ -41,6 +138,51 @@ Excitation
 #################################################
 '''
 
+'''
+#################################################
+Spectral pseudo inverse shared by all momenta
+Schur decomposition T = Q S Q^dagger with the dominant eigenvalues (|lam| = 1)
+sorted into the upper left block. For the phase z = exp(-ip)
+1 - zT = Q [[M11, M12], [0, M22]] Q^dagger,  M = 1 - zS (upper triangular)
+M22 has no zero eigenvalue, so it is inverted by back substitution, and only
+the small block M11 (size = number of dominant eigenvalues) needs a pseudo inverse:
+y2 = M22^-1 x2,  y1 = pinv(M11) (x1 - M12 y2)
+The O(N^3) Schur decomposition is done once per transfer matrix, every momentum
+then costs O(N^2) per application, like the dense pinv.
+A Schur rather than an eigen decomposition, because the MPO transfer matrices
+have Jordan blocks at eigenvalue 1.
+#################################################
+'''
+def schur_transfer(T, dominant_tol=1e-6):
+    '''
+    :param T: transfer.TransferOperator (without momentum phase)
+    :param dominant_tol: eigenvalues with ||lam|-1| < dominant_tol go into the upper left block
+    :return: (S, Q, number of dominant eigenvalues, vshape of T)
+    '''
+    S, Q, m = linalg.schur(T.dense(), output='complex', sort=lambda x: abs(abs(x)-1) < dominant_tol)
+    return S, Q, m, T.vshape
+
+def schur_pinv(schur, phase):
+    '''
+    :param schur: result of schur_transfer
+    :param phase: z in 1 - zT
+    :return: function x -> pinv(1-zT) x (x with shape vshape, or vshape + (b,) for a block of b vectors)
+    '''
+    S, Q, m, vshape = schur
+    M = np.eye(S.shape[0]) - phase*S
+    M11_pinv = linalg.pinv(M[:m, :m]) if m > 0 else np.zeros([0, 0])
+    M12 = M[:m, m:]
+    M22 = np.asfortranarray(M[m:, m:])
+    Q_dagger = np.conj(Q.T)
+    def apply(x):
+        shape = x.shape
+        x = Q_dagger @ x.reshape(S.shape[0], -1)
+        y = np.zeros_like(x)
+        y[m:] = linalg.solve_triangular(M22, x[m:], check_finite=False)
+        y[:m] = M11_pinv @ (x[:m] - M12 @ y[m:])
+        return (Q @ y).reshape(shape)
+    return apply
+
 def Tw_to_rl(T_W):
     '''
     :param T_W: transder matrix with MPO
@@ -50,20 +192,17 @@ def Tw_to_rl(T_W):
     # print('doing get_rl')
     def map_r(r):
         '''If T_W = T_Wr, then it is map_l, for <l|T_Wr = <l|'''
-        r = r.reshape(D,d_w,D)
-        r_out = ncon([r, T_W],
-                     [[1,2,3], [1,2,3,-1,-2,-3]])
+        r_out = T_W.apply_transpose(r)
         return r_out.reshape(-1)
     def map_l(l):
         '''If T_W = T_Wr, then it is map_r, for T_Wr|r> = |r>'''
-        l = l.reshape(D,d_w,D)
-        l_out = ncon([T_W,l],
-                     [[-1,-2,-3,1,2,3], [1,2,3]])
+        l_out = T_W.apply(l)
         return l_out.reshape(-1)
-    D,d_w = T_W.shape[0], T_W.shape[1]
-    l_val, l = eigs(LinearOperator((D**2*d_w, D**2*d_w), matvec=map_l), k=1, which='LM')
+    D,d_w = T_W.vshape[0], T_W.vshape[1]
+    v0 = parallel.start_vector(D**2*d_w)
+    l_val, l = eigs(LinearOperator((D**2*d_w, D**2*d_w), matvec=map_l), k=1, which='LM', v0=v0)
     l = l.reshape(D,d_w,D)
-    r_val, r = eigs(LinearOperator((D**2*d_w, D**2*d_w), matvec=map_r), k=1, which='LM')
+    r_val, r = eigs(LinearOperator((D**2*d_w, D**2*d_w), matvec=map_r), k=1, which='LM', v0=v0)
     r = r.reshape(D,d_w,D)
     # print('norm(l_val) = ', linalg.norm(l_val), 'norm(r_val) = ', linalg.norm(r_val))
     # print(l_val, r_val)
@@ -79,17 +218,13 @@ def T_to_rl(T_RL):
     # print('doing get_rl')
     def map_r(r):
         '''If T = T_LR, then it is map_l, for <l|T_LR = <l|'''
-        r = r.reshape(D,D)
-        r_out = ncon([r, T_RL],
-                     [[1,2],[1,2,-1,-2]])
+        r_out = T_RL.apply_transpose(r)
         return r_out.reshape(-1)
     def map_l(l):
         '''If T_W = T_Wr, then it is map_r, for T_Wr|r> = |r>'''
-        l = l.reshape(D,D)
-        l_out = ncon([T_RL, l],
-                     [[-1,-2,1,2], [1,2]])
+        l_out = T_RL.apply(l)
         return l_out.reshape(-1)
-    D = T_RL.shape[0]
+    D = T_RL.vshape[0]
     l_val, l = eigs(LinearOperator((D**2, D**2), matvec=map_l), k=1, which='LM')
     l = l.reshape(D,D)
     r_val, r = eigs(LinearOperator((D**2, D**2), matvec=map_r), k=1, which='LM')
@@ -107,28 +242,9 @@ def quasi_sum_right_left_mpo(T_W, r, l, x):
     :param l: left dominant vector (If T_W = T_Wr, then it is r)
     :param x: tensor on which infinite sum we want to apply
     :return: y
+    Note: for repeated solves with the same T_W keep a TransferSolver instead
     '''
-    # print('doing quasi_sum_right_left')
-    def trans_map(y):
-        y = y.reshape(D,d_w,D)
-        term1 = y
-        term2 = ncon([T_W, y],
-                     [[-1,-2,-3,1,2,3], [1,2,3]])
-        term3 = ncon([r,y],
-                     [[1,2,3], [1,2,3]])*l
-        y_out = term1 + term2 + term3
-        return y_out.reshape(-1)
-    D,d_w,_ = x.shape
-    x_tilda = x - ncon([x,r],[[1,2,3],[1,2,3]])*l
-    y, info = bicgstab(LinearOperator((D**2*d_w, D**2*d_w), matvec=trans_map), x_tilda.reshape(-1),
-                       x0=x_tilda.reshape(-1))
-    # y, info = bicg(LinearOperator((D ** 2 * d_w, D ** 2 * d_w), matvec=trans_map), x_tilda.reshape(-1),
-    #                    x0=x_tilda.reshape(-1))
-    y = y.reshape(D,d_w,D)
-    if info != 0:
-        print('bicgstab did not converge!')
-        exit()
-    return y
+    return TransferSolver(T_W, r, l).solve(x)
 
 def quasi_sum_right_left_2sites(T_RL, r, l, x):
     '''
@@ -138,25 +254,6 @@ def quasi_sum_right_left_2sites(T_RL, r, l, x):
     :param l: left dominant vector (If T = T_LR, then it is r)
     :param x: tensor on which infinite sum we want to apply
     :return: y
+    Note: for repeated solves with the same T_RL keep a TransferSolver instead
     '''
-    # print('doing quasi_sum_right_left')
-    def trans_map(y):
-        y = y.reshape(D,D)
-        term1 = y
-        term2 = ncon([T_RL, y],
-                     [[-1,-2,1,2], [1,2]])
-        term3 = ncon([r,y],
-                     [[1,2], [1,2]])*l
-        y_out = term1 + term2 + term3
-        return y_out.reshape(-1)
-    D,_ = x.shape
-    x_tilda = x - ncon([x,r],[[1,2],[1,2]])*l
-    y, info = bicgstab(LinearOperator((D**2, D**2), matvec=trans_map), x_tilda.reshape(-1),
-                       x0=x_tilda.reshape(-1))
-    # y, info = bicg(LinearOperator((D ** 2 * d_w, D ** 2 * d_w), matvec=trans_map), x_tilda.reshape(-1),
-    #                    x0=x_tilda.reshape(-1))
-    y = y.reshape(D,D)
-    if info != 0:
-        print('bicgstab did not converge!')
-        exit()
-    return y
\ No newline at end of file
+    return TransferSolver(T_RL, r, l).solve(x)
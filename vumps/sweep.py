@@ -0,0 +1,116 @@
+import vumps
+import transfer
+from ncon_plan import ncon
+import numpy as np
+from scipy import linalg
+from scipy.sparse.linalg import eigs
+
+'''
+#################################################
+Parameter continuation for phase diagrams
+Instead of starting every point of a scan from a random A, each point is seeded
+with the converged state of its neighbour (passed to the solver as resume_from),
+without the 15 step floor of a cold start. Optionally the initial A_L is linearly
+extrapolated from the last two points, after bringing the previous A_L into the
+gauge of the last one. The step is adapted with the fidelity per site
+f = |lam| of the mixed transfer matrix of two neighbouring points, since
+1 - f ~ (dx)^2 grows near critical points: the step is multiplied by
+sqrt(fidelity_tol / (1 - f)) (between 1/4 and 2, at least grid step/max_substeps),
+so extra points are put in between the grid points where the state changes fast.
+Both options are off by default: for TFIM the iterations near hz = 1 are dominated
+by the slow convergence of VUMPS itself, not by the distance to the seed, so they buy
+resolution near the critical point and not fewer iterations.
+Usage:
+get_W = lambda hz: constants.Model('TFIM', 2, hz).get_h_W_E()[1]
+results, states = sweep.continuation_sweep(get_W, np.linspace(0.5, 1.5, 50), A)
+results['x'], results['e'], results['steps']
+#################################################
+'''
+## solver, names of its outputs and the environments which are used as warm start
+SOLVERS = {'mpo': (vumps.vumps_mpo, ['e', 'Ac', 'C', 'A_L', 'A_R', 'L_W', 'R_W'], []),
+           '2sites': (vumps.vumps_2sites, ['e', 'A_L', 'A_R', 'Ac', 'C', 'L_h', 'R_h'], ['L_h', 'R_h']),
+           'fixed_points': (vumps.vumps_fixed_points, ['lam1', 'Ac', 'C', 'A_L', 'A_R', 'Lw', 'Rw'], ['Lw', 'Rw'])}
+
+def align_gauge(A_ref, A):
+    '''
+    Gauge transformation of A_L into the gauge of A_ref
+    The dominant eigenvector of X -> sum_s A_ref^dagger X A is X = lam U with A_ref ~ U A U^dagger
+    :return: U A U^dagger (times the phase of lam), fidelity per site |lam|
+    '''
+    D = A.shape[0]
+    T = transfer.TransferOperator(A, A_ref)
+    lam, X = eigs(T.linear_operator(dtype=complex), k=1, which='LM', v0=np.eye(D, dtype=complex).reshape(-1))
+    U_X, _, V_dagger_X = linalg.svd(X.reshape(D, D))
+    U = U_X @ V_dagger_X
+    A_aligned = ncon([U, A, np.conj(U)],
+                     [[-1,1], [1,-2,2], [-3,2]])
+    return A_aligned * np.conj(lam[0]) / abs(lam[0]), abs(lam[0])
+
+def seed_state(solver, out, eta):
+    '''Initial state of the solver at the next point from the output out at the previous one'''
+    _, _, env_keys = SOLVERS[solver]
+    state = {key: out[key] for key in ['A_L', 'A_R', 'C', 'Ac'] + env_keys}
+    state.update(count=0, delta=eta*1000, e=0, e_memory=-1)
+    return state
+
+def continuation_sweep(get_operator, values, A, solver='mpo', eta=1e-8, extrapolate=False, adaptive=False,
+                       fidelity_tol=1e-4, max_substeps=4, min_steps=3):
+    '''
+    :param get_operator: function x -> W (mpo, fixed_points) or h (2sites)
+    :param values: grid of parameters, in the order of the sweep (all of them are computed)
+    :param A: initial uMPS for the first point (cold start)
+    :param solver: 'mpo', '2sites' or 'fixed_points'
+    :param extrapolate: linear extrapolation of A_L from the last two points, only where the
+                        last step had 1 - f < fidelity_tol (not across a critical point)
+    :param adaptive: put extra points between the grid points where 1 - f > fidelity_tol
+    :param max_substeps: at most max_substeps steps between two grid points
+    :param min_steps: minimal number of iterations of a seeded point (with 2 the stopping
+                      criterion of the solvers can stop before the state moved to the new point)
+    :return: structured array with fields 'x', 'e' (energy, or lam1 for fixed_points),
+    'steps' (VUMPS iterations), 'fidelity' (with the previous point, 1 for the first one) and
+    'grid' (False for the extra points), and the list of solver outputs (dicts)
+    '''
+    solve, keys, _ = SOLVERS[solver]
+    def get_energy(out):
+        return np.ravel(out['lam1'] if solver == 'fixed_points' else out['e'])[0]
+    values = list(values)
+    points, outputs = [], []
+    def run(x, A_init, seed, **kwargs):
+        steps = [0]
+        def count(i, delta, e):
+            steps[0] += 1
+        out = dict(zip(keys, solve(get_operator(x), A_init, eta=eta, resume_from=seed, callback=count, **kwargs)))
+        outputs.append(out)
+        return out, steps[0]
+    out, steps = run(values[0], A, None)
+    points.append((values[0], get_energy(out), steps, 1., True))
+    x_old, A_old = None, None
+    fidelity = 1.
+    h_max = None
+    for x_next in values[1:]:
+        x = points[-1][0]
+        h_grid = x_next - x
+        h = h_grid if h_max is None or not adaptive else np.sign(h_grid)*min(abs(h_max), abs(h_grid))
+        while x != x_next:
+            x_new = x_next if abs(x_next - x) <= abs(h)*(1 + 1e-8) else x + h
+            seed = seed_state(solver, out, eta)
+            if extrapolate and A_old is not None and 1 - fidelity < fidelity_tol:
+                A_prev, _ = align_gauge(out['A_L'], A_old)
+                A_guess = out['A_L'] + (out['A_L'] - A_prev) * (x_new - x) / (x - x_old)
+                seed['A_L'], seed['A_R'], seed['C'], seed['Ac'] = vumps.canonical_form(A_guess)
+                for key in SOLVERS[solver][2]:
+                    seed[key] = None
+            x_old, A_old = x, out['A_L']
+            out, steps = run(x_new, None, seed, min_steps=min_steps)
+            _, fidelity = align_gauge(out['A_L'], A_old)
+            points.append((x_new, get_energy(out), steps, fidelity, x_new == x_next))
+            if adaptive:
+                factor = np.sqrt(fidelity_tol / max(1 - fidelity, 1e-16))
+                h = (x_new - x) * min(max(factor, 0.25), 2.)
+                if abs(h) < abs(h_grid) / max_substeps:
+                    h = h_grid / max_substeps
+                h_max = h
+            x = x_new
+    dtype = [('x', float), ('e', complex), ('steps', int), ('fidelity', float), ('grid', bool)]
+    results = np.array(points, dtype=dtype)
+    return results, outputs
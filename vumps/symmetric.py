@@ -0,0 +1,728 @@
+import vumps
+import instrument
+import controller
+import pinv_manual
+import itertools
+from ncon_plan import compile_plan
+import numpy as np
+from scipy import linalg
+from scipy.sparse.linalg import eigs
+from scipy.sparse.linalg import eigsh
+from scipy.sparse.linalg import LinearOperator
+
+'''
+#################################################
+Block sparse tensors with Z2 or U(1) symmetry
+Every index of every leg carries a charge, every leg a flow (+1 in, -1 out), and only
+the blocks with  sum_legs flow*charge = total charge  (mod 2 for Z2) are stored.
+Contractions are done block by block (only pairs of blocks with equal charges on the
+contracted legs), so the exactly zero blocks of a dense symmetric tensor cost nothing.
+Flows of the VUMPS tensors (same index order as vumps.py):
+   A, A_L, Ac (+1,+1,-1)   A_R (-1,+1,+1)   C (+1,-1)   W (+1,-1,-1,+1)
+   L_W (+1,-1,-1)          R_W (-1,+1,+1)
+so the total charge of A is the charge per site (0 for the ground state) and a
+quasiparticle B = V_L X carries the charge of its sector.
+The charges of the bonds are fixed by the initial state (sorted, see leg_charges),
+e.g. U(1) with charges 2S^z: {-4: 4, -2: 12, 0: 16, 2: 12, 4: 4} for D = 48.
+A single site uMPS with odd charges only (spin-1/2 and U(1)) is not injective, so
+block two sites: constants.Model('XXZ', 2).get_symmetric_W('U1', block=2).
+Usage:
+W = constants.Model('XXZ', 2, delta=1.).get_symmetric_W('U1', block=2)
+A = symmetric.random_state(symmetric.leg_charges({-2: 6, 0: 8, 2: 6}), W.charges[2], 'U1')
+e, Ac, C, A_L, A_R, L_W, R_W = symmetric.vumps_mpo_symmetric(W, A)
+omega, X = symmetric.quasiparticle_mpo_symmetric(W, p, A_L, A_R, L_W, R_W, sector=2)
+#################################################
+'''
+def leg_charges(dims):
+    ''':param dims: dict charge -> number of states. :return: sorted array of the charges of the indices'''
+    return np.concatenate([np.full(dims[q], q, dtype=int) for q in sorted(dims)])
+
+def leg_sectors(charges):
+    ''':return: dict charge -> indices with this charge'''
+    return {int(q): np.flatnonzero(charges == q) for q in np.unique(charges)}
+
+class BlockTensor:
+    def __init__(self, charges, flows, blocks=None, symmetry='U1', charge=0):
+        '''
+        :param charges: list of arrays, the charge of every index of every leg
+        :param flows: +1 or -1 for every leg
+        :param blocks: dict (charge of every leg) -> dense block
+        :param symmetry: 'Z2' or 'U1'
+        :param charge: total charge of the tensor
+        '''
+        self.symmetry = symmetry
+        self.charges = [np.asarray(c, dtype=int) for c in charges]
+        self.flows = tuple(flows)
+        self.sectors = [leg_sectors(c) for c in self.charges]
+        self.charge = self.fuse(charge)
+        self.blocks = {} if blocks is None else blocks
+        self._keys = None
+
+    def fuse(self, q):
+        return int(q) % 2 if self.symmetry == 'Z2' else int(q)
+
+    @property
+    def ndim(self):
+        return len(self.charges)
+
+    @property
+    def shape(self):
+        return tuple(len(c) for c in self.charges)
+
+    @property
+    def dtype(self):
+        return np.result_type(*self.blocks.values()) if self.blocks else np.dtype(float)
+
+    def allowed_keys(self):
+        '''All charge combinations which conserve the total charge (in a fixed order)'''
+        if self._keys is None:
+            self._keys = [key for key in itertools.product(*[list(s) for s in self.sectors])
+                          if self.fuse(np.dot(self.flows, key)) == self.charge]
+        return self._keys
+
+    def block_shape(self, key):
+        return tuple(len(self.sectors[leg][q]) for leg, q in enumerate(key))
+
+    @property
+    def size(self):
+        '''Number of stored numbers (of all allowed blocks)'''
+        return int(sum(np.prod(self.block_shape(key)) for key in self.allowed_keys()))
+
+    def new(self, blocks, charge=None):
+        '''Tensor with the same legs and other blocks'''
+        return BlockTensor(self.charges, self.flows, blocks, self.symmetry, self.charge if charge is None else charge)
+
+    def same_legs(self, other):
+        return (self.flows == other.flows and self.charge == other.charge and
+                all(np.array_equal(a, b) for a, b in zip(self.charges, other.charges)))
+
+    def to_dense(self):
+        T = np.zeros(self.shape, dtype=self.dtype)
+        for key, block in self.blocks.items():
+            T[np.ix_(*[self.sectors[leg][q] for leg, q in enumerate(key)])] = block
+        return T
+
+    def to_vector(self, dtype=None):
+        '''All allowed blocks flattened and concatenated (missing blocks are zeros)'''
+        dtype = self.dtype if dtype is None else np.result_type(self.dtype, dtype)
+        v = np.zeros(self.size, dtype=dtype)
+        start = 0
+        for key in self.allowed_keys():
+            n = int(np.prod(self.block_shape(key)))
+            if key in self.blocks:
+                v[start:start+n] = self.blocks[key].reshape(-1)
+            start += n
+        return v
+
+    def from_vector(self, v):
+        '''Tensor with the legs of self and the blocks from the vector v (inverse of to_vector)'''
+        blocks = {}
+        start = 0
+        for key in self.allowed_keys():
+            shape = self.block_shape(key)
+            n = int(np.prod(shape))
+            blocks[key] = v[start:start+n].reshape(shape)
+            start += n
+        T = self.new(blocks)
+        T._keys = self._keys
+        return T
+
+    def conj(self):
+        return BlockTensor(self.charges, [-f for f in self.flows], {key: np.conj(b) for key, b in self.blocks.items()},
+                           self.symmetry, -self.charge)
+
+    def transpose(self, perm):
+        blocks = {tuple(key[i] for i in perm): b.transpose(perm) for key, b in self.blocks.items()}
+        return BlockTensor([self.charges[i] for i in perm], [self.flows[i] for i in perm], blocks,
+                           self.symmetry, self.charge)
+
+    def norm(self):
+        return np.sqrt(sum(linalg.norm(b)**2 for b in self.blocks.values()))
+
+    def item(self):
+        ''':return: the number of a tensor without legs'''
+        return self.blocks[()][()] if () in self.blocks else 0.
+
+    def __add__(self, other):
+        if not self.same_legs(other):
+            raise ValueError('tensors with different legs')
+        blocks = dict(self.blocks)
+        for key, b in other.blocks.items():
+            blocks[key] = blocks[key] + b if key in blocks else b
+        return self.new(blocks)
+
+    def __neg__(self):
+        return self.new({key: -b for key, b in self.blocks.items()})
+
+    def __sub__(self, other):
+        return self + (-other)
+
+    def __mul__(self, factor):
+        return self.new({key: factor*b for key, b in self.blocks.items()})
+    __rmul__ = __mul__
+
+    def __truediv__(self, factor):
+        return self * (1/factor)
+
+    def select(self, leg, index):
+        '''T[..., index, ...] with the leg removed (its charge goes into the total charge), zero blocks dropped'''
+        q = int(self.charges[leg][index])
+        position = int(np.flatnonzero(self.sectors[leg][q] == index)[0])
+        blocks = {}
+        for key, b in self.blocks.items():
+            if key[leg] == q:
+                b = b.take(position, axis=leg)
+                if np.any(b):
+                    blocks[key[:leg] + key[leg+1:]] = b
+        return BlockTensor(self.charges[:leg] + self.charges[leg+1:], self.flows[:leg] + self.flows[leg+1:],
+                           blocks, self.symmetry, self.charge - self.flows[leg]*q)
+
+    '''
+    Matrix decompositions: legs [0, n_left) are the rows, the others the columns.
+    The matrix is block diagonal in the fused charge of the rows.
+    '''
+    def fused_combos(self, legs):
+        ''':return: dict fused charge -> list of (charges of the legs, shape)'''
+        combos = {}
+        for key in itertools.product(*[list(self.sectors[leg]) for leg in legs]):
+            q = self.fuse(np.dot([self.flows[leg] for leg in legs], key))
+            shape = tuple(len(self.sectors[leg][k]) for leg, k in zip(legs, key))
+            combos.setdefault(q, []).append((key, shape))
+        return combos
+
+    def matrix_blocks(self, n_left):
+        ''':return: dict fused charge of the rows -> (matrix, row combos, column combos)'''
+        rows = self.fused_combos(range(n_left))
+        cols = self.fused_combos(range(n_left, self.ndim))
+        matrices = {}
+        for q, row in rows.items():
+            col = cols.get(self.fuse(self.charge - q), [])
+            m = sum(int(np.prod(s)) for _, s in row)
+            n = sum(int(np.prod(s)) for _, s in col)
+            M = np.zeros([m, n], dtype=self.dtype)
+            i = 0
+            for key_r, shape_r in row:
+                m_r = int(np.prod(shape_r))
+                j = 0
+                for key_c, shape_c in col:
+                    n_c = int(np.prod(shape_c))
+                    b = self.blocks.get(key_r + key_c)
+                    if b is not None:
+                        M[i:i+m_r, j:j+n_c] = b.reshape(m_r, n_c)
+                    j += n_c
+                i += m_r
+            matrices[q] = (M, row, col)
+        return matrices
+
+    def split_rows(self, M, row, key_c, n_new):
+        '''Blocks of the columns key_c (n_new columns) of the matrix M with the row combos row'''
+        blocks = {}
+        i = 0
+        for key_r, shape_r in row:
+            m_r = int(np.prod(shape_r))
+            blocks[key_r + key_c] = M[i:i+m_r].reshape(shape_r + n_new)
+            i += m_r
+        return blocks
+
+    def polar(self, n_left):
+        '''Polar factor U of every block (vumps.polar_factor), same legs as self'''
+        blocks = {}
+        for q, (M, row, col) in self.matrix_blocks(n_left).items():
+            if M.size == 0:
+                continue
+            if M.shape[0] >= M.shape[1]:
+                U = vumps.polar_factor(M)
+            else:
+                U_M, _, V_dagger_M = linalg.svd(M, full_matrices=False)
+                U = U_M @ V_dagger_M
+            j = 0
+            for key_c, shape_c in col:
+                n_c = int(np.prod(shape_c))
+                blocks.update(self.split_rows(U[:, j:j+n_c], row, key_c, shape_c))
+                j += n_c
+        return self.new(blocks)
+
+    def qr(self, n_left=2):
+        '''
+        Q R with positive diagonal of R (vumps.qr_positive) for one column leg,
+        the new leg of Q and R has the charges (and flow) of the column leg
+        :return: Q (total charge of self), R (total charge 0)
+        '''
+        if self.ndim - n_left != 1:
+            raise ValueError('qr needs exactly one column leg')
+        f = self.flows[-1]
+        Q_blocks, R_blocks = {}, {}
+        for q, (M, row, col) in self.matrix_blocks(n_left).items():
+            if M.shape[1] == 0:
+                continue
+            if M.shape[0] < M.shape[1]:
+                raise ValueError('sector %d of the bond has %d states, but only %d can be reached'
+                                 % (col[0][0][0], M.shape[1], M.shape[0]))
+            Q_q, R_q = vumps.qr_positive(M)
+            key_c = col[0][0]
+            Q_blocks.update(self.split_rows(Q_q, row, key_c, (M.shape[1],)))
+            R_blocks[key_c + key_c] = R_q
+        Q = self.new(Q_blocks)
+        R = BlockTensor([self.charges[-1]]*2, (-f, f), R_blocks, self.symmetry, 0)
+        return Q, R
+
+    def null_space(self, n_left=2):
+        '''
+        Orthonormal basis N of the complement of the columns, N^dagger self = 0,
+        legs: the row legs and a new leg (flow of the column leg), total charge 0
+        '''
+        if self.ndim - n_left != 1:
+            raise ValueError('null_space needs exactly one column leg')
+        f = self.flows[-1]
+        null = {}
+        for q, (M, row, col) in self.matrix_blocks(n_left).items():
+            N_q = linalg.null_space(np.conj(M.T)) if M.shape[1] > 0 else np.eye(M.shape[0])
+            if N_q.shape[1] > 0:
+                null[self.fuse(-f*q)] = (N_q, row)
+        N = BlockTensor(self.charges[:n_left] + [leg_charges({q: N_q.shape[1] for q, (N_q, _) in null.items()})],
+                        self.flows, {}, self.symmetry, 0)
+        for q_new, (N_q, row) in null.items():
+            N.blocks.update(N.split_rows(N_q, row, (q_new,), (N_q.shape[1],)))
+        return N
+
+    def svd(self):
+        '''
+        SVD of a block diagonal matrix with square blocks (C of the canonical form)
+        :return: U, S (BlockTensor, diagonal blocks), V_dagger, all with the legs of self
+        '''
+        U, S, V_dagger = self.new({}), self.new({}), self.new({})
+        for key, b in self.blocks.items():
+            U_b, S_b, V_dagger_b = linalg.svd(b)
+            U.blocks[key], S.blocks[key], V_dagger.blocks[key] = U_b, np.diag(S_b), V_dagger_b
+        return U, S, V_dagger
+
+def zeros(charges, flows, symmetry='U1', charge=0, dtype=float):
+    T = BlockTensor(charges, flows, None, symmetry, charge)
+    T.blocks = {key: np.zeros(T.block_shape(key), dtype=dtype) for key in T.allowed_keys()}
+    return T
+
+def random(charges, flows, symmetry='U1', charge=0):
+    T = BlockTensor(charges, flows, None, symmetry, charge)
+    T.blocks = {key: np.random.rand(*T.block_shape(key)) for key in T.allowed_keys()}
+    return T
+
+def eye(charges, flows=(1, -1), symmetry='U1'):
+    T = BlockTensor([charges, charges], flows, None, symmetry, 0)
+    T.blocks = {(q, q): np.eye(len(idx)) for q, idx in T.sectors[0].items()}
+    return T
+
+def from_dense(T, charges, flows, symmetry='U1', charge=0, tol=1e-12):
+    '''
+    Blocks of the dense tensor T, blocks which are exactly zero are not stored
+    :param tol: raise ValueError if T has elements which violate the charge conservation
+    (relative to norm(T)), None for no check
+    '''
+    B = BlockTensor(charges, flows, None, symmetry, charge)
+    for key in B.allowed_keys():
+        block = T[np.ix_(*[B.sectors[leg][q] for leg, q in enumerate(key)])]
+        if np.any(block):
+            B.blocks[key] = block
+    if tol is not None and linalg.norm(B.to_dense() - T) > tol*max(linalg.norm(T), 1.):
+        raise ValueError('the tensor does not conserve the charges')
+    return B
+
+def stack(tensors, charges, flow, axis):
+    '''
+    Insert a new leg at axis, index n of the new leg is tensors[n] (all with the same legs)
+    :return: BlockTensor with total charge tensors[n].charge + flow*charges[n] (has to be the same for all n)
+    '''
+    first = tensors[0]
+    total = first.fuse(first.charge + flow*charges[0])
+    T = BlockTensor(first.charges[:axis] + [charges] + first.charges[axis:],
+                    first.flows[:axis] + (flow,) + first.flows[axis:], None, first.symmetry, total)
+    for key in T.allowed_keys():
+        key_t = key[:axis] + key[axis+1:]
+        idx = T.sectors[axis][key[axis]]
+        parts = [tensors[n].blocks.get(key_t) for n in idx]
+        if all(p is None for p in parts):
+            continue
+        shape = T.block_shape(key)
+        shape_t = shape[:axis] + shape[axis+1:]
+        T.blocks[key] = np.stack([np.zeros(shape_t) if p is None else p for p in parts], axis=axis)
+    return T
+
+def tensordot(A, B, axes):
+    '''Block by block tensordot, the contracted legs need equal charges and opposite flows'''
+    axes_a, axes_b = axes
+    for a, b in zip(axes_a, axes_b):
+        if A.flows[a] != -B.flows[b] or not np.array_equal(A.charges[a], B.charges[b]):
+            raise ValueError('legs %d and %d do not match' % (a, b))
+    free_a = [i for i in range(A.ndim) if i not in axes_a]
+    free_b = [i for i in range(B.ndim) if i not in axes_b]
+    groups = {}
+    for key_b, block_b in B.blocks.items():
+        groups.setdefault(tuple(key_b[i] for i in axes_b), []).append((key_b, block_b))
+    blocks = {}
+    for key_a, block_a in A.blocks.items():
+        for key_b, block_b in groups.get(tuple(key_a[i] for i in axes_a), []):
+            key = tuple(key_a[i] for i in free_a) + tuple(key_b[i] for i in free_b)
+            C = np.tensordot(block_a, block_b, (axes_a, axes_b))
+            blocks[key] = blocks[key] + C if key in blocks else C
+    return BlockTensor([A.charges[i] for i in free_a] + [B.charges[i] for i in free_b],
+                       [A.flows[i] for i in free_a] + [B.flows[i] for i in free_b],
+                       blocks, A.symmetry, A.charge + B.charge)
+
+_plans = {}
+def ncon(tensors, connects):
+    '''ncon for BlockTensors, with the contraction order of ncon_plan (cached per network and shape)'''
+    key = (tuple(map(tuple, connects)), tuple(t.shape for t in tensors))
+    plan = _plans.get(key)
+    if plan is None:
+        plan = _plans[key] = compile_plan(connects, key[1])
+        if plan is None:
+            raise ValueError('traces are not supported')
+    steps, perm = plan
+    L = list(tensors)
+    for a, b, axes_a, axes_b in steps:
+        new_A = tensordot(L[a], L[b], (axes_a, axes_b))
+        del L[b]
+        del L[a]
+        L.append(new_A)
+    return L[0] if perm is None else L[0].transpose(perm)
+
+'''
+##########################################################
+Symmetric MPO
+The charges of the MPO legs follow from the nonzero W[a,b]:
+W[a,b][s,t] != 0 needs charge[a] = charge[b] + q_s - q_t
+##########################################################
+'''
+def mpo_from_dense(W, phys_charges, symmetry='U1'):
+    '''
+    :param W: dense MPO (d_w, d_w, d, d)
+    :param phys_charges: charges of the physical indices
+    :return: BlockTensor W, raises ValueError if W does not conserve the charges
+    '''
+    d_w = W.shape[0]
+    phys_charges = np.asarray(phys_charges)
+    w_charges = [0] + [None]*(d_w-1)
+    changed = True
+    while changed:
+        changed = False
+        for a in range(d_w):
+            for b in range(d_w):
+                if not np.any(W[a, b]):
+                    continue
+                s, t = np.unravel_index(np.argmax(abs(W[a, b])), W[a, b].shape)
+                if w_charges[b] is not None and w_charges[a] is None:
+                    w_charges[a] = w_charges[b] + phys_charges[s] - phys_charges[t]
+                    changed = True
+                elif w_charges[a] is not None and w_charges[b] is None:
+                    w_charges[b] = w_charges[a] - phys_charges[s] + phys_charges[t]
+                    changed = True
+    w_charges = np.array([0 if q is None else q for q in w_charges])
+    if symmetry == 'Z2':
+        w_charges, phys_charges = w_charges % 2, phys_charges % 2
+    return from_dense(W, [w_charges, w_charges, phys_charges, phys_charges], (1, -1, -1, 1), symmetry)
+
+def random_state(bond_charges, phys_charges, symmetry='U1', charge=0):
+    ''':param bond_charges: sorted charges of the bond (leg_charges)'''
+    return random([bond_charges, phys_charges, bond_charges], (1, 1, -1), symmetry, charge)
+
+class BlockTransfer:
+    def __init__(self, ket, bra=None, W=None, O=None, factor=1., charge=0):
+        '''
+        Transfer matrix of BlockTensors, same conventions as transfer.TransferOperator.
+        apply/apply_transpose act on flat vectors (to_vector of the vector tensor of
+        total charge `charge`), so pinv_manual.TransferSolver and eigs can be used,
+        apply_block on BlockTensors (also with a charged O).
+        '''
+        self.ket = ket
+        self.bra = ket if bra is None else bra
+        self.bra_conj = self.bra.conj()
+        self.W = W
+        self.O = O
+        self.factor = factor
+        charges = [self.bra.charges[0]] + ([W.charges[0]] if W is not None else []) + [ket.charges[0]]
+        flows = [self.bra.flows[0]] + ([-W.flows[0]] if W is not None else []) + [-ket.flows[0]]
+        self.template = BlockTensor(charges, flows, None, ket.symmetry, charge)
+        self.template_T = BlockTensor(charges, [-f for f in flows], None, ket.symmetry, -charge)
+        self.size = self.template.size
+        self.vshape = (self.size,)
+        self.shape = (self.size, self.size)
+        tensors = [ket, self.bra] + [t for t in (W, O) if t is not None]
+        self.dtype = np.result_type(*[t.dtype for t in tensors], np.asarray(factor))
+
+    def __mul__(self, factor):
+        return BlockTransfer(self.ket, self.bra, self.W, self.O, self.factor*factor, self.template.charge)
+    __rmul__ = __mul__
+
+    def apply_block(self, x):
+        if self.W is not None:
+            y = ncon([x, self.bra_conj, self.W, self.ket],
+                     [[1,2,3], [1,5,-1], [2,-2,4,5], [3,4,-3]])
+        elif self.O is not None:
+            y = ncon([x, self.ket, self.O, self.bra_conj],
+                     [[1,2], [2,3,-2], [3,4], [1,4,-1]])
+        else:
+            y = ncon([x, self.ket, self.bra_conj],
+                     [[1,2], [2,3,-2], [1,3,-1]])
+        return self.factor*y
+
+    def apply_transpose_block(self, x):
+        if self.W is not None:
+            y = ncon([x, self.bra_conj, self.W, self.ket],
+                     [[1,2,3], [-1,5,1], [-2,2,4,5], [-3,4,3]])
+        else:
+            y = ncon([x, self.ket, self.bra_conj],
+                     [[1,2], [-2,3,2], [-1,3,1]])
+        return self.factor*y
+
+    def apply(self, v):
+        return self.apply_block(self.template.from_vector(v.reshape(-1))).to_vector(v.dtype)
+
+    def apply_transpose(self, v):
+        return self.apply_transpose_block(self.template_T.from_vector(v.reshape(-1))).to_vector(v.dtype)
+
+    def linear_operator(self, transpose=False, dtype=None):
+        apply = self.apply_transpose if transpose else self.apply
+        dtype = self.dtype if dtype is None else np.result_type(self.dtype, dtype)
+        return LinearOperator(self.shape, matvec=apply, dtype=dtype)
+
+    def dense(self):
+        '''Explicit (size x size) matrix of the map in the sector of the vectors'''
+        eye = np.eye(self.size, dtype=self.dtype)
+        return np.stack([self.apply(eye[i]) for i in range(self.size)], axis=1)
+
+'''
+##########################################################
+Canonical form and min_Ac_C block by block
+##########################################################
+'''
+def left_orth(A, eta=1e-12, maxiter=100):
+    '''vumps.left_orth_arnoldi for BlockTensors, :return: A_L, L, delta'''
+    L = eye(A.charges[0], (A.flows[0], -A.flows[0]), A.symmetry)
+    L = L / L.norm()
+    delta = 1.
+    for i in range(maxiter):
+        LA = ncon([L, A],
+                  [[-1,1], [1,-2,-3]])
+        A_L, L_new = LA.qr(2)
+        L_new = L_new / L_new.norm()
+        delta = (L_new - L).norm()
+        L = L_new
+        if delta < eta:
+            break
+        T = BlockTransfer(A, A_L)
+        if T.size > 2:
+            dtype = np.result_type(T.dtype, L.dtype)
+            _, X = eigs(T.linear_operator(dtype=dtype), k=1, which='LM', v0=L.to_vector(dtype), tol=delta/10)
+            X = X[:, 0]
+            X = X * abs(X[np.argmax(abs(X))]) / X[np.argmax(abs(X))]
+            if A.dtype.kind != 'c' and L.dtype.kind != 'c':
+                X = X.real
+            _, L = T.template.from_vector(X).qr(1)
+            L = L / L.norm()
+    return A_L, L, delta
+
+def canonical_form(A, eta=1e-12, maxiter=100):
+    ''':return: A_L, A_R, C, Ac (vumps.canonical_form, C diagonal in every sector)'''
+    A_L, _, _ = left_orth(A, eta, maxiter)
+    A_R, C_r, _ = left_orth(A_L.transpose([2,1,0]), eta, maxiter)
+    C = C_r.transpose([1,0])
+    U, S, V_dagger = C.svd()
+    A_L = ncon([U.conj().transpose([1,0]), A_L, U],
+               [[-1,1], [1,-2,2], [2,-3]])
+    A_R = ncon([V_dagger, A_R, V_dagger.conj().transpose([1,0])],
+               [[-3,1], [2,-2,1], [2,-1]])
+    C = S / S.norm()
+    Ac = ncon([A_L, C],
+              [[-1,-2,1], [1,-3]])
+    return A_L, A_R, C, Ac
+
+def min_Ac_C(Ac, C):
+    ''':return: A_L, A_R, delta (vumps.min_Ac_C with polar factors of every block)'''
+    U_C_conj = C.polar(1).conj()
+    A_L = ncon([Ac.polar(2), U_C_conj],
+               [[-1,-2,1], [-3,1]])
+    A_R = ncon([Ac.transpose([2,1,0]).polar(2), U_C_conj],
+               [[-1,-2,1], [1,-3]])
+    delta = (Ac - ncon([A_L, C], [[-1,-2,1], [1,-3]])).norm()
+    return A_L, A_R, delta
+
+'''
+##########################################################
+Environments (vumps.get_Lh_Rh_mpo), a component W[j,i] which is zero is skipped
+##########################################################
+'''
+def get_Lh_Rh_mpo(A_L, A_R, C, W, tol=1e-8):
+    d_w = W.shape[0]
+    components = {}
+    for a in range(d_w):
+        W_a = W.select(0, a)
+        for b in range(d_w):
+            O = W_a.select(0, b)
+            if O.blocks:
+                components[a, b] = O
+    L_W = [None]*d_w
+    L_W[d_w-1] = eye(A_L.charges[0], (1, -1), W.symmetry)
+    for i in range(d_w-2, -1, -1):
+        for j in range(i+1, d_w):
+            if (j, i) in components and L_W[j] is not None:
+                y = BlockTransfer(A_L, O=components[j, i]).apply_block(L_W[j])
+                L_W[i] = y if L_W[i] is None else L_W[i] + y
+    C_r = C.transpose([1,0])
+    R = ncon([C_r.conj(), C_r],
+             [[1,-1], [1,-2]])
+    e_Lw = ncon([R, L_W[0]],
+                [[1,2], [1,2]]).item()
+    T_L = BlockTransfer(A_L)
+    x = L_W[0] - e_Lw*L_W[d_w-1]
+    y = pinv_manual.TransferSolver(T_L, R.to_vector(), L_W[d_w-1].to_vector(), tol=tol).solve(x.to_vector())
+    L_W[0] = T_L.template.from_vector(y)
+
+    R_W = [None]*d_w
+    R_W[0] = eye(A_R.charges[0], (-1, 1), W.symmetry)
+    for i in range(1, d_w):
+        for j in range(i-1, -1, -1):
+            if (i, j) in components and R_W[j] is not None:
+                y = BlockTransfer(A_R, O=components[i, j]).apply_block(R_W[j])
+                R_W[i] = y if R_W[i] is None else R_W[i] + y
+    L = ncon([C.conj(), C],
+             [[1,-1], [1,-2]])
+    e_Rw = ncon([L, R_W[d_w-1]],
+                [[1,2], [1,2]]).item()
+    T_R = BlockTransfer(A_R)
+    x = R_W[d_w-1] - e_Rw*R_W[0]
+    y = pinv_manual.TransferSolver(T_R, L.to_vector(), R_W[0].to_vector(), tol=tol).solve(x.to_vector())
+    R_W[d_w-1] = T_R.template.from_vector(y)
+    L_W = [BlockTensor([A_L.charges[0]]*2, (1, -1), {}, W.symmetry, W.charges[0][i]) if x is None else x
+           for i, x in enumerate(L_W)]
+    R_W = [BlockTensor([A_R.charges[0]]*2, (-1, 1), {}, W.symmetry, -W.charges[0][i]) if x is None else x
+           for i, x in enumerate(R_W)]
+    L_W = stack(L_W, W.charges[0], -W.flows[0], 1)
+    R_W = stack(R_W, W.charges[1], -W.flows[1], 1)
+    return L_W, R_W, (e_Lw+e_Rw)/2
+
+'''
+##############################################################
+MPO VUMPS with BlockTensors
+##############################################################
+'''
+def vumps_mpo_symmetric(W, A, eta=1e-8, min_steps=0, callback=None, tracer=None, control=None):
+    '''
+    :param W: BlockTensor MPO (mpo_from_dense or constants.Model.get_symmetric_W)
+    :param A: initial BlockTensor state (random_state), its charges fix the sectors of the bond
+    :param min_steps: minimal number of iterations
+    :param callback: called as callback(count, delta, e) after every iteration
+    :param tracer: instrument.Tracer which records every iteration (default: print every 5 steps)
+    :param control: controller.Controller of the tolerances and the stopping criterion (default: Controller(eta))
+    :return: e, Ac, C, A_L, A_R, L_W, R_W (BlockTensors)
+    '''
+    print('>'*100)
+    print('VUMPS for MPO with %s symmetry begin!' % W.symmetry)
+    tracer = instrument.Tracer() if tracer is None else tracer
+    tracer.begin('vumps_mpo_symmetric')
+    control = controller.Controller(eta) if control is None else control
+    control.reset()
+    def map_Hac(v):
+        Ac = Ac_template.from_vector(v)
+        Ac_new = ncon([L_W, Ac, W, R_W],
+                      [[-1,3,1], [1,5,2], [3,4,5,-2], [-3,4,2]])
+        return Ac_new.to_vector(v.dtype)
+    def map_Hc(v):
+        C = C_template.from_vector(v)
+        C_new = ncon([L_W, C, R_W],
+                     [[-1,3,1], [1,2], [-2,3,2]])
+        return C_new.to_vector(v.dtype)
+    A_L, A_R, C, Ac = canonical_form(A)
+    Ac_template, C_template = Ac.new({}), C.new({})
+    print('D = ', A.shape[0], 'stored elements of A: ', Ac_template.size, 'of', int(np.prod(A.shape)))
+    delta = eta * 1000
+    e = 0
+    count = 0
+    while not control.converged() or count < min_steps:
+        eig_tol = control.eig_tol()
+        with tracer.stage('environments'):
+            L_W, R_W, energy = get_Lh_Rh_mpo(A_L, A_R, C, W, tol=control.env_tol())
+        with tracer.stage('eig_Ac'):
+            E_Ac, v_Ac = vumps.arpack_eigenpair(eigs, LinearOperator((Ac_template.size,)*2, dtype=complex,
+                                                matvec=tracer.counted('matvecs_Ac', control.counted('Ac', map_Hac))),
+                                                which='SR', v0=Ac.to_vector(complex), tol=eig_tol,
+                                                **control.krylov('Ac', Ac_template.size))
+        Ac = Ac_template.from_vector(v_Ac[:, 0])
+        with tracer.stage('eig_C'):
+            E_C, v_C = vumps.arpack_eigenpair(eigs, LinearOperator((C_template.size,)*2, dtype=complex,
+                                              matvec=tracer.counted('matvecs_C', control.counted('C', map_Hc))),
+                                              which='SR', v0=C.to_vector(complex), tol=eig_tol,
+                                              **control.krylov('C', C_template.size))
+        C = C_template.from_vector(v_C[:, 0])
+        with tracer.stage('residuals'):
+            residuals = {'residual_Ac': vumps.eig_residual(map_Hac, E_Ac, v_Ac),
+                         'residual_C': vumps.eig_residual(map_Hc, E_C, v_C)}
+        e = energy
+        with tracer.stage('gauge'):
+            A_L, A_R, delta = min_Ac_C(Ac, C)
+        control.update(delta, e, residuals.values())
+        tracer.end_iteration(count, energy=e, delta=delta, E_Ac=E_Ac, E_C=E_C, eig_tol=eig_tol, **residuals)
+        count += 1
+        if callback is not None:
+            callback(count, delta, e)
+    L_W, R_W, e = get_Lh_Rh_mpo(A_L, A_R, C, W) ## the environments of the returned state (for the excitations)
+    print(50 * '-' + ' final ' + 50 * '-')
+    print('delta = ', delta)
+    print('energy = ', e)
+    return e, Ac, C, A_L, A_R, L_W, R_W
+
+'''
+##############################################################
+Quasiparticle excitations in a charge sector
+B = V_L X has total charge `sector`. For sector 0 the MPO transfer matrices have
+Jordan blocks at eigenvalue 1, as in vumps.quasiparticle_mpo the pseudo inverses are
+taken of the dense matrices, but only in the (much smaller) space of the sector.
+For sector != 0 there is no eigenvalue 1 in the space of L_B and R_B, and the
+equations are solved with lgmres (pinv_manual.TransferSolver without projector).
+##############################################################
+'''
+def quasiparticle_mpo_symmetric(W, p, A_L, A_R, L_W, R_W, sector=0, num_of_excite=1, tol=1e-6):
+    '''
+    :param p: momentum
+    :param sector: total charge of the excitation
+    :param tol: tolerance of eigsh (the lgmres solves of sector != 0 use tol/100)
+    :return: omega (num_of_excite lowest), X of the lowest one (BlockTensor)
+    '''
+    V_L = A_L.null_space(2)
+    X_template = zeros([V_L.charges[2], A_L.charges[2]], (-V_L.flows[2], A_L.flows[2]), W.symmetry, sector)
+    if X_template.size == 0:
+        raise ValueError('no states in sector %d' % sector)
+    W_r = W.transpose([1,0,2,3])
+    T_RL = BlockTransfer(A_R.transpose([2,1,0]), A_L, W=W, charge=sector) * np.exp(-1j*p)
+    T_LR = BlockTransfer(A_L.transpose([2,1,0]), A_R, W=W_r, charge=sector) * np.exp(1j*p)
+    if sector == 0:
+        inv_T_RL = linalg.pinv(np.eye(T_RL.size) - T_RL.dense())
+        inv_T_LR = linalg.pinv(np.eye(T_LR.size) - T_LR.dense())
+        solve_L = lambda x: inv_T_RL @ x
+        solve_R = lambda x: inv_T_LR @ x
+    else:
+        solve_L = pinv_manual.TransferSolver(T_RL, tol=tol/100).solve
+        solve_R = pinv_manual.TransferSolver(T_LR, tol=tol/100).solve
+    A_L_conj, A_R_conj = A_L.conj(), A_R.conj()
+    V_L_conj = V_L.conj()
+    def map_effective_H(v):
+        X = X_template.from_vector(v)
+        B = ncon([V_L, X],
+                 [[-1,-2,1], [1,-3]])
+        LBWA_L = ncon([L_W, B, W, A_L_conj],
+                      [[1,2,3], [3,5,-3], [2,-2,5,4], [1,4,-1]])
+        RBWA_R = ncon([R_W, B, W, A_R_conj],
+                      [[1,2,3], [-3,5,3], [-2,2,5,4], [1,4,-1]])
+        L_B = T_RL.template.from_vector(solve_L(LBWA_L.to_vector(complex)))
+        R_B = T_LR.template.from_vector(solve_R(RBWA_R.to_vector(complex)))
+        term1 = np.exp(-1j*p)*ncon([L_B, A_R, W, R_W],
+                                   [[-1,1,2], [4,5,2], [1,3,5,-2], [-3,3,4]])
+        term2 = np.exp(1j*p)*ncon([L_W, A_L, W, R_B],
+                                  [[-1,1,2], [2,5,4], [1,3,5,-2], [-3,3,4]])
+        term3 = ncon([L_W, B, W, R_W],
+                     [[-1,1,2], [2,5,4], [1,3,5,-2], [-3,3,4]])
+        Teff_X = ncon([term1 + term2 + term3, V_L_conj],
+                      [[1,2,-2], [1,2,-1]])
+        return Teff_X.to_vector(complex)
+    k = min(num_of_excite, X_template.size - 1)
+    omega, X = eigsh(LinearOperator((X_template.size,)*2, matvec=map_effective_H, dtype=complex), k=k,
+                     which='SA', tol=tol)
+    return omega, X_template.from_vector(X[:, 0])
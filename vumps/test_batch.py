@@ -0,0 +1,38 @@
+import json
+import numpy as np
+import batch
+import pinv_manual
+
+## the workers are forked, so they see the solve_job patched in the parent
+
+def flaky_solve_job(job, seed):
+    ''':raise RuntimeError: in the first attempt, like a non converged lgmres'''
+    if seed == job['seed']:
+        raise RuntimeError('lgmres did not converge (info = 100)')
+    return {'e': -1., 'e_imag': 0., 'e_exact': None, 'delta_vumps': 1e-9, 'steps': 1}, {'C': np.eye(2)}
+
+def failing_solve_job(job, seed):
+    raise RuntimeError('lgmres did not converge (info = 100)')
+
+def test_failed_job_is_retried(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'solve_job', flaky_solve_job)
+    results = batch.run_batch([{'D': 2}, {'D': 3}], str(tmp_path), workers=2, start_method='fork')
+    assert all(result['status'] == 'done' and result['attempts'] == 2 for result in results.values())
+    assert all((tmp_path / 'states' / job_id).is_dir() for job_id in results)
+
+def test_failing_job_does_not_abort_the_batch(tmp_path, monkeypatch):
+    monkeypatch.setattr(batch, 'solve_job', failing_solve_job)
+    results = batch.run_batch([{'D': 2}, {'D': 3}], str(tmp_path), workers=2, retries=1, start_method='fork')
+    assert all(result['status'] == 'failed' and result['attempts'] == 2 for result in results.values())
+    with open(tmp_path / 'results.jsonl') as f:
+        assert len([json.loads(line) for line in f]) == 2
+    monkeypatch.setattr(batch, 'solve_job', flaky_solve_job)
+    results = batch.run_batch([{'D': 2}, {'D': 3}], str(tmp_path), workers=2, start_method='fork')
+    assert all(result['status'] == 'done' for result in results.values())
+
+def test_lgmres_failure_is_a_failed_job(tmp_path, monkeypatch):
+    monkeypatch.setattr(pinv_manual, 'lgmres', lambda A, b, **kwargs: (b, 1))
+    results = batch.run_batch([{'D': 2}], str(tmp_path), workers=1, retries=1, start_method='fork')
+    result, = results.values()
+    assert result['status'] == 'failed' and result['attempts'] == 2
+    assert result['error'].startswith('RuntimeError: lgmres did not converge')
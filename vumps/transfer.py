@@ -0,0 +1,136 @@
+from ncon_plan import ncon
+import numpy as np
+from scipy.sparse.linalg import LinearOperator
+
+'''
+#################################################
+Matrix-free transfer matrices
+Instead of storing the D^4 (or D^4 d_w^2) transfer tensor, the map is applied to
+a vector by contracting bra, (O or W) and ket one after another, which costs O(D^3).
+All tensors are given in the "left-to-right" orientation:
+
+   0--ket--2         ---      ---                              ---
+      |              |        |                                |
+      1         0--W--1 or O   x--(1)    with x = x[bra,(w),ket]  y = T|x>
+      |              |        |                                |
+   0--bra--2         ---      ---                              ---
+
+  W: 0--W--1, ket physical leg 2, bra physical leg 3 (same as vumps.py)
+  O: O[ket physical, bra physical]
+So for A_R (2--A_R--0) pass A_R.transpose([2,1,0]) to go from left to right,
+or A_R itself to go from right to left.
+#################################################
+'''
+class TransferOperator:
+    def __init__(self, ket, bra=None, W=None, O=None, factor=1.):
+        '''
+        :param ket: tensor of the upper layer
+        :param bra: tensor of the lower layer (complex conjugated in the contraction), default is ket
+        :param W: optional MPO tensor between the layers
+        :param O: optional one-site operator between the layers
+        :param factor: scalar multiplying the whole map, e.g. the momentum phase
+        '''
+        self.ket = ket
+        self.bra = ket if bra is None else bra
+        self.bra_conj = np.conj(self.bra)
+        self.W = W
+        self.O = O
+        self.factor = factor
+        D_bra, D_ket = self.bra.shape[2], ket.shape[2]
+        if W is None:
+            self.vshape = (D_bra, D_ket)
+        else:
+            self.vshape = (D_bra, W.shape[1], D_ket)
+        self.size = int(np.prod(self.vshape))
+        self.shape = (self.size, self.size)
+        tensors = [ket, self.bra] + [t for t in (W, O) if t is not None] + [np.asarray(factor)]
+        self.dtype = np.result_type(*tensors)
+
+    def __mul__(self, factor):
+        return TransferOperator(self.ket, self.bra, self.W, self.O, self.factor*factor)
+    __rmul__ = __mul__
+
+    def apply(self, x):
+        '''y = T|x>, x has shape vshape (or flattened), y has shape vshape'''
+        x = x.reshape(self.vshape)
+        if self.W is not None:
+            y = ncon([x, self.bra_conj, self.W, self.ket],
+                     [[1,2,3], [1,5,-1], [2,-2,4,5], [3,4,-3]])
+        elif self.O is not None:
+            y = ncon([x, self.ket, self.O, self.bra_conj],
+                     [[1,2], [2,3,-2], [3,4], [1,4,-1]])
+        else:
+            y = ncon([x, self.ket, self.bra_conj],
+                     [[1,2], [2,3,-2], [1,3,-1]])
+        return self.factor*y
+
+    def apply_transpose(self, x):
+        '''y = <x|T (no complex conjugation), i.e. the map from the other side'''
+        x = x.reshape(self.vshape)
+        if self.W is not None:
+            y = ncon([x, self.bra_conj, self.W, self.ket],
+                     [[1,2,3], [-1,5,1], [-2,2,4,5], [-3,4,3]])
+        elif self.O is not None:
+            y = ncon([x, self.ket, self.O, self.bra_conj],
+                     [[1,2], [-2,3,2], [3,4], [-1,4,1]])
+        else:
+            y = ncon([x, self.ket, self.bra_conj],
+                     [[1,2], [-2,3,2], [-1,3,1]])
+        return self.factor*y
+
+    def linear_operator(self, transpose=False, dtype=None):
+        '''
+        :param dtype: dtype of the LinearOperator, e.g. complex for a complex v0 with a real map
+        '''
+        apply = self.apply_transpose if transpose else self.apply
+        dtype = self.dtype if dtype is None else np.result_type(self.dtype, dtype)
+        return LinearOperator(self.shape, matvec=lambda x: apply(x).reshape(-1), dtype=dtype)
+
+    def dense(self):
+        '''
+        Explicit (size x size) matrix of the map, only for small D (e.g. for linalg.pinv)
+        '''
+        if self.W is not None:
+            T = ncon([self.ket, self.W, self.bra_conj],
+                     [[-6,1,-3], [-5,-2,1,2], [-4,2,-1]])
+        elif self.O is not None:
+            T = ncon([self.ket, self.O, self.bra_conj],
+                     [[-4,1,-2], [1,2], [-3,2,-1]])
+        else:
+            T = ncon([self.ket, self.bra_conj],
+                     [[-4,1,-2], [-3,1,-1]])
+        return self.factor*T.reshape(self.shape)
+
+class TransferProduct(TransferOperator):
+    def __init__(self, operators, factor=1.):
+        '''
+        Transfer matrix of a unit cell, x -> T_{N-1}(...T_1(T_0(x)))
+        :param operators: list of TransferOperator (site 0 first, in the direction of the map)
+        :param factor: scalar multiplying the whole map
+        '''
+        self.operators = operators
+        self.factor = factor
+        self.vshape = operators[0].vshape
+        self.size = int(np.prod(self.vshape))
+        self.shape = (self.size, self.size)
+        self.dtype = np.result_type(*[T.dtype for T in operators], np.asarray(factor))
+
+    def __mul__(self, factor):
+        return TransferProduct(self.operators, self.factor*factor)
+    __rmul__ = __mul__
+
+    def apply(self, x):
+        for T in self.operators:
+            x = T.apply(x)
+        return self.factor*x
+
+    def apply_transpose(self, x):
+        for T in reversed(self.operators):
+            x = T.apply_transpose(x)
+        return self.factor*x
+
+    def dense(self):
+        T = np.eye(self.size)
+        for T_k in self.operators:
+            T = T_k.dense() @ T
+        return self.factor*T
@@ -0,0 +1,375 @@
+import vumps
+import transfer
+import pinv_manual
+import krylov
+import parallel
+import mpo
+import instrument
+import controller
+from ncon_plan import ncon
+import numpy as np
+from scipy import linalg
+from scipy.sparse.linalg import eigs
+from concurrent.futures import ThreadPoolExecutor
+
+'''
+#################################################
+VUMPS with an N site unit cell
+The state is given by one (A_L, A_R, Ac, C) per site, with C[k] on the bond right
+of site k and
+   A_L[k] C[k] = Ac[k] = C[k-1] A_R[k]   (k-1 mod N)
+so dimerized, antiferromagnetic or stripe orders do not need blocked sites with
+d^N physical dimension. All bonds have the same D.
+Environments: L_W[k] on the bond left of site k, R_W[k] on the bond right of site k,
+so Ac[k] sees (L_W[k], W[k], R_W[k]) and C[k] sees (L_W[k+1], R_W[k]). Around the cell
+the infinite sums are solved once with the product of the N transfer matrices, the
+other bonds follow by applying the single site transfer matrices.
+Given the environments, the 2N eigenproblems of Ac[k] and C[k] are independent, and
+so are the N gauge updates min_Ac_C(Ac[k], C[k], C[k-1]), so they run in a thread pool
+(as do the left and right environments). The eigensolves use krylov.arnoldi_eig,
+since eigs would serialize them on the ARPACK lock.
+Ref: Section IV in PRB 97, 045145 (2018)
+Usage:
+W_list = [W_a, W_b]                       (or one W for all sites)
+e, Ac, C, A_L, A_R, L_W, R_W = unit_cell.vumps_mpo_cell(W_list, [A, A])
+#################################################
+'''
+def cell_tensors(W, N):
+    ''':return: list of the N tensors of the cell, W is a list or one tensor for all sites'''
+    return list(W) if isinstance(W, (list, tuple)) else [W]*N
+
+def left_orth_cell(A, L0, eta=1e-12, maxiter=100):
+    '''
+    left_orth_arnoldi for a unit cell: L[k] A[k] = A_L[k] L[k+1] (L normalized), iterated
+    around the cell until L[N] = L[0], accelerated with the dominant eigenvector of the
+    mixed transfer matrix of the whole cell
+    :param A: list of the N tensors
+    :return: A_L (list), L (list, L[k] on the bond left of site k), delta
+    '''
+    N = len(A)
+    D, d, _ = A[0].shape
+    L = L0 / linalg.norm(L0)
+    delta = 1.
+    for i in range(maxiter):
+        L_start = L
+        A_L, Ls = [], []
+        for k in range(N):
+            Ls.append(L)
+            LA = ncon([L, A[k]],
+                      [[-1,1], [1,-2,-3]])
+            A_L_k, L = vumps.qr_positive(LA.reshape(D*d, D))
+            A_L.append(A_L_k.reshape(D,d,D))
+            L = L / linalg.norm(L)
+        delta = linalg.norm(L - L_start)
+        if delta < eta:
+            break
+        if D**2 > 2:
+            T = transfer.TransferProduct([transfer.TransferOperator(A[k], A_L[k]) for k in range(N)])
+            dtype = np.result_type(T.dtype, L)
+            _, X = eigs(T.linear_operator(dtype=dtype), k=1, which='LM',
+                        v0=L.reshape(-1).astype(dtype), tol=delta/10)
+            X = X[:, 0]
+            X = X * abs(X[np.argmax(abs(X))]) / X[np.argmax(abs(X))]
+            if all(np.isrealobj(A_k) for A_k in A) and np.isrealobj(L):
+                X = X.real
+            _, L = vumps.qr_positive(X.reshape(D,D))
+            L = L / linalg.norm(L)
+    return A_L, Ls, delta
+
+def canonical_form_cell(A, eta=1e-12, maxiter=100):
+    '''
+    Mixed canonical form of the unit cell A (list of N tensors)
+    :return: lists A_L, A_R, C, Ac with A_L[k] C[k] = Ac[k] = C[k-1] A_R[k],
+    C[k] diagonal, positive, decreasing, norm 1
+    '''
+    N = len(A)
+    D, d, _ = A[0].shape
+    A_L, _, _ = left_orth_cell(A, np.eye(D), eta, maxiter)
+    ## right orthonormalize from site N-1 to 0, the bond left of A_L[k].T is the bond right of site k
+    A_R_rev, C_rev, _ = left_orth_cell([A_L[k].transpose([2,1,0]) for k in range(N-1, -1, -1)],
+                                       np.eye(D), eta, maxiter)
+    A_R = A_R_rev[::-1]
+    C = [C_rev[N-1-k].T for k in range(N)]
+    U, V_dagger = [], []
+    for k in range(N):
+        U_k, S_k, V_dagger_k = linalg.svd(C[k], full_matrices=False)
+        U.append(U_k)
+        V_dagger.append(V_dagger_k)
+        C[k] = np.diag(S_k / linalg.norm(S_k))
+    for k in range(N):
+        A_L[k] = ncon([np.conj(U[k-1].T), A_L[k], U[k]],
+                      [[-1,1], [1,-2,2], [2,-3]])
+        A_R[k] = ncon([V_dagger[k-1], A_R[k], np.conj(V_dagger[k].T)],
+                      [[-3,1], [2,-2,1], [2,-1]])
+    Ac = [ncon([A_L[k], C[k]],
+               [[-1,-2,1], [1,-3]]) for k in range(N)]
+    return A_L, A_R, C, Ac
+
+'''
+##########################################################
+Environments of the unit cell
+Only MPOs with W[a,a] = 0 except for W[0,0] and W[d_w-1,d_w-1] (as get_Lh_Rh_mpo).
+The energy per cell e_cell is split evenly over the sites, which only shifts
+the effective Hamiltonians by a constant.
+##########################################################
+'''
+def left_env_cell(A_L, C, W, tol=1e-8):
+    '''
+    :return: L_W (list of (D, d_w, D), L_W[k] on the bond left of site k), energy per cell
+    '''
+    N = len(A_L)
+    W = [mpo.as_sparse(W_k) for W_k in W]
+    d_w = W[0].d_w
+    D = A_L[0].shape[0]
+    T = [transfer.TransferOperator(A_L[k]) for k in range(N)]
+    def T_term(k, c, O):
+        return c*(T[k] if O is None else vumps.Al_O_to_T_O(A_L[k], O))
+    L_W = np.zeros([N, d_w, D, D], dtype=np.result_type(*A_L, *C, *[W_k.W for W_k in W]))
+    L_W[:, d_w-1] = np.eye(D)
+    for i in range(d_w-2, 0, -1):
+        for k in range(N):
+            for j, c, O in W[k].left_terms(i):
+                L_W[(k+1)%N, i] += T_term(k, c, O).apply(L_W[k, j])
+    S = [sum(T_term(k, c, O).apply(L_W[k, j]) for j, c, O in W[k].left_terms(0))
+         for k in range(N)]
+    Y = S[0]
+    for k in range(1, N):
+        Y = T[k].apply(Y) + S[k]
+    C_r = C[N-1].T
+    R = ncon([np.conj(C_r), C_r],
+             [[1,-1], [1,-2]])
+    e = ncon([R, Y],
+             [[1,2], [1,2]])
+    solver = pinv_manual.TransferSolver(transfer.TransferProduct(T), R, np.eye(D), tol=tol)
+    L_W[0, 0] = solver.solve(Y - e*np.eye(D))
+    for k in range(N-1):
+        L_W[k+1, 0] = T[k].apply(L_W[k, 0]) + S[k] - e/N*np.eye(D)
+    return [L_W[k].transpose([1,0,2]) for k in range(N)], e
+
+def right_env_cell(A_R, C, W, tol=1e-8):
+    '''
+    :return: R_W (list of (D, d_w, D), R_W[k] on the bond right of site k), energy per cell
+    '''
+    N = len(A_R)
+    W = [mpo.as_sparse(W_k) for W_k in W]
+    d_w = W[0].d_w
+    D = A_R[0].shape[0]
+    T = [transfer.TransferOperator(A_R[k]) for k in range(N)]
+    def T_term(k, c, O):
+        return c*(T[k] if O is None else vumps.Al_O_to_T_O(A_R[k], O))
+    R_W = np.zeros([N, d_w, D, D], dtype=np.result_type(*A_R, *C, *[W_k.W for W_k in W]))
+    R_W[:, 0] = np.eye(D)
+    for i in range(1, d_w-1):
+        for k in range(N):
+            for j, c, O in W[k].right_terms(i):
+                R_W[k-1, i] += T_term(k, c, O).apply(R_W[k, j])
+    S = [sum(T_term(k, c, O).apply(R_W[k, j]) for j, c, O in W[k].right_terms(d_w-1))
+         for k in range(N)]
+    Y = S[N-1]
+    for k in range(N-2, -1, -1):
+        Y = T[k].apply(Y) + S[k]
+    L = ncon([np.conj(C[N-1]), C[N-1]],
+             [[1,-1], [1,-2]])
+    e = ncon([L, Y],
+             [[1,2], [1,2]])
+    solver = pinv_manual.TransferSolver(transfer.TransferProduct(T[::-1]), L, np.eye(D), tol=tol)
+    R_W[N-1, d_w-1] = solver.solve(Y - e*np.eye(D))
+    for k in range(N-1, 0, -1):
+        R_W[k-1, d_w-1] = T[k].apply(R_W[k, d_w-1]) + S[k] - e/N*np.eye(D)
+    return [R_W[k].transpose([1,0,2]) for k in range(N)], e
+
+'''
+##########################################################
+Per site eigenproblems
+krylov.arnoldi_eig works in complex arithmetic; for a real operator the eigenvector
+is real up to its phase, so it is returned real (the real path of vumps_mpo).
+##########################################################
+'''
+def real_if_real_operator(v, real):
+    ''':return: v with its largest element made positive and real, v.real if real'''
+    if not real:
+        return v
+    i = np.argmax(abs(v))
+    return np.ascontiguousarray((v * abs(v[i]) / v[i]).real)
+
+def solve_Ac_cell(L_W, W, R_W, Ac, tol, which='SR', factor=1.):
+    D, d, _ = Ac.shape
+    real = np.isrealobj(L_W) and np.isrealobj(R_W) and np.isrealobj(W.W if isinstance(W, mpo.SparseMPO) else W)
+    def map_Hac(Ac):
+        if isinstance(W, mpo.SparseMPO):
+            Ac_new = W.apply_Hac(L_W, Ac.reshape(D,d,D), R_W)
+        else:
+            Ac_new = ncon([L_W, Ac.reshape(D,d,D), W, R_W],
+                          [[-1,3,1], [1,5,2], [3,4,5,-2], [-3,4,2]])
+        return factor*Ac_new.reshape(-1)
+    E, Ac, converged = krylov.arnoldi_eig(map_Hac, Ac.reshape(-1), which=which, tol=tol)
+    if not converged:
+        print('Ac eigensolver did not converge!')
+    return E, real_if_real_operator(Ac, real).reshape(D,d,D)
+
+def solve_C_cell(L_W, R_W, C, tol, which='SR'):
+    D = C.shape[0]
+    real = np.isrealobj(L_W) and np.isrealobj(R_W)
+    def map_Hc(C):
+        C_new = ncon([L_W, C.reshape(D,D), R_W],
+                     [[-1,3,1], [1,2], [-2,3,2]])
+        return C_new.reshape(-1)
+    E, C, converged = krylov.arnoldi_eig(map_Hc, C.reshape(-1), which=which, tol=tol)
+    if not converged:
+        print('C eigensolver did not converge!')
+    return E, real_if_real_operator(C, real).reshape(D,D)
+
+def update_cell(pool, L_W, W, R_W, Ac, C, tol, which='SR', factor=1.):
+    '''
+    Ac[k], C[k] from the environments and then A_L[k], A_R[k], all sites concurrently
+    :return: E_Ac, E_C, Ac, C, A_L, A_R (lists), delta = max over the sites
+    '''
+    N = len(Ac)
+    jobs_Ac = [pool.submit(solve_Ac_cell, L_W[k], W[k], R_W[k], Ac[k], tol, which, factor) for k in range(N)]
+    jobs_C = [pool.submit(solve_C_cell, L_W[(k+1)%N], R_W[k], C[k], tol, which) for k in range(N)]
+    E_Ac, Ac = [list(x) for x in zip(*[job.result() for job in jobs_Ac])]
+    E_C, C = [list(x) for x in zip(*[job.result() for job in jobs_C])]
+    jobs = [pool.submit(vumps.min_Ac_C, Ac[k], C[k], C[k-1]) for k in range(N)]
+    A_L, A_R, deltas = [list(x) for x in zip(*[job.result() for job in jobs])]
+    return E_Ac, E_C, Ac, C, A_L, A_R, max(deltas)
+
+'''
+##############################################################
+MPO VUMPS with a unit cell
+##############################################################
+'''
+def vumps_mpo_cell(W, A, eta=1e-8, min_steps=0, callback=None, workers=None, tracer=None, control=None,
+                   max_steps=10000):
+    '''
+    :param W: list of the N MPO tensors of the cell, or one W for all sites
+    :param A: list of the N initial tensors (D, d, D)
+    :param min_steps: minimal number of iterations
+    :param callback: called as callback(count, delta, e) after every iteration
+    :param workers: number of threads (default of ThreadPoolExecutor)
+    :param tracer: instrument.Tracer which records every iteration (default: print every 5 steps),
+                   E_Ac and E_C are recorded as averages over the cell
+    :param control: controller.Controller of the tolerances and the stopping criterion (default: Controller(eta));
+                    krylov.arnoldi_eig only returns eigenpairs converged to its tolerance
+    :param max_steps: hard limit of the number of iterations
+    :return: e (per site), and the lists Ac, C, A_L, A_R, L_W, R_W
+    '''
+    print('>'*100)
+    print('VUMPS for MPO with a unit cell of %d sites begin!' % len(A))
+    tracer = instrument.Tracer() if tracer is None else tracer
+    tracer.begin('vumps_mpo_cell')
+    control = controller.Controller(eta) if control is None else control
+    control.reset()
+    N = len(A)
+    W = [mpo.as_sparse(W_k) for W_k in cell_tensors(W, N)]
+    A_L, A_R, C, Ac = canonical_form_cell(A)
+    delta = eta * 1000
+    e = 0
+    count = 0
+    steps = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while (not control.converged() or count < min_steps) and steps < max_steps:
+            eig_tol, env_tol = control.eig_tol(), control.env_tol()
+            with tracer.stage('environments'):
+                job_L = pool.submit(left_env_cell, A_L, C, W, env_tol)
+                job_R = pool.submit(right_env_cell, A_R, C, W, env_tol)
+                (L_W, e_L), (R_W, e_R) = job_L.result(), job_R.result()
+            with tracer.stage('update'):
+                E_Ac, E_C, Ac, C, A_L, A_R, delta = update_cell(pool, L_W, W, R_W, Ac, C, eig_tol)
+            e = (e_L + e_R) / (2*N)
+            control.update(delta, e)
+            tracer.end_iteration(count, energy=e, delta=delta, E_Ac=np.mean(np.real(E_Ac)),
+                                 E_C=np.mean(np.real(E_C)), eig_tol=eig_tol, env_tol=env_tol)
+            count += 1
+            steps += 1
+            if callback is not None:
+                callback(count, delta, e)
+    if steps >= max_steps:
+        print('warning: stopped after max_steps = ', max_steps, 'iterations at delta = ', delta)
+    print(50 * '-' + ' final ' + 50 * '-')
+    print('delta = ', delta)
+    print('energy = ', e)
+    return e, Ac, C, A_L, A_R, L_W, R_W
+
+'''
+##############################################################
+vumps_fixed_points with a unit cell
+##############################################################
+'''
+def fixed_boundary_cell(A, W, tol, v0=None):
+    '''
+    Dominant eigenvector of the product of the T_W of the cell (in the order of A, W),
+    carried through the cell
+    :return: lam of the cell, list of the N fixed points (the k-th one is in front of A[k])
+    '''
+    T = [transfer.TransferOperator(A[k], W=W[k]) for k in range(len(A))]
+    T_cell = transfer.TransferProduct(T)
+    if v0 is None:
+        v0 = parallel.start_vector(T_cell.size, T_cell.dtype) ## the same start in every process, see parallel.py
+    lam, x, converged = krylov.arnoldi_eig(lambda x: T_cell.apply(x).reshape(-1), v0.reshape(-1),
+                                           which='LM', tol=tol)
+    if not converged:
+        print('fixed_boundary_cell did not converge!')
+    x = [real_if_real_operator(x, not np.issubdtype(T_cell.dtype, np.complexfloating)).reshape(T_cell.vshape)]
+    for k in range(len(A)-1):
+        x.append(T[k].apply(x[-1]))
+    return lam, x
+
+def vumps_fixed_points_cell(W, A, eta=1e-8, min_steps=0, callback=None, workers=None, tracer=None,
+                            control=None, max_steps=10000):
+    '''
+    :param W: list of the N MPO (transfer matrix) tensors of the cell, or one W for all sites
+    :param A: list of the N initial tensors (D, d, D)
+    :param min_steps: minimal number of iterations
+    :param callback: called as callback(count, delta, lam1) after every iteration
+    :param workers: number of threads (default of ThreadPoolExecutor)
+    :param tracer: instrument.Tracer which records every iteration (default: print every 10 steps)
+    :param control: controller.Controller as in vumps_mpo_cell
+    :param max_steps: hard limit of the number of iterations (restarts included)
+    :return: lam1 (per site), and the lists Ac, C, A_L, A_R, Lw, Rw
+    '''
+    tracer = instrument.Tracer(printer=instrument.Printer(every=10)) if tracer is None else tracer
+    tracer.begin('vumps_fixed_points_cell')
+    control = controller.Controller(eta) if control is None else control
+    control.reset()
+    N = len(A)
+    W = cell_tensors(W, N)
+    W_r = [W[k].transpose([1, 0, 2, 3]) for k in range(N)]
+    A_L, A_R, C, Ac = canonical_form_cell(A)
+    D, d, _ = A_L[0].shape
+    delta = eta * 1000
+    count = 0
+    Lw, Rw = None, None
+    steps = 0
+    with ThreadPoolExecutor(max_workers=workers) as pool:
+        while (not control.converged() or count < min_steps) and steps < max_steps:
+            eig_tol, env_tol = control.eig_tol(), control.env_tol()
+            with tracer.stage('environments'):
+                job_L = pool.submit(fixed_boundary_cell, A_L, W, env_tol, None if Lw is None else Lw[0])
+                job_R = pool.submit(fixed_boundary_cell, A_R[::-1], W_r[::-1], env_tol,
+                                    None if Rw is None else Rw[N-1])
+                (lam_L, Lw), (lam_R, Rw) = job_L.result(), job_R.result()
+            Rw = Rw[::-1]
+            for k in range(N):
+                Lw[k] = Lw[k] / vumps.overlap_fixed_boundary(Lw[k], Rw[k-1], C[k-1])
+            lam1 = lam_L**(1/N)
+            with tracer.stage('update'):
+                _, _, Ac, C, A_L, A_R, delta = update_cell(pool, Lw, W, Rw, Ac, C, eig_tol, 'LM', 1/lam1)
+            control.update(delta, lam1)
+            tracer.end_iteration(count, delta=delta, lam1=lam1, lam2=lam_R**(1/N), eig_tol=eig_tol, env_tol=env_tol)
+            count += 1
+            steps += 1
+            if callback is not None:
+                callback(count, delta, lam1)
+            if count > 200 and delta > 1e-3:
+                A_L, A_R, C, Ac = canonical_form_cell([np.random.rand(D,d,D) for k in range(N)])
+                tracer.add(restarts=1)
+                control.reset()
+                delta = eta * 1000
+                count = 0
+                Lw, Rw = None, None
+    print('delta = ', delta)
+    if steps >= max_steps:
+        print('warning: stopped after max_steps = ', max_steps, 'iterations at delta = ', delta)
+    else:
+        print('converge!')
+    return lam1, Ac, C, A_L, A_R, Lw, Rw
@@ -1,15 +1,23 @@
 import constants
 import pinv_manual
-from ncon import ncon
+import checkpoint
+import transfer
+import mpo
+import instrument
+import controller
+import parallel
+import krylov
+from ncon_plan import ncon
 import numpy as np
 from scipy import linalg
 from scipy.sparse.linalg import eigs
 from scipy.sparse.linalg import eigsh
 from scipy.sparse.linalg import LinearOperator
-from scipy.sparse.linalg import bicgstab
+from scipy.sparse.linalg import ArpackNoConvergence
 # from scipy.sparse.linalg import bicg
 import matplotlib.pyplot as plt
 import copy
+import time
 
 
 '''
@@ -37,7 +45,8 @@ Section 1 Functions that will be used for both 2sites and MPO
 Contain three parts:
 1.Change uMPS to canonical form.
 2.Find {A_L, A_R} from a given {Ac, C} 
-3.Sum infinite transfer matrix (most FREQUENTLY used) 
+3.Adaptive bond dimension
+(Sum infinite transfer matrix (most FREQUENTLY used) is in pinv_manual.py)
 ########################################################################################################################
 
 ###########################################################
@@ -166,7 +175,7 @@ Three functions:
 >>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>>
 The final result we want is A_L, A_R, and C
 Ac should be calculate using (A_L,C) or (C,A_R)
-For instance, most of the time, we use
+The solvers now use canonical_form (Part 1-3); this method is kept for comparison:
 lam, gamma = A_to_lam_gamma(A)
 lam, gamma = lam_gamma_to_canonical(lam, gamma)
 A_L, A_R = canonical_to_Al_Ar(lam, gamma)
@@ -248,6 +257,95 @@ def canonical_to_Al_Ar(lam, gamma):
                [[-3,-2,1], [1,-1]])
     return A_L, A_R
 
+'''
+########################################################
+Part 1-3
+Change uMPS to canonical form: method 3 (used by all solvers)
+Iterative QR with Arnoldi acceleration, Algorithm 1 & 2 in arXiv:1810.07006v3,
+with the fixes which make method 1 stable and reproducible:
+1. QR with positive diagonal of R, so the fixed point is unique (no sign flips of L),
+2. the global phase of the Arnoldi vector is removed, so L stays real for real A,
+3. deterministic initial guess (identity), no random v0,
+4. no explicit inverse, no eigh of the fixed points.
+A_R is obtained by left orthonormalizing A_L.transpose([2,1,0]), which gives C directly.
+Usage:
+A_L, A_R, C, Ac = canonical_form(A)
+########################################################
+'''
+def qr_positive(M):
+    '''M = Q R with an isometry Q and an upper triangular R with real, non-negative diagonal'''
+    Q, R = linalg.qr(M, mode='economic')
+    diag = np.diag(R)
+    phase = np.ones(len(diag), dtype=diag.dtype)
+    nonzero = abs(diag) > 0
+    phase[nonzero] = diag[nonzero] / abs(diag[nonzero])
+    Q = Q * phase
+    R = np.conj(phase)[:, None] * R
+    return Q, R
+
+def left_orth_arnoldi(A, L0, eta=1e-12, maxiter=100, slow_factor=0.5):
+    '''
+    0--L--1 0--A--2 ----> 0--A_L--2  0--L--1
+               |     QR      |
+               1             1
+    :param L0: initial guess of L
+    :param eta: tolerance of ||L - L_old|| (L normalized)
+    :param maxiter: maximal number of QR steps
+    :param slow_factor: a QR step is slow if it reduces delta by less than this factor
+    :return: A_L, L, delta
+    After a slow QR step, L is replaced by the dominant eigenvector of the mixed transfer
+    matrix X -> A_L^dagger X A (Arnoldi, tol = delta/10, v0 = L); fast QR steps (e.g. from
+    a good L0) are not interrupted.
+    '''
+    D, d, _ = A.shape
+    def transfer_map(X):
+        X_out = ncon([X.reshape(D,D), A, np.conj(A_L)],
+                     [[2,1], [1,3,-2], [2,3,-1]])
+        return X_out.reshape(-1)
+    L = L0 / linalg.norm(L0)
+    delta = 1.
+    for i in range(maxiter):
+        LA = ncon([L, A],
+                  [[-1,1], [1,-2,-3]])
+        A_L, L_new = qr_positive(LA.reshape(D*d, D))
+        A_L = A_L.reshape(D,d,D)
+        L_new = L_new / linalg.norm(L_new)
+        delta, delta_prev = linalg.norm(L_new - L), delta
+        L = L_new
+        if delta < eta:
+            break
+        if D**2 > 2 and delta > slow_factor * delta_prev:
+            dtype = np.result_type(A, L)
+            _, X = eigs(LinearOperator((D**2, D**2), matvec=transfer_map, dtype=dtype), k=1, which='LM',
+                        v0=L.reshape(-1).astype(dtype), tol=delta/10)
+            X = X[:, 0]
+            X = X * abs(X[np.argmax(abs(X))]) / X[np.argmax(abs(X))]
+            if np.isrealobj(A) and np.isrealobj(L):
+                X = X.real
+            _, L = qr_positive(X.reshape(D,D))
+            L = L / linalg.norm(L)
+    return A_L, L, delta
+
+def canonical_form(A, eta=1e-12, maxiter=100):
+    '''
+    Mixed canonical form of the uMPS A (any normalization)
+    :return: A_L, A_R, C, Ac with A_L C = Ac and C diagonal, positive, decreasing, norm 1
+    '''
+    D, d, _ = A.shape
+    A_L, _, _ = left_orth_arnoldi(A, np.eye(D), eta, maxiter)
+    A_R, C_r, _ = left_orth_arnoldi(A_L.transpose([2,1,0]), np.eye(D), eta, maxiter)
+    C = C_r.T ## A_L C = C A_R
+    U, S, V_dagger = linalg.svd(C, full_matrices=False)
+    A_L = ncon([np.conj(U.T), A_L, U],
+               [[-1,1], [1,-2,2], [2,-3]])
+    V = np.conj(V_dagger.T)
+    A_R = ncon([V_dagger, A_R, V],
+               [[-3,1], [2,-2,1], [2,-1]])
+    C = np.diag(S / linalg.norm(S))
+    Ac = ncon([A_L, C],
+              [[-1, -2, 1], [1, -3]])
+    return A_L, A_R, C, Ac
+
 '''
 ##########################################################
 Part 2
@@ -255,41 +353,351 @@ Find {A_L, A_R} from a given {Ac, C}
 Ref: Algorithm 5 in arXiv:1810.07006v3
 ##########################################################
 '''
-def min_Ac_C(Ac, C):
+def polar_newton_schulz(X, tol=1e-13, maxerr=1e-2, maxiter=20):
+    '''
+    Orthonormalize the columns of X, which is already close to an isometry, by the
+    Newton-Schulz iteration X <- X (3 - X^dagger X)/2 (only matrix products).
+    The error err = ||X^dagger X - 1|| goes to ~err^2 per step, so the last check is skipped.
+    :return: isometry, converged (False if err > maxerr in the first step)
+    '''
+    eye = np.eye(X.shape[1])
+    for i in range(maxiter):
+        XX = np.conj(X.T) @ X
+        err = linalg.norm(XX - eye)
+        if err < tol:
+            return X, True
+        if err > maxerr and i == 0:
+            return X, False
+        X = X @ (1.5*eye - 0.5*XX)
+        if err**2 < tol:
+            return X, True
+    return X, False
+
+def polar_factor(M, tol=1e-10, switch_tol=1e-2):
+    '''
+    Polar factor U of M = U P (M is tall, U an isometry).
+    Fast path: U = M (M^dagger M)^-1/2 from the eigen decomposition of the small Gram matrix,
+    polished by Newton-Schulz. The Gram matrix already perturbs U by ~ eps*cond(M)^2, which
+    Newton-Schulz does not remove (it only restores the orthogonality of the perturbed U),
+    so the fast path is only taken if eps*cond(M)^2 <= tol; otherwise, or if
+    ||U^dagger U - 1|| > switch_tol, U comes from the SVD.
+    :param tol: accepted error of U (eps of the dtype of M)
+    '''
+    w, V = linalg.eigh(np.conj(M.T) @ M)
+    if w[0] * tol >= w[-1] * np.finfo(w.dtype).eps:
+        U = (M @ V) @ (np.conj(V.T) / np.sqrt(w)[:, None])
+        U, converged = polar_newton_schulz(U, maxerr=switch_tol)
+        if converged:
+            return U
+    U_M, S_M, V_dagger_M = linalg.svd(M, full_matrices=False)
+    return U_M @ V_dagger_M
+
+def min_Ac_C(Ac, C, C_left=None, tol=1e-10):
+    '''
+    A_L = U_Ac U_C^dagger and A_R likewise, with the polar factors U from polar_factor
+    (Gram matrix + Newton-Schulz, SVD if cond(Ac) or cond(C) is too large for tol)
+    The polar factor of C.T is U_C.T, so C is only decomposed once.
+    :param C_left: C on the left bond of Ac for unit cells (Ac = A_L C = C_left A_R),
+                   default is C (one site unit cell)
+    :param tol: accepted error of A_L and A_R (delta does not show it, it is weighted by C)
+    :return: A_L, A_R, delta = ||Ac - A_L C|| (and ||Ac - C_left A_R|| if C_left is given)
+    '''
     D,d,_ = Ac.shape
-
-    U_Ac,S_Ac,V_dagger_Ac = linalg.svd(Ac.reshape(D*d,D), full_matrices=False)
-    U_c, S_c, V_dagger_c = linalg.svd(C, full_matrices=False)
-    A_L = (U_Ac@V_dagger_Ac)@np.conj(U_c@V_dagger_c).T
+    U_C = polar_factor(C, tol)
+    U_C_left = U_C if C_left is None else polar_factor(C_left, tol)
+    A_L = polar_factor(Ac.reshape(D*d, D), tol) @ np.conj(U_C).T
     A_L = A_L.reshape(D,d,D)
     Ac_r = Ac.transpose([2,1,0])
-
-    C_r = C.T
-    U_Ac, S_Ac, V_dagger_Ac = linalg.svd(Ac_r.reshape(D * d, D), full_matrices=False)
-    U_c, S_c, V_dagger_c = linalg.svd(C_r, full_matrices=False)
-    A_R = (U_Ac@V_dagger_Ac)@np.conj(U_c@V_dagger_c).T
+    A_R = polar_factor(Ac_r.reshape(D*d, D), tol) @ np.conj(U_C_left)
     A_R = A_R.reshape(D,d,D)
+    Al_C = ncon([A_L, C],
+                [[-1, -2, 1], [1, -3]])
+    delta = linalg.norm(Ac-Al_C)
+    if C_left is not None:
+        C_Ar = ncon([C_left, A_R],
+                    [[-1, 1], [-3, -2, 1]])
+        delta = max(delta, linalg.norm(Ac-C_Ar))
+    return A_L, A_R, delta
+
+'''
+##########################################################
+Part 3
+Adaptive bond dimension
+Subspace expansion: the two site effective Hamiltonian applied to Ac2 = Ac A_R,
+projected onto the null spaces N_L of A_L and N_R of A_R, gives the directions
+which the one site update cannot reach. A_L and A_R are enlarged by the dD leading
+singular vectors of N_L^dagger (H Ac2) N_R^dagger, C and Ac are padded with zeros
+(the state does not change, the next VUMPS step fills the new block).
+Truncation: Schmidt values S/S[0] < trunc_tol are discarded.
+Ref: Sec. 6 in arXiv:1810.07006v3; PRB 97, 045145 (2018) Appendix B
+Usage (inside the solvers, apply_two_site is the two site map of the model):
+A_L, A_R, C, Ac, change = adapt_bond_dimension(A_L, A_R, C, Ac, apply_two_site, D_max, D_step, trunc_tol)
+##########################################################
+'''
+def null_space_left(A_L):
+    '''
+    N_L with shape (D, d, D*(d-1)) and N_L^dagger A_L = 0, N_L^dagger N_L = 1
+    (also for A_R, whose columns are the left index in the convention 2--A_R--0)
+    '''
+    D, d, _ = A_L.shape
+    N_L = linalg.null_space(np.conj(A_L.reshape(D*d, D)).T)
+    return N_L.reshape(D, d, -1)
+
+def expand_bond(A_L, A_R, C, Ac, H_Ac2, dD):
+    '''
+    :param H_Ac2: two site effective Hamiltonian applied to Ac2 = Ac A_R, shape (D,d,d,D)
+    :param dD: maximal number of new states
+    :return: A_L, A_R, C, Ac with bond dimension D + dD (or less, if N_L/N_R are smaller)
+    '''
+    D, d, _ = A_L.shape
+    N_L = null_space_left(A_L)
+    N_R = null_space_left(A_R)
+    P = ncon([np.conj(N_L), H_Ac2, np.conj(N_R)],
+             [[1,2,-1], [1,2,3,4], [4,3,-2]])
+    U, S, V_dagger = linalg.svd(P, full_matrices=False)
+    dD = min(dD, len(S))
+    dtype = np.result_type(A_L, A_R, C, Ac, U)
+    A_L_new = np.zeros([D+dD, d, D+dD], dtype=dtype)
+    A_L_new[:D, :, :D] = A_L
+    A_L_new[:D, :, D:] = ncon([N_L, U[:, :dD]],
+                              [[-1,-2,1], [1,-3]])
+    A_R_new = np.zeros([D+dD, d, D+dD], dtype=dtype)
+    A_R_new[:D, :, :D] = A_R
+    A_R_new[:D, :, D:] = ncon([N_R, V_dagger[:dD]],
+                              [[-1,-2,1], [-3,1]])
+    C_new = np.zeros([D+dD, D+dD], dtype=dtype)
+    C_new[:D, :D] = C
+    Ac_new = np.zeros([D+dD, d, D+dD], dtype=dtype)
+    Ac_new[:D, :, :D] = Ac
+    return A_L_new, A_R_new, C_new, Ac_new
+
+def truncate_bond(A_L, C, trunc_tol):
+    '''
+    Keep the Schmidt values S/S[0] >= trunc_tol, then restore the exact canonical form
+    :return: A_L, A_R, C, Ac
+    '''
+    U, S, V_dagger = linalg.svd(C)
+    k = max(1, int(np.sum(S >= trunc_tol*S[0])))
+    U = U[:, :k]
+    A_L = ncon([np.conj(U.T), A_L, U],
+               [[-1,1], [1,-2,2], [2,-3]])
+    return canonical_form(A_L)
 
-    '''u_l_ac, _ = linalg.polar(Ac.reshape(D * d, D), side='left')
-    u_l_c, _ = linalg.polar(C, side='left')
+def adapt_bond_dimension(A_L, A_R, C, Ac, apply_two_site, D_max, D_step, trunc_tol):
+    '''
+    Truncate if C has Schmidt values below trunc_tol, otherwise expand by
+    min(D_step, D_max - D) states
+    :param apply_two_site: function Ac2 -> H Ac2 (two site effective Hamiltonian)
+    :return: A_L, A_R, C, Ac, change ('truncate', 'expand' or None)
+    '''
+    D = A_L.shape[0]
+    S = linalg.svd(C, compute_uv=False)
+    if S[-1] < trunc_tol*S[0]:
+        A_L, A_R, C, Ac = truncate_bond(A_L, C, trunc_tol)
+        return A_L, A_R, C, Ac, 'truncate'
+    if D >= D_max:
+        return A_L, A_R, C, Ac, None
+    Ac2 = ncon([Ac, A_R],
+               [[-1,-2,1], [-4,-3,1]])
+    A_L, A_R, C, Ac = expand_bond(A_L, A_R, C, Ac, apply_two_site(Ac2), min(D_step, D_max - D))
+    if A_L.shape[0] == D:
+        return A_L, A_R, C, Ac, None
+    return A_L, A_R, C, Ac, 'expand'
 
-    al_tilda = u_l_ac @ np.conj(u_l_c).T
-    al_tilda = al_tilda.reshape(D, d, D)
+'''
+##########################################################
+Part 4
+Mixed precision
+In the early iterations delta is ~1e-1..1e-4, so the solvers can hold and contract
+all tensors in single precision (complex64/float32), which halves the memory and
+the cost of the BLAS calls. Once delta < single_precision_delta the tensors are
+promoted to double precision for the final convergence and stay there.
+Single precision does not resolve much more, so the threshold is at least
+single_delta_min and the tolerances of eigs/lgmres at least single_tol_min.
+Usage (inside the solvers):
+single = single and delta > max(single_precision_delta, single_delta_min)
+A_L, A_R, C, Ac = to_precision(single, A_L, A_R, C, Ac)
+##########################################################
+'''
+single_delta_min = 1e-4
+single_tol_min = 1e-5
 
-    print('left test:', linalg.norm(al_tilda - A_L))
+def to_precision(single, *tensors):
+    '''
+    :param single: True: complex64/float32, False: complex128/float64
+    :return: list of the tensors in that precision (None stays None, real stays real)
+    '''
+    out = []
+    for T in tensors:
+        if T is not None:
+            if np.iscomplexobj(T):
+                T = np.asarray(T).astype(np.complex64 if single else np.complex128, copy=False)
+            else:
+                T = np.asarray(T).astype(np.float32 if single else np.float64, copy=False)
+        out.append(T)
+    return out
+
+def precision_tol(tol, single):
+    ''':return: tol, raised to single_tol_min in single precision'''
+    return max(tol, single_tol_min) if single else tol
+
+def report_promotion(count, delta, t0):
+    print('promoted to double precision at step ', count, 'delta = ', delta,
+          'after %.2f s in single precision' % (time.time() - t0))
 
-    u_r_ac, _ = linalg.polar(Ac.reshape(D, D * d), side='right')
-    u_r_c, _ = linalg.polar(C, side='right')
+'''
+##########################################################
+Part 5
+Real arithmetic
+constants.Model builds W from the complex spin operators, but for TFIM and XXZ
+(written with S+/S-) all entries are real, and so is the ground state.
+vumps_mpo and vumps_2sites pass W/h through real_if_real, and with a real W/h and
+a real initial A every tensor stays real (canonical_form, the environments, the
+polar decompositions). The Ac and C problems are then real symmetric and are solved
+by Lanczos (eigsh) instead of the complex Arnoldi of eigs: half the memory and
+about a quarter of the flops. Complex W/h or a complex A keep eigs.
+##########################################################
+'''
+def real_if_real(T, tol=1e-14):
+    ''':return: T.real if max|Im T| <= tol max|T|, otherwise T'''
+    if np.iscomplexobj(T) and np.max(abs(T.imag)) <= tol*np.max(abs(T)):
+        return np.ascontiguousarray(T.real)
+    return T
 
-    ar_tilda = np.conj(u_r_c).T @ u_r_ac
-    ar_tilda = ar_tilda.reshape(D, d, D)
-    ar_tilda = ar_tilda.transpose([2, 1, 0])
+def lowest_eigenpair(H, v0, tol, ncv=None, maxiter=None):
+    '''
+    Lowest eigenpair of the Hermitian effective Hamiltonian H (LinearOperator):
+    eigsh for a real H (real symmetric), eigs (which='SR') for a complex one
+    :param ncv, maxiter: as eigs, e.g. from controller.Controller.krylov
+    :return: E, v as eigs
+    '''
+    if np.issubdtype(H.dtype, np.complexfloating):
+        return arpack_eigenpair(eigs, H, which='SR', v0=v0, tol=tol, ncv=ncv, maxiter=maxiter)
+    return arpack_eigenpair(eigsh, H, which='SA', v0=v0, tol=tol, ncv=ncv, maxiter=maxiter)
 
-    print('right test:', linalg.norm(ar_tilda - A_R))
+def arpack_eigenpair(solver, H, **kwargs):
+    '''
+    solver(H, k=1, **kwargs) with solver eigs or eigsh. If it does not converge within maxiter,
+    the best Ritz pair is returned (the eigen-residual is checked by the outer loop),
+    or, if there is none, the solver is called again without maxiter.
+    '''
+    try:
+        return solver(H, k=1, **kwargs)
+    except ArpackNoConvergence as err:
+        if len(err.eigenvalues) == 0:
+            return solver(H, k=1, **dict(kwargs, maxiter=None))
+        return err.eigenvalues[:1], err.eigenvectors[:, :1]
 
-    return al_tilda, ar_tilda'''
-    return A_L, A_R
+'''
+##########################################################
+Part 6
+Instrumentation
+The solvers take a tracer (instrument.Tracer, default: printing only) and record
+per iteration the time of each stage, the matvec and lgmres counts, delta, the
+energy, the eigenvalues and the residuals of the Ac and C problems, and the
+tolerances set by the controller (controller.Controller).
+##########################################################
+'''
+def eig_residual(matvec, E, v):
+    ''':return: ||H v - E v|| / ||v|| for the eigenpair (E, v) of eigs/eigsh'''
+    v = v.reshape(-1)
+    return linalg.norm(matvec(v) - np.asarray(E).reshape(-1)[0]*v) / linalg.norm(v)
 
+'''
+##########################################################
+Part 7
+Acceleration
+With acceleration=anderson.Anderson() the solvers extrapolate the iterate x = (A_L, A_R, C)
+from the previous ones after min_Ac_C (see anderson.py). Mixing A_L and C, not Ac and C,
+keeps the extrapolated state consistent: mixing Ac and C and taking the polar factors
+again amplifies the errors in the directions of the small singular values of C.
+delta is still the one of the plain update, so the stopping criterion is unchanged.
+##########################################################
+'''
+def retract(A_L, A_R, C):
+    '''
+    Closest isometries A_L, A_R and normalized C to an extrapolated iterate
+    :return: A_L, A_R, C, Ac = A_L C
+    '''
+    D, d, _ = A_L.shape
+    A_L = polar_factor(A_L.reshape(D*d, D)).reshape(D, d, D)
+    A_R = polar_factor(A_R.reshape(D*d, D)).reshape(D, d, D)
+    C = C / linalg.norm(C)
+    Ac = ncon([A_L, C],
+              [[-1, -2, 1], [1, -3]])
+    return A_L, A_R, C, Ac
+
+'''
+##########################################################
+Part 8
+Concurrent pairs
+With pool=parallel.PairPool() vumps_mpo and vumps_fixed_points solve the independent
+pairs (left/right environments, Ac/C eigenproblems) in two worker processes, see
+parallel.py. Both paths call the module level functions below (solve_Ac, solve_C,
+left_environment_mpo, right_environment_mpo, fixed_boundary_counted), which return
+their counters instead of updating the tracer. The results are bit-identical to
+pool=None only if this process runs with as many BLAS threads as each worker
+(PairPool(blas_threads=...), default half of the cores, while this process keeps all
+of them), otherwise they differ in the last bits. The pool costs ~2-15 ms of
+inter-process transfer per pair, so it only pays off for D >~ 16, see parallel.py.
+##########################################################
+'''
+def apply_Hac(L_W, W, R_W, Ac, lam=1.):
+    '''
+    H_Ac Ac / lam on flat vectors
+    :param W: mpo.SparseMPO (vumps_mpo) or dense W (vumps_fixed_points)
+    '''
+    D, d = L_W.shape[0], W.shape[2]
+    Ac = Ac.reshape(D, d, D)
+    if isinstance(W, mpo.SparseMPO):
+        Ac_new = W.apply_Hac(L_W, Ac, R_W)
+    else:
+        Ac_new = ncon([L_W, Ac, W, R_W],
+                      [[-1,3,1], [1,5,2], [3,4,5,-2], [-3,4,2]])
+    return (Ac_new / lam).reshape(-1)
+
+def apply_Hc(L_W, R_W, C):
+    '''H_C C on flat vectors'''
+    D = L_W.shape[0]
+    C_new = ncon([L_W, C.reshape(D, D), R_W],
+                 [[-1,3,1], [1,2], [-2,3,2]])
+    return C_new.reshape(-1)
+
+def solve_eigenpair(matvec, v0, tol, krylov, which):
+    '''
+    :param which: 'SA' for the lowest eigenpair (lowest_eigenpair), otherwise as eigs
+    :param krylov: ncv and maxiter (controller.Controller.krylov)
+    :return: E, v, stats {'matvecs': applications of matvec, 'time': wall time}
+    '''
+    t = time.perf_counter()
+    stats = {'matvecs': 0}
+    def matvec_counted(x):
+        stats['matvecs'] += 1
+        return matvec(x)
+    H = LinearOperator((v0.size, v0.size), matvec=matvec_counted, dtype=v0.dtype)
+    if which == 'SA':
+        E, v = lowest_eigenpair(H, v0, tol, **krylov)
+    else:
+        E, v = arpack_eigenpair(eigs, H, which=which, v0=v0, tol=tol, **krylov)
+    stats['time'] = time.perf_counter() - t
+    return E, v, stats
+
+def solve_Ac(L_W, W, R_W, Ac, tol, krylov, which='SA', lam=1.):
+    ''':return: E_Ac, Ac (flat), stats of the eigenproblem of H_Ac / lam (see solve_eigenpair)'''
+    v0 = Ac.reshape(-1).astype(np.result_type(Ac, L_W, R_W))
+    return solve_eigenpair(lambda x: apply_Hac(L_W, W, R_W, x, lam), v0, tol, krylov, which)
+
+def solve_C(L_W, R_W, C, tol, krylov, which='SA'):
+    ''':return: E_C, C (flat), stats of the eigenproblem of H_C (see solve_eigenpair)'''
+    v0 = C.reshape(-1).astype(np.result_type(C, L_W, R_W))
+    return solve_eigenpair(lambda x: apply_Hc(L_W, R_W, x), v0, tol, krylov, which)
+
+def count_eigensolvers(tracer, control, stats_Ac, stats_C):
+    '''Adds the matvecs and times of solve_Ac and solve_C to the tracer and the controller'''
+    tracer.add(matvecs_Ac=stats_Ac['matvecs'], matvecs_C=stats_C['matvecs'],
+               time_eig_Ac=stats_Ac['time'], time_eig_C=stats_C['time'])
+    control.count('Ac', stats_Ac['matvecs'])
+    control.count('C', stats_C['matvecs'])
 
 '''
 ########################################################################################################################
@@ -332,9 +740,26 @@ def Ar_h_to_h_R(A_R, h): ## eqn(133) in arXiv:1810.07006v3
                [[2,3,-2],[1,4,2],[3,4,5,6],[7,5,-1],[1,6,7]])
     return h_R
 
+def two_site_h(Ac2, A_L, A_R, h, L_h, R_h):
+    '''
+    Two site effective Hamiltonian of 2sites VUMPS applied to Ac2 (D,d,d,D), for the subspace expansion:
+    h on the two sites, on the bonds to the left and right neighbours, and L_h, R_h
+    '''
+    term1 = ncon([Ac2, h],
+                 [[-1,1,2,-4], [1,2,-2,-3]])
+    term2 = ncon([A_L, Ac2, h, np.conj(A_L)],
+                 [[5,2,1], [1,3,-3,-4], [2,3,4,-2], [5,4,-1]])
+    term3 = ncon([Ac2, A_R, h, np.conj(A_R)],
+                 [[-1,-2,2,1], [5,3,1], [2,3,-3,4], [5,4,-4]])
+    term4 = ncon([L_h, Ac2],
+                 [[-1,1], [1,-2,-3,-4]])
+    term5 = ncon([Ac2, R_h],
+                 [[-1,-2,-3,1], [-4,1]])
+    return term1+term2+term3+term4+term5
+
 def A_to_Tm(A_L):
-    T_L = ncon([A_L, np.conj(A_L)],
-               [[-4,1,-2], [-3,1,-1]])
+    '''Matrix-free transfer matrix of A_L (or A_R), see transfer.TransferOperator'''
+    T_L = transfer.TransferOperator(A_L)
     return T_L
 
 '''
@@ -344,9 +769,41 @@ This function will largely use the previos defined functions
 Ref: Algorithm 4 in arXiv:1810.07006v3
 ############################################################
 '''
-def vumps_2sites(h, A, eta=1e-7, pinv = 'scipy'):
+def vumps_2sites(h, A, eta=1e-7, pinv = 'auto', dense_pinv_max_D = 10, save_to = None, save_every = 10,
+                 resume_from = None, min_steps = 0, callback = None, D_max = None, D_step = 4,
+                 expand_delta = 1e-4, trunc_tol = 1e-10, single_precision_delta = None, tracer = None,
+                 acceleration = None, control = None, max_steps = 10000):
+    '''
+    :param pinv: how to sum the infinite transfer matrix for L_h/R_h
+        'manual': projected iterative solver (pinv_manual.sum_right_left), warm-started
+                  from L_h/R_h of the previous iteration
+        'scipy': dense linalg.pinv of the D^2 x D^2 matrix 1-T, O(D^6) per iteration
+        'auto': 'scipy' if D <= dense_pinv_max_D else 'manual'
+    :param save_to: checkpoint directory, written every save_every iterations (see checkpoint.py)
+    :param resume_from: checkpoint directory (or dict of the same arrays, e.g. a seed from sweep.py)
+                        to continue from (A is not used then)
+    :param min_steps: minimal number of iterations (the controller alone decides by default)
+    :param callback: called as callback(count, delta, e) after every iteration
+    :param D_max: adaptive bond dimension (None: D fixed by A). Whenever delta < expand_delta,
+                  the bond is truncated to the Schmidt values S/S[0] >= trunc_tol if there are
+                  smaller ones, otherwise expanded by D_step states (up to D_max), see Part 3
+    :param single_precision_delta: mixed precision (None: double precision only). While
+                  delta > single_precision_delta the iterations run in single precision, see Part 4
+    :param tracer: instrument.Tracer which records every iteration (default: print every 5 steps)
+    :param acceleration: anderson.Anderson to extrapolate A_L, A_R, C from the previous iterates
+                  (None: plain fixed-point iteration), see Part 7
+    :param control: controller.Controller which sets the tolerances of the eigensolvers and the
+                  environments and decides when to stop (default: Controller(eta)), see controller.py
+    :param max_steps: hard limit of the number of iterations (restarts included)
+    '''
     print('>' * 100)
     print('VUMPS for two sites begin!')
+    h = real_if_real(h)
+    tracer = instrument.Tracer() if tracer is None else tracer
+    tracer.begin('vumps_2sites')
+    control = controller.Controller(eta) if control is None else control
+    if acceleration is not None:
+        acceleration.reset()
     def map_Hac(Ac): ## eqn(131) in arXiv:1810.07006v3
         Ac = Ac.reshape(D,d,D)
         term1 = ncon([A_L,Ac,h_tilda,np.conj(A_L)],
@@ -367,65 +824,117 @@ def vumps_2sites(h, A, eta=1e-7, pinv = 'scipy'):
         term3 = C@R_h.T
         final = term1+term2+term3
         return final.reshape(-1)
-    D,d,_ = A.shape
-    lam, gamma = A_to_lam_gamma(A)
-    lam, gamma = lam_gamma_to_canonical(lam, gamma)
-    A_L, A_R = canonical_to_Al_Ar(lam, gamma)
-    C = lam
-    Ac = ncon([A_L, C],
-              [[-1, -2, 1], [1, -3]])
-    delta = eta*1000
-    e_memory = -1
-    e = 0
-    count = 0
-    while (delta > eta and abs(e - e_memory) > eta / 10) or count <15:
+    if resume_from is None:
+        A_L, A_R, C, Ac = canonical_form(A)
+        delta = eta*1000
+        e_memory = -1
+        e = 0
+        count = 0
+        L_h, R_h = None, None
+    else:
+        state = checkpoint.load_state(resume_from)
+        A_L, A_R, C, Ac, L_h, R_h = [state.get(key) for key in ['A_L', 'A_R', 'C', 'Ac', 'L_h', 'R_h']]
+        delta, e, e_memory, count = [state[key] for key in ['delta', 'e', 'e_memory', 'count']]
+        if not isinstance(resume_from, dict):
+            print('resume from ', resume_from, 'at step ', count)
+    D,d,_ = A_L.shape
+    control.reset(None if resume_from is None else delta)
+    saver = None if save_to is None else checkpoint.Checkpoint(save_to, save_every)
+    growing = D_max is not None
+    single = single_precision_delta is not None
+    t0 = time.time()
+    steps = 0
+    while (not control.converged() or count < min_steps or growing or single) and steps < max_steps:
+        A_L, A_R, C, Ac, L_h, R_h, h_k = to_precision(single, A_L, A_R, C, Ac, L_h, R_h, h)
+        tracer.add(single=single)
+        x_in = [A_L, A_R, C]
+        eig_tol, env_tol = control.eig_tol(), control.env_tol()
         e_memory = e
-        e = evaluate_energy_two_sites(A_L, A_R, Ac, h)
-        e_eye = e * np.eye(d ** 2, d ** 2).reshape(d, d, d, d)
-        h_tilda = h - e_eye
-        # h_tilda = h
-        h_L = Al_h_to_hL(A_L, h_tilda)
-        h_R = Ar_h_to_h_R(A_R, h_tilda)
-        if pinv == 'scipy':
-            T_L = A_to_Tm(A_L)
-            T_R = A_to_Tm(A_R)
-            mat_TL = T_L.reshape(D**2,D**2)
-            mat_TR = T_R.reshape(D**2,D**2)
-            mat_eye = np.eye(D**2,D**2)
-            inv_TL = linalg.pinv(mat_eye-mat_TL).reshape(D,D,D,D)
-            inv_TR = linalg.pinv(mat_eye-mat_TR).reshape(D,D,D,D)
-            L_h = ncon([inv_TL, h_L],
-                       [[-1,-2,1,2], [1,2]])
-            R_h = ncon([inv_TR, h_R],
-                       [[-1,-2,1,2], [1,2]])
-        # L_h = sum_left(h_L, A_L, C,tol=delta/10)
-        else:
-            C_r = C.T
-            L_h = pinv_manual.sum_right_left(h_L, A_L, C_r, tol=delta / 10)
-            R_h = pinv_manual.sum_right_left(h_R, A_R, C, tol=delta / 10)
+        with tracer.stage('environments'):
+            e = evaluate_energy_two_sites(A_L, A_R, Ac, h_k)
+            e_eye = e * np.eye(d ** 2, d ** 2, dtype=h_k.dtype).reshape(d, d, d, d)
+            h_tilda = h_k - e_eye
+            # h_tilda = h
+            h_L = Al_h_to_hL(A_L, h_tilda)
+            h_R = Ar_h_to_h_R(A_R, h_tilda)
+            if pinv == 'scipy' or (pinv == 'auto' and D <= dense_pinv_max_D):
+                T_L = A_to_Tm(A_L)
+                T_R = A_to_Tm(A_R)
+                mat_TL = T_L.dense()
+                mat_TR = T_R.dense()
+                mat_eye = np.eye(D**2,D**2, dtype=mat_TL.dtype)
+                inv_TL = linalg.pinv(mat_eye-mat_TL).reshape(D,D,D,D)
+                inv_TR = linalg.pinv(mat_eye-mat_TR).reshape(D,D,D,D)
+                L_h = ncon([inv_TL, h_L],
+                           [[-1,-2,1,2], [1,2]])
+                R_h = ncon([inv_TR, h_R],
+                           [[-1,-2,1,2], [1,2]])
+            # L_h = sum_left(h_L, A_L, C,tol=delta/10)
+            else:
+                C_r = C.T
+                stats = {}
+                L_h = pinv_manual.sum_right_left(h_L, A_L, C_r, tol=precision_tol(env_tol, single), x0=L_h,
+                                                 stats=stats)
+                R_h = pinv_manual.sum_right_left(h_R, A_R, C, tol=precision_tol(env_tol, single), x0=R_h,
+                                                 stats=stats)
+                tracer.add(lgmres_iterations=stats['iterations'], lgmres_matvecs=stats['matvecs'])
         # print('linalg.norm(R_h-R_h.T)', linalg.norm(R_h-np.conj(R_h.T)))
         # print('R_h = ', R_h)
         # exit()
         # print(Ac.shape)
-        E_Ac, Ac = eigs(LinearOperator((D ** 2*d, D ** 2*d), matvec=map_Hac), k=1, which='SR',
-                v0=Ac.reshape(-1), tol=delta/10)
+        dtype = np.result_type(A_L, A_R, Ac, h_tilda, L_h, R_h)
+        with tracer.stage('eig_Ac'):
+            E_Ac, Ac = lowest_eigenpair(LinearOperator((D ** 2*d, D ** 2*d), dtype=dtype,
+                                                       matvec=tracer.counted('matvecs_Ac', control.counted('Ac', map_Hac))),
+                                        Ac.reshape(-1), precision_tol(eig_tol, single), **control.krylov('Ac', D**2*d))
+        with tracer.stage('eig_C'):
+            E_C, C = lowest_eigenpair(LinearOperator((D ** 2 , D ** 2 ), dtype=dtype,
+                                                     matvec=tracer.counted('matvecs_C', control.counted('C', map_Hc))),
+                                      C.reshape(-1), precision_tol(eig_tol, single), **control.krylov('C', D**2))
+        with tracer.stage('residuals'):
+            residuals = {'residual_Ac': eig_residual(map_Hac, E_Ac, Ac), 'residual_C': eig_residual(map_Hc, E_C, C)}
         Ac= Ac.reshape(D,d,D)
-        E_C, C = eigs(LinearOperator((D ** 2 , D ** 2 ), matvec=map_Hc), k=1, which='SR',
-                     v0=C.reshape(-1), tol=delta/10)
         C = C.reshape(D,D)
-        A_L, A_R = min_Ac_C(Ac,C)
-        Al_C =  ncon([A_L, C],
-                    [[-1, -2, 1], [1, -3]])
-        delta = linalg.norm(Ac-Al_C)
-
-        if count%5 == 0:
-            print(50*'-'+'steps',count, 50*'-')
-            print('energy = ', e)
-            print('delta = ', delta)
-            print('Eac = ', E_Ac)
-            print('Ec = ',E_C)
-            # print('Eac/Ec', E_Ac/E_C)
+        with tracer.stage('gauge'):
+            A_L, A_R, delta = min_Ac_C(Ac, C, tol=precision_tol(eta / 10, single))
+        if acceleration is not None:
+            with tracer.stage('acceleration'):
+                x, status = acceleration.update(x_in, [A_L, A_R, C], delta)
+                A_L, A_R, C, Ac = retract(*x)
+            tracer.add(extrapolated=status == 'extrapolated', rejected=status == 'rejected')
+        control.update(delta, e, residuals.values())
+        if single and (delta <= max(single_precision_delta, single_delta_min) or abs(e - e_memory) <= eta / 10):
+            single = False ## from the next iteration on
+            report_promotion(count, delta, t0)
+        if growing and control.stalled():
+            growing = False ## delta does not reach expand_delta at this bond dimension
+            print('bond dimension: delta stalled at ', delta, ', D = ', D, 'is kept')
+        if growing and delta < expand_delta:
+            with tracer.stage('bond'):
+                A_L, A_R, C, Ac, change = adapt_bond_dimension(A_L, A_R, C, Ac,
+                    lambda Ac2: two_site_h(Ac2, A_L, A_R, h_tilda, L_h, R_h), D_max, D_step, trunc_tol)
+            growing = change == 'expand'
+            if change is not None:
+                print('bond dimension: ', change, 'to D = ', A_L.shape[0])
+                D = A_L.shape[0]
+                L_h, R_h = None, None
+                delta = expand_delta
+                control.reset(delta)
+
+        tracer.end_iteration(count, energy=e, delta=delta, E_Ac=E_Ac, E_C=E_C, D=D, eig_tol=eig_tol,
+                             env_tol=env_tol, **residuals)
         count += 1
+        steps += 1
+        if callback is not None:
+            callback(count, delta, e)
+        if saver is not None:
+            saver.step(count, A_L=A_L, A_R=A_R, Ac=Ac, C=C, L_h=L_h, R_h=R_h,
+                       count=count, delta=delta, e=e, e_memory=e_memory)
+    if steps >= max_steps:
+        print('warning: stopped after max_steps = ', max_steps, 'iterations at delta = ', delta)
+    if saver is not None:
+        saver.close(A_L=A_L, A_R=A_R, Ac=Ac, C=C, L_h=L_h, R_h=R_h,
+                    count=count, delta=delta, e=e, e_memory=e_memory)
     print(50*'-'+' final '+50*'-')
     print('energy = ', e)
     return e, A_L, A_R, Ac, C, L_h, R_h
@@ -445,20 +954,44 @@ which means W[a,a] = 0 except for W[0,0] and W[d_w-1,d_w-1]
 Ref: Algorithm 6 in PRB 97, 045145 (2018)
 ##########################################################
 '''
+def two_site_mpo(Ac2, L_W, W, R_W):
+    '''Two site effective Hamiltonian of MPO VUMPS applied to Ac2 (D,d,d,D), for the subspace expansion'''
+    return ncon([L_W, Ac2, W, W, R_W],
+                [[-1,3,1], [1,5,6,2], [3,4,5,-2], [4,7,6,-3], [-4,7,2]])
+
 def Al_O_to_T_O(A_L, O):
-    T_O = ncon([A_L, O, np.conj(A_L)],
-               [[-4,1,-2], [1,2],[-3,2,-1]])
+    T_O = transfer.TransferOperator(A_L, O=O)
     return T_O
-def get_Lh_Rh_mpo(A_L, A_R, C,W):
-    d_w,_,_,_ = W.shape
+def get_Lh_Rh_mpo(A_L, A_R, C,W, tol=1e-8, stats=None, pool=None):
+    '''
+    :param W: MPO tensor or mpo.SparseMPO, only the nonzero blocks W[j,i] enter the recursion
+    :param tol: tolerance of the infinite sums (pinv_manual.sum_right_left)
+    :param stats: dict for the counters of the lgmres solves (see pinv_manual.sum_right_left)
+    :param pool: parallel.PairPool to compute L_W and R_W concurrently (None: one after the other)
+    L_W, R_W have the dtype of the tensors (real for real A_L, A_R, C and W, see Part 5)
+    '''
+    W = mpo.as_sparse(W)
+    dtype = np.result_type(A_L, A_R, C, W.W)
+    (L_W, e_Lw, stats_L), (R_W, e_Rw, stats_R) = parallel.run_pair(pool, left_environment_mpo, (A_L, C, W, tol, dtype),
+                                                                   right_environment_mpo, (A_R, C, W, tol, dtype))
+    if stats is not None:
+        for key in set(stats_L) | set(stats_R):
+            stats[key] = stats.get(key, 0) + stats_L.get(key, 0) + stats_R.get(key, 0)
+    # print(e_Rw, e_Lw)
+    return L_W, R_W, (e_Lw+e_Rw)/2
+
+def left_environment_mpo(A_L, C, W, tol, dtype):
+    ''':return: L_W, e_Lw, stats of the lgmres solve (left half of get_Lh_Rh_mpo, W a SparseMPO)'''
+    d_w = W.d_w
     D,d,_ = A_L.shape
-    L_W = np.zeros([d_w, D,D], dtype=complex)
+    stats = {}
+    T_L = transfer.TransferOperator(A_L) ## identity blocks
+    L_W = np.zeros([d_w, D,D], dtype=dtype)
     L_W[d_w-1] = np.eye(D,D)
     for i in range(d_w-2,-1,-1): # dw-2,dw-3,...,1,0
-        for j in range(i+1, d_w): # j>i: i+1,...d_w-1
-            # print(i,j)
-            L_W[i] += ncon([L_W[j], Al_O_to_T_O(A_L, W[j, i])],
-                           [[1,2],[-1,-2,1,2]]) # Lw[i] = Lw[j]T[j,i]
+        for j, c, O in W.left_terms(i): # nonzero W[j,i] with j>i
+            T = T_L if O is None else Al_O_to_T_O(A_L, O)
+            L_W[i] += c*T.apply(L_W[j]) # Lw[i] = Lw[j]T[j,i]
     C_r = C.T
     # exit()
     R = ncon([np.conj(C_r), C_r],
@@ -468,17 +1001,21 @@ def get_Lh_Rh_mpo(A_L, A_R, C,W):
     # print('e_test_Lw = ', e_test_Lw)
     e_Lw_eye = e_Lw*np.eye(D,D)
     L_W[0] -= e_Lw_eye
-    L_W[0] = pinv_manual.sum_right_left(L_W[0], A_L, C_r)
-
-    L_W = L_W.transpose([1,0,2])
-    R_W = np.zeros([d_w, D,D], dtype=complex)
+    L_W[0] = pinv_manual.sum_right_left(L_W[0], A_L, C_r, tol=tol, stats=stats)
+    return L_W.transpose([1,0,2]), e_Lw, stats
+
+def right_environment_mpo(A_R, C, W, tol, dtype):
+    ''':return: R_W, e_Rw, stats of the lgmres solve (right half of get_Lh_Rh_mpo, W a SparseMPO)'''
+    d_w = W.d_w
+    D,d,_ = A_R.shape
+    stats = {}
+    T_R = transfer.TransferOperator(A_R)
+    R_W = np.zeros([d_w, D,D], dtype=dtype)
     R_W[0] = np.eye(D,D)
     for i in range (1,d_w): # 1,2,...,dw-1
-        for j in range(i-1,-1,-1): # j<i: i-1,i-2,...,0
-            # print('i=',i,'j=',j)
-            R_W[i] += ncon([R_W[j], Al_O_to_T_O(A_R, W[i, j])],
-                           [[1,2], [-1,-2,1,2]]) # Rw[i] = T[i,j]R[j]
-    # exit()
+        for j, c, O in W.right_terms(i): # nonzero W[i,j] with j<i
+            T = T_R if O is None else Al_O_to_T_O(A_R, O)
+            R_W[i] += c*T.apply(R_W[j]) # Rw[i] = T[i,j]R[j]
     L = ncon([np.conj(C), C],
              [[1,-1],[1,-2]])
     e_Rw = ncon([L, R_W[d_w-1]], ## eqn (C27) in PRB 97, 045145 (2018)
@@ -486,11 +1023,8 @@ def get_Lh_Rh_mpo(A_L, A_R, C,W):
     e_Rw_eye = e_Rw * np.eye(D, D)
     # print('e_test_Rw = ', e_test_Rw)
     R_W[d_w - 1] -= e_Rw_eye
-    R_W[d_w-1] = pinv_manual.sum_right_left(R_W[d_w-1], A_R, C)
-
-    R_W = R_W.transpose([1,0,2])
-    # print(e_Rw, e_Lw)
-    return L_W, R_W, (e_Lw+e_Rw)/2
+    R_W[d_w-1] = pinv_manual.sum_right_left(R_W[d_w-1], A_R, C, tol=tol, stats=stats)
+    return R_W.transpose([1,0,2]), e_Rw, stats
 '''
 ##############################################################
 Final Algorithm for MPO VUMPS
@@ -498,55 +1032,124 @@ This function will largely use the previos defined functions
 Ref: Hao-Ti Hung's thesis p.26
 ##############################################################
 '''
-def vumps_mpo(W,A,eta = 1e-8):
+def vumps_mpo(W,A,eta = 1e-8, save_to = None, save_every = 10, resume_from = None, min_steps = 0, callback = None,
+              D_max = None, D_step = 4, expand_delta = 1e-4, trunc_tol = 1e-10, single_precision_delta = None,
+              tracer = None, acceleration = None, control = None, pool = None, max_steps = 10000):
+    '''
+    :param W: MPO tensor (d_w, d_w, d, d) or mpo.SparseMPO, Heff and the environments only use its nonzero blocks
+    :param save_to: checkpoint directory, written every save_every iterations (see checkpoint.py)
+    :param resume_from: checkpoint directory (or dict of the same arrays, e.g. a seed from sweep.py)
+                        to continue from (A is not used then)
+    :param min_steps: minimal number of iterations (the controller alone decides by default)
+    :param callback: called as callback(count, delta, e) after every iteration
+    :param D_max: adaptive bond dimension (None: D fixed by A). Whenever delta < expand_delta,
+                  the bond is truncated to the Schmidt values S/S[0] >= trunc_tol if there are
+                  smaller ones, otherwise expanded by D_step states (up to D_max), see Part 3
+    :param single_precision_delta: mixed precision (None: double precision only). While
+                  delta > single_precision_delta the iterations run in single precision, see Part 4
+    :param tracer: instrument.Tracer which records every iteration (default: print every 5 steps)
+    :param acceleration: anderson.Anderson to extrapolate A_L, A_R, C from the previous iterates
+                  (None: plain fixed-point iteration), see Part 7
+    :param control: controller.Controller which sets the tolerances of the eigensolvers and the
+                  environments and decides when to stop (default: Controller(eta)), see controller.py
+    :param pool: parallel.PairPool to solve the left/right environments and the Ac/C eigenproblems
+                  concurrently (None: one after the other), see Part 8; bit-identical to pool=None
+                  only with the same number of BLAS threads in this process and in the workers
+    :param max_steps: hard limit of the number of iterations (restarts included)
+    '''
     print('>'*100)
     print('VUMPS for MPO begin!')
+    tracer = instrument.Tracer() if tracer is None else tracer
+    tracer.begin('vumps_mpo')
+    control = controller.Controller(eta) if control is None else control
+    if acceleration is not None:
+        acceleration.reset()
+    W_sparse = mpo.as_sparse(W if isinstance(W, mpo.SparseMPO) else real_if_real(W))
+    W = W_sparse.W
+    W_single = mpo.SparseMPO(to_precision(True, W)[0]) if single_precision_delta is not None else None
     def map_Hac(Ac):
-        Ac = Ac.reshape(D,d,D)
-        # e_eye = energy* np.eye(d ** 2, d ** 2).reshape(d, d, d, d)
-        Ac_new = ncon([L_W,Ac,W,R_W],
-                      [[-1,3,1],[1,5,2],[3,4,5,-2],[-3,4,2]])
-        return Ac_new.reshape(-1)
+        return apply_Hac(L_W, W_k, R_W, Ac)
     def map_Hc(C):
-        C= C.reshape(D,D)
-        C_new = ncon([L_W,C,R_W],
-                     [[-1,3,1],[1,2],[-2,3,2]])
-        return C_new.reshape(-1)
-    D, d, _ = A.shape
-    lam, gamma = A_to_lam_gamma(A)
-    lam, gamma = lam_gamma_to_canonical(lam, gamma)
-    A_L, A_R = canonical_to_Al_Ar(lam, gamma)
-    C = lam
-    Ac = ncon([A_L, C],
-              [[-1, -2, 1], [1, -3]])
-    delta = eta * 1000
-    e_memory = -1
-    e = 0
-    count = 0
-
-    while (delta > eta and abs(e - e_memory) > eta / 10) or count <15:
-        L_W, R_W, energy = get_Lh_Rh_mpo(A_L,A_R,C,W)
-        E_Ac, Ac = eigs(LinearOperator((D ** 2 * d, D ** 2 * d), matvec=map_Hac), k=1, which='SR',
-                        v0=Ac.reshape(-1), tol=delta / 10)
+        return apply_Hc(L_W, R_W, C)
+    if resume_from is None:
+        A_L, A_R, C, Ac = canonical_form(A)
+        delta = eta * 1000
+        e_memory = -1
+        e = 0
+        count = 0
+    else:
+        state = checkpoint.load_state(resume_from)
+        A_L, A_R, C, Ac, L_W, R_W = [state.get(key) for key in ['A_L', 'A_R', 'C', 'Ac', 'L_W', 'R_W']]
+        delta, e, e_memory, count = [state[key] for key in ['delta', 'e', 'e_memory', 'count']]
+        if not isinstance(resume_from, dict):
+            print('resume from ', resume_from, 'at step ', count)
+    D, d, _ = A_L.shape
+    control.reset(None if resume_from is None else delta)
+    saver = None if save_to is None else checkpoint.Checkpoint(save_to, save_every)
+    growing = D_max is not None
+    single = single_precision_delta is not None
+    t0 = time.time()
+    steps = 0
+    while (not control.converged() or count < min_steps or growing or single) and steps < max_steps:
+        A_L, A_R, C, Ac = to_precision(single, A_L, A_R, C, Ac)
+        tracer.add(single=single)
+        x_in = [A_L, A_R, C]
+        eig_tol, env_tol = control.eig_tol(), control.env_tol()
+        W_k = W_single if single else W_sparse
+        with tracer.stage('environments'):
+            stats = {}
+            L_W, R_W, energy = get_Lh_Rh_mpo(A_L,A_R,C,W_k, tol=precision_tol(env_tol, single), stats=stats,
+                                             pool=pool)
+            tracer.add(lgmres_iterations=stats['iterations'], lgmres_matvecs=stats['matvecs'])
+        tol = precision_tol(eig_tol, single)
+        (E_Ac, Ac, stats_Ac), (E_C, C, stats_C) = parallel.run_pair(
+            pool, solve_Ac, (L_W, W_k, R_W, Ac, tol, control.krylov('Ac', D**2*d)),
+            solve_C, (L_W, R_W, C, tol, control.krylov('C', D**2)))
+        count_eigensolvers(tracer, control, stats_Ac, stats_C)
+        with tracer.stage('residuals'):
+            residuals = {'residual_Ac': eig_residual(map_Hac, E_Ac, Ac), 'residual_C': eig_residual(map_Hc, E_C, C)}
         Ac = Ac.reshape(D, d, D)
-        E_C, C = eigs(LinearOperator((D ** 2, D ** 2), matvec=map_Hc), k=1, which='SR',
-                      v0=C.reshape(-1), tol=delta / 10)
         C = C.reshape(D, D)
         e_memory = e
         e = energy
-        A_L, A_R = min_Ac_C(Ac, C)
-        Al_C = ncon([A_L, C],
-                    [[-1, -2, 1], [1, -3]])
-        delta = linalg.norm(Ac - Al_C)
-        if count % 5 == 0:
-            print(50 * '-' + 'steps', count, 50 * '-')
-            print('energy = ', e)
-            print('delta = ', delta)
-            print('Eac = ', E_Ac)
-            print('Ec = ', E_C)
-            print('Eac-Ec = ', E_Ac-E_C)
-            print('Eac/Ec = ', E_Ac/E_C)
+        with tracer.stage('gauge'):
+            A_L, A_R, delta = min_Ac_C(Ac, C, tol=precision_tol(eta / 10, single))
+        if acceleration is not None:
+            with tracer.stage('acceleration'):
+                x, status = acceleration.update(x_in, [A_L, A_R, C], delta)
+                A_L, A_R, C, Ac = retract(*x)
+            tracer.add(extrapolated=status == 'extrapolated', rejected=status == 'rejected')
+        control.update(delta, e, residuals.values())
+        if single and (delta <= max(single_precision_delta, single_delta_min) or abs(e - e_memory) <= eta / 10):
+            single = False ## from the next iteration on
+            report_promotion(count, delta, t0)
+        if growing and control.stalled():
+            growing = False ## delta does not reach expand_delta at this bond dimension
+            print('bond dimension: delta stalled at ', delta, ', D = ', D, 'is kept')
+        if growing and delta < expand_delta:
+            with tracer.stage('bond'):
+                A_L, A_R, C, Ac, change = adapt_bond_dimension(A_L, A_R, C, Ac,
+                    lambda Ac2: two_site_mpo(Ac2, L_W, W, R_W), D_max, D_step, trunc_tol)
+            growing = change == 'expand'
+            if change is not None:
+                print('bond dimension: ', change, 'to D = ', A_L.shape[0])
+                D = A_L.shape[0]
+                delta = expand_delta
+                control.reset(delta)
+        tracer.end_iteration(count, energy=e, delta=delta, E_Ac=E_Ac, E_C=E_C, D=D, eig_tol=eig_tol,
+                             env_tol=env_tol, **residuals)
         count += 1
+        steps += 1
+        if callback is not None:
+            callback(count, delta, e)
+        if saver is not None:
+            saver.step(count, A_L=A_L, A_R=A_R, Ac=Ac, C=C, L_W=L_W, R_W=R_W,
+                       count=count, delta=delta, e=e, e_memory=e_memory)
+    if steps >= max_steps:
+        print('warning: stopped after max_steps = ', max_steps, 'iterations at delta = ', delta)
+    if saver is not None:
+        saver.close(A_L=A_L, A_R=A_R, Ac=Ac, C=C, L_W=L_W, R_W=R_W,
+                    count=count, delta=delta, e=e, e_memory=e_memory)
     print(50 * '-' + ' final ' + 50 * '-')
     print('delta = ', delta)
     print('energy = ', e)
@@ -565,82 +1168,180 @@ vumps_fixed_points
 def A_W_to_Tw(A_L, W):
     '''Get T_Wl or T_Wr
     See eqn(250) in arXiv:1810.07006v3'''
-    T_W = ncon([A_L, W, np.conj(A_L)],
-                [[-6,1,-3], [-5,-2,1,2], [-4,2,-1]])
+    T_W = transfer.TransferOperator(A_L, W=W)
     return T_W
 
-def fixed_boundary(A_L,W,eta = 1e-8):
+def fixed_boundary(A_L,W,eta = 1e-8, v0 = None, maxiter = None, stats = None):
+    '''
+    Dominant eigenvector of T_W, which is applied matrix-free in O(D^3 d_w d^2)
+    :param v0: initial guess, e.g. Lw/Rw of the previous iteration
+    :param maxiter: maximal number of Arnoldi restarts
+    :param stats: dict, the number of T_W applications is added to stats['matvecs']
+    :return: lam, Lw, info (info = 0: converged, 1: not converged and the
+    best Ritz pair of Arnoldi is returned)
+    '''
     d_w, _, _, _ = W.shape
     D, d, _ = A_L.shape
     T_W = A_W_to_Tw(A_L,W)
-    T_W = T_W.reshape(D**2*d_w,D**2*d_w)
-    lam, Lw = eigs(T_W, k=1, which='LM',tol=eta)
+    v0 = parallel.start_vector(T_W.size, T_W.dtype) if v0 is None else v0.reshape(-1)
+    info = 0
+    T_op = T_W.linear_operator(dtype=v0.dtype)
+    if stats is not None:
+        def matvec(x):
+            stats['matvecs'] = stats.get('matvecs', 0) + 1
+            return T_W.apply(x).reshape(-1)
+        T_op = LinearOperator(T_op.shape, matvec=matvec, dtype=T_op.dtype)
+    try:
+        lam, Lw = eigs(T_op, k=1, which='LM',tol=eta,
+                       v0=v0, maxiter=maxiter)
+    except ArpackNoConvergence as err:
+        if len(err.eigenvalues) == 0:
+            raise
+        lam, Lw = err.eigenvalues, err.eigenvectors
+        info = 1
     Lw = Lw.reshape(D,d_w,D)
-    return lam, Lw
+    return lam, Lw, info
+
+def fixed_boundary_counted(A_L, W, eta, v0):
+    ''':return: lam, Lw, info of fixed_boundary and its stats (for parallel.run_pair)'''
+    stats = {}
+    return fixed_boundary(A_L, W, eta, v0=v0, stats=stats) + (stats,)
 
 def overlap_fixed_boundary(Lw,Rw,C):
     overlap = ncon([Lw,C,Rw,np.conj(C)],
                    [[4,3,1], [1,2], [5,3,2], [4,5]])
     return overlap
 
-def vumps_fixed_points(W,A,eta=1e-8):
+def vumps_fixed_points(W,A,eta=1e-8, save_to = None, save_every = 10, resume_from = None, min_steps = 0,
+                       callback = None, D_max = None, D_step = 4, expand_delta = 1e-4, trunc_tol = 1e-10,
+                       single_precision_delta = None, tracer = None, acceleration = None, control = None,
+                       pool = None, max_steps = 10000):
+    '''
+    :param save_to: checkpoint directory, written every save_every iterations (see checkpoint.py)
+    :param resume_from: checkpoint directory (or dict of the same arrays, e.g. a seed from sweep.py)
+                        to continue from (A is not used then)
+    :param min_steps: minimal number of iterations (the controller alone decides by default)
+    :param callback: called as callback(count, delta, lam1) after every iteration
+    :param D_max: adaptive bond dimension (None: D fixed by A). Whenever delta < expand_delta,
+                  the bond is truncated to the Schmidt values S/S[0] >= trunc_tol if there are
+                  smaller ones, otherwise expanded by D_step states (up to D_max), see Part 3
+    :param single_precision_delta: mixed precision (None: double precision only). While
+                  delta > single_precision_delta the iterations run in single precision, see Part 4
+    :param tracer: instrument.Tracer which records every iteration (default: print every 10 steps)
+    :param acceleration: anderson.Anderson to extrapolate A_L, A_R, C from the previous iterates
+                  (None: plain fixed-point iteration), see Part 7
+    :param control: controller.Controller which sets the tolerances of the eigensolvers and the
+                  environments and decides when to stop (default: Controller(eta)), see controller.py
+    :param pool: parallel.PairPool to solve the left/right environments and the Ac/C eigenproblems
+                  concurrently (None: one after the other), see Part 8; bit-identical to pool=None
+                  only with the same number of BLAS threads in this process and in the workers
+    :param max_steps: hard limit of the number of iterations (restarts included)
+    '''
+    tracer = instrument.Tracer(printer=instrument.Printer(every=10)) if tracer is None else tracer
+    tracer.begin('vumps_fixed_points')
+    control = controller.Controller(eta) if control is None else control
+    if acceleration is not None:
+        acceleration.reset()
     def map_Hac(Ac):
-        Ac = Ac.reshape(D,d,D)
-        Ac_new = ncon([Lw,Ac,W,Rw],
-                      [[-1,3,1],[1,5,2],[3,4,5,-2],[-3,4,2]])/lam1
-        return Ac_new.reshape(-1)
+        return apply_Hac(Lw, W_k, Rw, Ac, lam1)
     def map_Hc(C):
-        C= C.reshape(D,D)
-        C_new = ncon([Lw,C,Rw],
-                     [[-1,3,1],[1,2],[-2,3,2]])
-        return C_new.reshape(-1)
-    D, d, _ = A.shape
-    lam, gamma = A_to_lam_gamma(A)
-    lam, gamma = lam_gamma_to_canonical(lam, gamma)
-    A_L, A_R = canonical_to_Al_Ar(lam, gamma)
-    C = lam
-    Ac = ncon([A_L, C],
-              [[-1, -2, 1], [1, -3]])
-    delta = eta * 1000
-    count = 0
-
-    while (delta > eta) or count <15:
-        lam1, Lw = fixed_boundary(A_L,W,delta/10)
-        W_r = W.transpose([1, 0, 2, 3])
-        lam2, Rw = fixed_boundary(A_R, W_r, delta/10)
+        return apply_Hc(Lw, Rw, C)
+    if resume_from is None:
+        A_L, A_R, C, Ac = canonical_form(A)
+        delta = eta * 1000
+        count = 0
+        Lw, Rw = None, None
+    else:
+        state = checkpoint.load_state(resume_from)
+        A_L, A_R, C, Ac, Lw, Rw = [state.get(key) for key in ['A_L', 'A_R', 'C', 'Ac', 'Lw', 'Rw']]
+        delta, count, lam1 = state['delta'], state['count'], state.get('lam1')
+        if not isinstance(resume_from, dict):
+            print('resume from ', resume_from, 'at step ', count)
+    D, d, _ = A_L.shape
+    control.reset(None if resume_from is None else delta)
+    saver = None if save_to is None else checkpoint.Checkpoint(save_to, save_every)
+    W_r = W.transpose([1, 0, 2, 3])
+    growing = D_max is not None
+    single = single_precision_delta is not None
+    t0 = time.time()
+    steps = 0
+    while (not control.converged() or count < min_steps or growing or single) and steps < max_steps:
+        A_L, A_R, C, Ac, Lw, Rw, W_k, W_r_k = to_precision(single, A_L, A_R, C, Ac, Lw, Rw, W, W_r)
+        tracer.add(single=single)
+        x_in = [A_L, A_R, C]
+        eig_tol, env_tol = control.eig_tol(), control.env_tol()
+        with tracer.stage('environments'):
+            tol = precision_tol(env_tol, single)
+            (lam1, Lw, info_L, stats_L), (lam2, Rw, info_R, stats_R) = parallel.run_pair(
+                pool, fixed_boundary_counted, (A_L, W_k, tol, Lw), fixed_boundary_counted, (A_R, W_r_k, tol, Rw))
+            tracer.add(matvecs_env=stats_L['matvecs'] + stats_R['matvecs'])
+        if info_L != 0 or info_R != 0:
+            print('fixed_boundary did not converge: info_L = ', info_L, 'info_R = ', info_R)
 
         norm = overlap_fixed_boundary(Lw,Rw,C)
         Lw = Lw/norm
-        lam_Ac, Ac = eigs(LinearOperator((D ** 2 * d, D ** 2 * d), matvec=map_Hac), k=1, which='LM',
-                        v0=Ac.reshape(-1), tol=delta / 10)
+        tol = precision_tol(eig_tol, single)
+        (lam_Ac, Ac, stats_Ac), (lam_C, C, stats_C) = parallel.run_pair(
+            pool, solve_Ac, (Lw, W_k, Rw, Ac, tol, control.krylov('Ac', D**2*d), 'LM', lam1),
+            solve_C, (Lw, Rw, C, tol, control.krylov('C', D**2), 'LM'))
+        count_eigensolvers(tracer, control, stats_Ac, stats_C)
+        with tracer.stage('residuals'):
+            residuals = {'residual_Ac': eig_residual(map_Hac, lam_Ac, Ac), 'residual_C': eig_residual(map_Hc, lam_C, C)}
         Ac = Ac.reshape(D, d, D)
-        lam_C, C = eigs(LinearOperator((D ** 2, D ** 2), matvec=map_Hc), k=1, which='LM',
-                      v0=C.reshape(-1), tol=delta / 10)
         C = C.reshape(D, D)
         # print('lam_Ac = ', lam_Ac)
         # print('lam_C = ', lam_C)
-        A_L, A_R = min_Ac_C(Ac, C)
-        Al_C = ncon([A_L, C],
-                    [[-1, -2, 1], [1, -3]])
-        delta = linalg.norm(Ac - Al_C)
-
-        if count % 10 == 0:
-            print(50 * '-' + 'steps', count, 50 * '-')
-            print('delta = ', delta)
-            print('lam1 = ', lam1)
-            print('lam2 = ', lam2)
-            print('norm = ', norm)
+        with tracer.stage('gauge'):
+            A_L, A_R, delta = min_Ac_C(Ac, C, tol=precision_tol(eta / 10, single))
+        if acceleration is not None:
+            with tracer.stage('acceleration'):
+                x, status = acceleration.update(x_in, [A_L, A_R, C], delta)
+                A_L, A_R, C, Ac = retract(*x)
+            tracer.add(extrapolated=status == 'extrapolated', rejected=status == 'rejected')
+        control.update(delta, lam1, residuals.values())
+        if single and (delta <= max(single_precision_delta, single_delta_min) or
+                       control.energy_change() <= eta / 10 or control.stalled()):
+            single = False ## from the next iteration on
+            report_promotion(count, delta, t0)
+        if growing and control.stalled():
+            growing = False ## delta does not reach expand_delta at this bond dimension
+            print('bond dimension: delta stalled at ', delta, ', D = ', D, 'is kept')
+        if growing and delta < expand_delta:
+            with tracer.stage('bond'):
+                A_L, A_R, C, Ac, change = adapt_bond_dimension(A_L, A_R, C, Ac,
+                    lambda Ac2: two_site_mpo(Ac2, Lw, W, Rw), D_max, D_step, trunc_tol)
+            growing = change == 'expand'
+            if change is not None:
+                print('bond dimension: ', change, 'to D = ', A_L.shape[0])
+                D = A_L.shape[0]
+                Lw, Rw = None, None
+                delta = expand_delta
+                control.reset(delta)
+
+        tracer.end_iteration(count, delta=delta, lam1=lam1, lam2=lam2, norm=norm, E_Ac=lam_Ac, E_C=lam_C, D=D,
+                             eig_tol=eig_tol, env_tol=env_tol, **residuals)
         count += 1
+        steps += 1
+        if callback is not None:
+            callback(count, delta, lam1)
         if count > 200 and delta > 1e-3:
             A = np.random.rand(D,d,D)
-            lam, gamma = A_to_lam_gamma(A)
-            lam, gamma = lam_gamma_to_canonical(lam, gamma)
-            A_L, A_R = canonical_to_Al_Ar(lam, gamma)
-            C = lam
-            Ac = ncon([A_L, C],
-                      [[-1, -2, 1], [1, -3]])
+            A_L, A_R, C, Ac = canonical_form(A)
             delta = eta * 1000
             count = 0
+            Lw, Rw = None, None
+            tracer.add(restarts=1)
+            control.reset()
+            if acceleration is not None:
+                acceleration.reset()
+        elif saver is not None:
+            saver.step(count, A_L=A_L, A_R=A_R, Ac=Ac, C=C, Lw=Lw, Rw=Rw, lam1=lam1,
+                       count=count, delta=delta)
+    if steps >= max_steps:
+        print('warning: stopped after max_steps = ', max_steps, 'iterations at delta = ', delta)
+    if saver is not None:
+        saver.close(A_L=A_L, A_R=A_R, Ac=Ac, C=C, Lw=Lw, Rw=Rw, lam1=lam1,
+                    count=count, delta=delta)
     print('delta = ', delta)
     print('converge!')
     return lam1, Ac, C, A_L, A_R, Lw, Rw
@@ -652,13 +1353,11 @@ Excitation Part
 def get_T_RLw_or_T_LRw(A_R, W, A_L):
     '''Thie is ued in [quasiparticle_correct], which should be the correct transfer
     matrix to be used'''
-    T_RL = ncon([A_R,W,np.conj(A_L)],
-                [[-3,2,-6],[-5,-2,2,1], [-4,1,-1]])
+    T_RL = transfer.TransferOperator(A_R.transpose([2,1,0]), A_L, W=W)
     return T_RL
 
 def get_T_RL_or_T_LR(A_R,A_L):
-    T_RL = ncon([A_R, np.conj(A_L)],
-                [[-2,1,-4],[-3,1,-1]])
+    T_RL = transfer.TransferOperator(A_R.transpose([2,1,0]), A_L)
     return T_RL
 
 def combine_LBWA_L(L_W, B, W, A_L):
@@ -671,106 +1370,236 @@ def combine_RBWA_R(R_W, B, W, A_R):
                   [[1,2,3],[-3,5,3],[-2,2,5,4],[1,4,-1]])
     return RBWA_R
 
-def quasiparticle_mpo(W, p, A_L, A_R, L_W, R_W, num_of_excite=1, system ='1D', pinv = 'scipy'):
+def quasiparticle_mpo_setup(W, A_L, A_R, L_W, R_W, pinv = 'scipy', precondition = 0, tol = 1e-6, pool = None):
     '''
-    Corrected version of quasiparticle.
-    :param W: MPO
-    :param p: momentum
-    :param A_L: Used to get mpo transfer matrix and LBWA_L
-    :param A_R: Used to get mpo transfer matrix and RBWA_R
-    :param L_W: Left fixed point of MPO, which is obtained from vumps_mpo.
-    :param R_W: Right fixed point of MPO, which is obtained from vumps_mpo.
-    :return: omega and X
+    Everything in quasiparticle_mpo which does not depend on the momentum p:
+    transfer matrices T_RL/T_LR (dense in scipy mode, Schur decomposed in spectral mode),
+    their fixed points (manual mode)
+    and the null space V_L of A_L.
+    :param tol: tolerance of the eigensolver, the lgmres solves inside its matvec use tol/100
+    :param pool: parallel.PairPool to find the fixed points of T_RL and T_LR concurrently (manual mode)
+    :return: dict which is passed to quasiparticle_mpo_solve for every momentum
     '''
     T_RL = get_T_RLw_or_T_LRw(A_R, W, A_L)
-    D,dw = T_RL.shape[0], T_RL.shape[1]
-
-    # test = inv_T_RL@(mat_eye-mat_T_RL)
-    # print(np.around(test))
-    # exit()
     W_r = W.transpose([1, 0, 2, 3])
     T_LR = get_T_RLw_or_T_LRw(A_L, W_r, A_R)
+    context = {'W': W, 'A_L': A_L, 'A_R': A_R, 'L_W': L_W, 'R_W': R_W, 'T_RL': T_RL, 'T_LR': T_LR,
+               'pinv': pinv, 'precondition': precondition, 'tol': tol}
+    if pinv == 'scipy':
+        context['mat_T_RL'] = T_RL.dense()
+        context['mat_T_LR'] = T_LR.dense()
+    elif pinv == 'spectral':
+        context['schur_RL'] = pinv_manual.schur_transfer(T_RL)
+        context['schur_LR'] = pinv_manual.schur_transfer(T_LR)
+    else:
+        (context['r_L'], context['l_L']), (context['l_R'], context['r_R']) = parallel.run_pair(
+            pool, pinv_manual.Tw_to_rl, (T_RL,), pinv_manual.Tw_to_rl, (T_LR,))
+    D, d, _ = A_L.shape
+    A_tmp = A_L.reshape(D * d, D).T
+    V_L = linalg.null_space(A_tmp)
+    context['V_L'] = V_L.reshape(D, d, D*(d-1))
+    return context
 
-    # T_RL *= np.exp(-1j * p)
-    # T_LR *= np.exp(1j * p)
+def quasiparticle_mpo_map(context, p):
+    '''
+    Effective Hamiltonian of the excitations at momentum p with the objects of quasiparticle_mpo_setup
+    :return: map_effective_H (X -> H_eff X on flat vectors of size D^2 (d-1), or on blocks of them
+             with shape (D^2 (d-1), b), which turns the contractions into matrix-matrix products;
+             the lgmres solves of the manual pinv still run one vector at a time),
+             the lgmres solvers (solver_L, solver_R), None for the scipy and spectral pinv
+    '''
+    W, A_L, A_R, L_W, R_W = [context[key] for key in ['W', 'A_L', 'A_R', 'L_W', 'R_W']]
+    pinv, V_L = context['pinv'], context['V_L']
+    D,dw = context['T_RL'].vshape[0], context['T_RL'].vshape[1]
     if pinv == 'scipy':
-        mat_T_RL = T_RL.reshape(D ** 2 * dw, -1) * np.exp(-1j * p)
+        mat_T_RL = context['mat_T_RL'] * np.exp(-1j * p)
         mat_eye = np.eye(D ** 2 * dw, D ** 2 * dw)
-        # print(mat_T_RL.shape)
         inv_T_RL = linalg.pinv(mat_eye - mat_T_RL).reshape([D, dw, D] * 2)
-        mat_T_LR = T_LR.reshape(D ** 2 * dw, -1) * np.exp(1j * p)
-        # print(mat_T_RL.shape)
+        mat_T_LR = context['mat_T_LR'] * np.exp(1j * p)
         inv_T_LR = linalg.pinv(mat_eye - mat_T_LR).reshape([D, dw, D] * 2)
-        print('hello')
+    elif pinv == 'spectral':
+        pinv_T_RL = pinv_manual.schur_pinv(context['schur_RL'], np.exp(-1j * p))
+        pinv_T_LR = pinv_manual.schur_pinv(context['schur_LR'], np.exp(1j * p))
     else:
-        r_L, l_L = pinv_manual.Tw_to_rl(T_RL)
-        l_R, r_R = pinv_manual.Tw_to_rl(T_LR)
-        T_RL *= np.exp(-1j * p)
-        T_LR *= np.exp(1j * p)
+        T_RL = context['T_RL'] * np.exp(-1j * p)
+        T_LR = context['T_LR'] * np.exp(1j * p)
+        solver_L = pinv_manual.TransferSolver(T_RL, context['r_L'], context['l_L'], tol=context['tol'] / 100,
+                                              precondition=context['precondition'])
+        solver_R = pinv_manual.TransferSolver(T_LR, context['l_R'], context['r_R'], tol=context['tol'] / 100,
+                                              precondition=context['precondition'])
     D, d, _ = A_L.shape
-    A_tmp = A_L.reshape(D * d, D).T
-    V_L = linalg.null_space(A_tmp)
-    V_L = V_L.reshape(D, d, D*(d-1))
     def map_effective_H(X):
-        X = X.reshape(D*(d-1),D)
+        shape = X.shape
+        X = X.reshape(D*(d-1),D,-1) ## the last leg runs over the vectors of a block
         B = ncon([V_L,X],
-                 [[-1,-2,1],[1,-3]])
-        LBWA_L = combine_LBWA_L(L_W, B, W, A_L)
-        RBWA_R = combine_RBWA_R(R_W, B, W, A_R)
+                 [[-1,-2,1],[1,-3,-4]])
+        LBWA_L = ncon([L_W, B, W, np.conj(A_L)],
+                      [[1,2,3],[3,5,-3,-4],[2,-2,5,4],[1,4,-1]])
+        RBWA_R = ncon([R_W,B,W,np.conj(A_R)],
+                      [[1,2,3],[-3,5,3,-4],[-2,2,5,4],[1,4,-1]])
         if pinv == 'scipy':
             L_B = ncon([inv_T_RL, LBWA_L],
-                       [[-1,-2,-3,1,2,3], [1,2,3]])
+                       [[-1,-2,-3,1,2,3], [1,2,3,-4]])
             R_B = ncon([inv_T_LR, RBWA_R],
-                       [[-1,-2,-3,1,2,3], [1,2,3]])
+                       [[-1,-2,-3,1,2,3], [1,2,3,-4]])
+        elif pinv == 'spectral':
+            L_B = pinv_T_RL(LBWA_L)
+            R_B = pinv_T_LR(RBWA_R)
         else:
-            L_B = pinv_manual.quasi_sum_right_left_mpo(T_RL, r_L, l_L, LBWA_L)
-            R_B = pinv_manual.quasi_sum_right_left_mpo(T_LR, l_R, r_R, RBWA_R)
+            L_B = np.stack([solver_L.solve(x) for x in np.moveaxis(LBWA_L, -1, 0)], axis=-1)
+            R_B = np.stack([solver_R.solve(x) for x in np.moveaxis(RBWA_R, -1, 0)], axis=-1)
         term1 = np.exp(-1j*p)*ncon([L_B,A_R,W,R_W],
-                                    [[-1,1,2],[4,5,2],[1,3,5,-2],[-3,3,4]])
+                                    [[-1,1,2,-4],[4,5,2],[1,3,5,-2],[-3,3,4]])
         term2 = np.exp(1j*p)*ncon([L_W,A_L,W,R_B],
-                                  [[-1,1,2],[2,5,4],[1,3,5,-2],[-3,3,4]])
+                                  [[-1,1,2],[2,5,4],[1,3,5,-2],[-3,3,4,-4]])
         term3 = ncon([L_W,B,W,R_W],
-                     [[-1,1,2],[2,5,4],[1,3,5,-2],[-3,3,4]])
+                     [[-1,1,2],[2,5,4,-4],[1,3,5,-2],[-3,3,4]])
         Teff_B = term1+term2+term3
         Teff_X = ncon([Teff_B, np.conj(V_L)],
-                      [[1,2,-2],[1,2,-1]])
-        return Teff_X.reshape(-1)
+                      [[1,2,-2,-3],[1,2,-1]])
+        return Teff_X.reshape(shape)
+    if pinv in ['scipy', 'spectral']:
+        return map_effective_H, None
+    return map_effective_H, (solver_L, solver_R)
+
+## which and hermitian of the block eigensolver per system
+BLOCK_SPECTRUM = {'1D': ('SR', True), 'AKLT': ('BE', True), '2D': ('LM', False), 'RVB': ('LM', False)}
+
+def quasiparticle_mpo_solve(context, p, num_of_excite=1, system ='1D', block=False, X0=None):
+    '''
+    Solve the excitations at momentum p with the objects of quasiparticle_mpo_setup
+    For system='AKLT' both ends of the spectrum come from one Krylov space (krylov.arnoldi_both_ends),
+    instead of one eigsh run for 'LA' and one for 'SA'
+    :param block: block eigensolver (krylov.block_davidson) instead of eigsh/eigs: H_eff is applied
+                  to blocks of vectors, and it can start from the eigenvectors X0 of a neighbouring momentum
+    :param X0: initial eigenvectors for block=True, shape (D*(d-1), D, b) (default: a fixed random block)
+    :return: omega and X (the first eigenvector, shape (D*(d-1), D); for block=True all of them,
+             shape (D*(d-1), D, num_of_excite) or 2*num_of_excite for system='AKLT', ordered as omega)
+    '''
+    map_effective_H, solvers = quasiparticle_mpo_map(context, p)
+    D, d, _ = context['A_L'].shape
+    tol = context['tol']
+    v0 = parallel.start_vector(D ** 2 * (d - 1)) ## the same start in every process, see parallel.py
+    matvecs = [0]
+    def map_counted(X):
+        matvecs[0] += 1
+        return map_effective_H(X)
+    H_eff = LinearOperator((D ** 2 * (d - 1), D ** 2 * (d - 1)), matvec=map_counted)
     # omega, X = eigs(LinearOperator((D ** 2*(d-1), D ** 2*(d-1)), matvec=map_effective_H), k=10, which='SR', tol=1e-6)
-    if system == '1D':
-        omega, X = eigsh(LinearOperator((D ** 2*(d-1), D ** 2*(d-1)), matvec=map_effective_H), k=num_of_excite, which='SA', tol=1e-6)
+    if block:
+        omega, X, matvecs[0] = quasiparticle_block_solve(map_effective_H, D ** 2 * (d - 1), num_of_excite, system,
+                                                         tol, X0)
+    elif system == '1D':
+        omega, X = eigsh(H_eff, k=num_of_excite, which='SA', tol=tol, v0=v0)
     elif system == 'AKLT':
-        # omega, X = eigs(LinearOperator((D ** 2 * (d - 1), D ** 2 * (d - 1)), matvec=map_effective_H), k=num_of_excite, which='LM',
-        #                 tol=1e-6)
-        omega1, X = eigsh(LinearOperator((D ** 2 * (d - 1), D ** 2 * (d - 1)), matvec=map_effective_H), k=num_of_excite,
-                         which='LA', tol=1e-6)
-        # print('omega1 = ', omega1)
-        omega2, X = eigsh(LinearOperator((D ** 2 * (d - 1), D ** 2 * (d - 1)), matvec=map_effective_H), k=num_of_excite,
-                          which='SA', tol=1e-6)
-        # print('omega2 = ', omega2)
-        omega = np.hstack((omega1, omega2))
-    elif system == '2D':
-        omega, X = eigs(LinearOperator((D ** 2 * (d - 1), D ** 2 * (d - 1)), matvec=map_effective_H), k=num_of_excite,
-                        which='LM', tol=1e-6)
+        ## ascending real part: the num_of_excite smallest, then the num_of_excite largest
+        omega, X, converged = krylov.arnoldi_both_ends(map_counted, v0, num_of_excite, tol=tol)
+        if not converged:
+            print('warning: excitations at p = ', p, ' not converged')
+    elif system in ['2D', 'RVB']:
+        omega, X = eigs(H_eff, k=num_of_excite, which='LM', tol=tol, v0=v0)
+    if system == 'AKLT':
+        omega = np.hstack((omega[num_of_excite:], omega[:num_of_excite])).real
+        if block:
+            X = np.hstack((X[:, num_of_excite:], X[:, :num_of_excite]))
+    print('effective H matvecs = ', matvecs[0])
+    context['matvecs'] = context.get('matvecs', 0) + matvecs[0]
+    if solvers is not None:
+        solvers[0].report('L_B solver')
+        solvers[1].report('R_B solver')
+    if block:
+        return omega, X.reshape(D*(d-1),D,-1)
     X = X[:,0].reshape(D*(d-1),D)
-    B = ncon([V_L, X],
-             [[-1, -2, 1], [1, -3]])
-    # LBWA_L = combine_LBWA_L(L_W, B, W, A_L)
-    # test = ncon([LBWA_L, r_L],
-    #             [[1,2,3], [1,2,3]])
-    # print('testing LBWA_L:',test)
-    # RBWA_R = combine_RBWA_R(R_W, B, W, A_R)
-    # test = ncon([RBWA_R, l_R],
-    #             [[1, 2, 3], [1, 2, 3]])
-    # print('testing RBWA_R:',test)
     return omega, X
 
-def quasiparticle_2sites(h2sites, p, A_L, A_R, L_h, R_h, num_of_excite=5):
+def quasiparticle_block_solve(map_effective_H, n, num_of_excite, system, tol, X0=None):
+    '''
+    Block eigensolver of quasiparticle_mpo_solve. The block has the wanted eigenvectors
+    and wanted//4 + 2 more columns (filled with the fixed random start if X0 has fewer)
+    :return: omega, X (n, number of wanted eigenvectors), number of vectors multiplied by H_eff
+    '''
+    which, hermitian = BLOCK_SPECTRUM[system]
+    wanted = 2 * num_of_excite if which == 'BE' else num_of_excite
+    b = min(wanted + wanted // 4 + 2, n)
+    X_start = parallel.start_vector(n * b).reshape(n, b).astype(complex)
+    if X0 is not None:
+        X0 = X0.reshape(n, -1)[:, :b]
+        X_start[:, :X0.shape[1]] = X0
+    omega, X, converged, matvecs = krylov.block_davidson(map_effective_H, X_start, num_of_excite, which=which,
+                                                         tol=tol, hermitian=hermitian)
+    if not converged:
+        print('warning: block eigensolver not converged')
+    if hermitian:
+        omega = omega.real
+    return omega, X, matvecs
+
+def quasiparticle_mpo(W, p, A_L, A_R, L_W, R_W, num_of_excite=1, system ='1D', pinv = 'scipy', precondition = 0,
+                      tol = 1e-6, pool = None, block = False, X0 = None):
+    '''
+    Corrected version of quasiparticle.
+    :param W: MPO
+    :param p: momentum
+    :param A_L: Used to get mpo transfer matrix and LBWA_L
+    :param A_R: Used to get mpo transfer matrix and RBWA_R
+    :param L_W: Left fixed point of MPO, which is obtained from vumps_mpo.
+    :param R_W: Right fixed point of MPO, which is obtained from vumps_mpo.
+    :param pinv: 'scipy' for dense pseudo inverses (one SVD per momentum),
+                 'spectral' for pseudo inverses from one Schur decomposition shared by all momenta,
+                 otherwise recycling lgmres solves (pinv_manual.TransferSolver)
+    :param precondition: number of dominant transfer eigenvectors in the preconditioner of the lgmres solves
+    :param tol: tolerance of the eigensolver (the lgmres solves use tol/100)
+    :param pool: parallel.PairPool for the setup (see quasiparticle_mpo_setup)
+    :param block, X0: block eigensolver and its initial eigenvectors (see quasiparticle_mpo_solve)
+    :return: omega and X
+    For many momenta use dispersion_mpo, which does the setup only once.
+    '''
+    context = quasiparticle_mpo_setup(W, A_L, A_R, L_W, R_W, pinv=pinv, precondition=precondition, tol=tol,
+                                      pool=pool)
+    return quasiparticle_mpo_solve(context, p, num_of_excite=num_of_excite, system=system, block=block, X0=X0)
+
+def dispersion_mpo(W, A_L, A_R, L_W, R_W, momenta, num_of_excite=1, system ='1D', pinv = 'scipy', precondition = 0,
+                   tol = 1e-6, pool = None, block = False):
+    '''
+    Excitations for a grid of momenta. The momentum independent objects are
+    built once by quasiparticle_mpo_setup and shared by all momenta.
+    :param momenta: iterable of momenta p
+    :param block: block eigensolver, started at every momentum from the eigenvectors of the previous one
+                  (neighbouring momenta on a fine grid have close eigenvectors)
+    (other parameters as in quasiparticle_mpo)
+    :return: structured array with fields 'p' and 'omega' (num_of_excite values,
+    2*num_of_excite for system='AKLT': the largest, then the smallest), one row per momentum
+    '''
+    context = quasiparticle_mpo_setup(W, A_L, A_R, L_W, R_W, pinv=pinv, precondition=precondition, tol=tol,
+                                      pool=pool)
+    momenta = list(momenta)
+    omegas = []
+    X = None
+    for p in momenta:
+        print('solving p = ', p)
+        omega, X = quasiparticle_mpo_solve(context, p, num_of_excite=num_of_excite, system=system, block=block,
+                                           X0=X if block else None)
+        omegas.append(omega)
+    print('effective H matvecs of all momenta = ', context['matvecs'])
+    dtype = [('p', float), ('omega', np.result_type(*omegas), (len(omegas[0]),))]
+    dispersion = np.zeros(len(momenta), dtype=dtype)
+    dispersion['p'] = momenta
+    dispersion['omega'] = omegas
+    return dispersion
+
+def quasiparticle_2sites(h2sites, p, A_L, A_R, L_h, R_h, num_of_excite=5, tol=1e-8):
+    ''':param tol: tolerance of eigsh, the lgmres solves inside its matvec use tol/100'''
     T_RL = get_T_RL_or_T_LR(A_R,A_L)
     T_LR = get_T_RL_or_T_LR(A_L,A_R)
     r_L, l_L = pinv_manual.T_to_rl(T_RL)
     l_R, r_R = pinv_manual.T_to_rl(T_LR)
     T_RL *= np.exp(-1j * p)
     T_LR *= np.exp(1j * p)
+    ## one solver per transfer operator for L_B/R_B and one for L1/R1
+    ## (the right hand sides of the two pairs are unrelated, so warm starts are kept apart)
+    solver_LB = pinv_manual.TransferSolver(T_RL, r_L, l_L, tol=tol/100)
+    solver_RB = pinv_manual.TransferSolver(T_LR, l_R, r_R, tol=tol/100)
+    solver_L1 = pinv_manual.TransferSolver(T_RL, r_L, l_L, tol=tol/100)
+    solver_R1 = pinv_manual.TransferSolver(T_LR, l_R, r_R, tol=tol/100)
     D, d, _ = A_L.shape
     A_tmp = A_L.reshape(D * d, D).T
     V_L = linalg.null_space(A_tmp)
@@ -786,12 +1615,12 @@ def quasiparticle_2sites(h2sites, p, A_L, A_R, L_h, R_h, num_of_excite=5):
                     [[1,2,-2],[1,2,-1]])
         R_Bx = ncon([B,np.conj(A_R)],
                     [[-2,2,1],[1,2,-1]])
-        L_B = pinv_manual.quasi_sum_right_left_2sites(T_RL,r_L,l_L, L_Bx)
+        L_B = solver_LB.solve(L_Bx)
         # print(linalg.norm(L_B))
         # print('L_B = ', L_B)
         # print(R_Bx)
         # exit()
-        R_B = pinv_manual.quasi_sum_right_left_2sites(T_LR,l_R,r_R,R_Bx)
+        R_B = solver_RB.solve(R_Bx)
         # print('R_Bx = ', R_Bx)
         # exit()
 
@@ -804,7 +1633,7 @@ def quasiparticle_2sites(h2sites, p, A_L, A_R, L_h, R_h, num_of_excite=5):
         L1x[3] = np.exp(-2j*p)*ncon([L_B, A_R, A_R, h2sites, np.conj(A_L), np.conj(A_L)],
                                     [[1,2],[3,4,2],[-2,5,3],[4,5,6,7],[1,6,8],[8,7,-1]])
         L1x_sum = sum(L1x)
-        L1 = pinv_manual.quasi_sum_right_left_2sites(T_RL, r_L, l_L, L1x_sum)
+        L1 = solver_L1.solve(L1x_sum)
 
         R1x[0] = ncon([B,R_h,np.conj(A_R)],
                        [[-2,3,2],[1,2],[1,3,-1]])
@@ -815,7 +1644,7 @@ def quasiparticle_2sites(h2sites, p, A_L, A_R, L_h, R_h, num_of_excite=5):
         R1x[3] = np.exp(2j*p)*ncon([A_L, A_L, h2sites, np.conj(A_R), np.conj(A_R), R_B],
                                    [[-2,2,1],[1,3,6],[2,3,4,5],[8,4,-1],[7,5,8],[7,6]])
         R1x_sum = sum(R1x)
-        R1 = pinv_manual.quasi_sum_right_left_2sites(T_LR,l_R,r_R,R1x_sum)
+        R1 = solver_R1.solve(R1x_sum)
         # Heff_B = [None]*14
         Heff_B[0] = ncon([B, A_R, h2sites, np.conj(A_R)],
                          [[-1,3,1],[2,4,1],[3,4,-2,5],[2,5,-3]])
@@ -850,7 +1679,7 @@ def quasiparticle_2sites(h2sites, p, A_L, A_R, L_h, R_h, num_of_excite=5):
                       [[1,2,-2],[1,2,-1]])
         return Heff_X.reshape(-1)
     # omega, X = eigs(LinearOperator((D ** 2*(d-1), D ** 2*(d-1)), matvec=map_effective_H), k=10, which='SR', tol=1e-6)
-    omega, X = eigsh(LinearOperator((D ** 2*(d-1), D ** 2*(d-1)), matvec=map_effective_H), k=num_of_excite, which='SA', tol=1e-8)
+    omega, X = eigsh(LinearOperator((D ** 2*(d-1), D ** 2*(d-1)), matvec=map_effective_H), k=num_of_excite, which='SA', tol=tol)
     X = X[:,0]
     _ = map_effective_H(X)
     X = X.reshape(D * (d - 1), D)
@@ -874,36 +1703,26 @@ def quasiparticle_2sites(h2sites, p, A_L, A_R, L_h, R_h, num_of_excite=5):
 
 def domain_sum_right_left(T_R2L1,x):
     '''For domain part, we use regular inverse instead of pseudo inverse'''
-    D, d_w, _ = x.shape
-    def map_inv_L(y):
-        y = y.reshape(D,d_w,D)
-        term1 = y
-        term2 = ncon([T_R2L1, y],
-                     [[-1,-2,-3,1,2,3],[1,2,3]])
-        y_out = term1 - term2
-        return y_out.reshape(-1)
-    y, info = bicgstab(LinearOperator((D ** 2 * d_w, D ** 2 * d_w), matvec=map_inv_L), x.reshape(-1),
-                       x0=x.reshape(-1))
-    if info != 0:
-        print('bicgstab did not converge!')
-        exit()
-    y = y.reshape(D,d_w,D)
-    return y
-
-def quasiparticle_domain(W, p, A_L1, A_R2, L_W, R_W, num_of_excite=1):
+    return pinv_manual.TransferSolver(T_R2L1).solve(x)
+
+def quasiparticle_domain(W, p, A_L1, A_R2, L_W, R_W, num_of_excite=1, tol=1e-6):
+    ''':param tol: tolerance of eigs, the lgmres solves inside its matvec use tol/100'''
     D, d, _ = A_L1.shape
     d_w, _, _, _ = W.shape
     A_tmp = A_L1.reshape(D * d, D).T
     V_L = linalg.null_space(A_tmp)
     V_L = V_L.reshape(D, d, D * (d - 1))
     T_R2L1 = get_T_RLw_or_T_LRw(A_R2, W, A_L1)
-    lval, l = eigs(T_R2L1.reshape(D**2*d_w,D**2*d_w),k=1, which='LM')
+    lval, l = eigs(T_R2L1.linear_operator(),k=1, which='LM')
     A_R2*= np.conj(lval)/linalg.norm(lval)
     T_R2L1 = get_T_RLw_or_T_LRw(A_R2, W, A_L1)
     T_R2L1 *= np.exp(-1j*p)
     W_r = W.transpose([1, 0, 2, 3])
     T_L1R2 = get_T_RLw_or_T_LRw(A_L1, W_r, A_R2)
     T_L1R2 *= np.exp(1j*p)
+    ## regular inverse instead of pseudo inverse for the domain part
+    solver_L = pinv_manual.TransferSolver(T_R2L1, tol=tol/100)
+    solver_R = pinv_manual.TransferSolver(T_L1R2, tol=tol/100)
     # print('solving eigsh')
     def map_effective_H(X):
         # print('doing map_H')
@@ -912,8 +1731,8 @@ def quasiparticle_domain(W, p, A_L1, A_R2, L_W, R_W, num_of_excite=1):
                  [[-1,-2,1],[1,-3]])
         LBWA_L1 = combine_LBWA_L(L_W, B, W, A_L1)
         RBWA_R2 = combine_RBWA_R(R_W, B, W, A_R2)
-        L_B = domain_sum_right_left(T_R2L1, LBWA_L1)
-        R_B = domain_sum_right_left(T_L1R2, RBWA_R2)
+        L_B = solver_L.solve(LBWA_L1)
+        R_B = solver_R.solve(RBWA_R2)
         term1 = np.exp(-1j*p)*ncon([L_B,A_R2,W,R_W],
                                     [[-1,1,2],[4,5,2],[1,3,5,-2],[-3,3,4]])
         term2 = np.exp(1j*p)*ncon([L_W, A_L1, W, R_B],
@@ -929,7 +1748,7 @@ def quasiparticle_domain(W, p, A_L1, A_R2, L_W, R_W, num_of_excite=1):
     # omega, X = eigs(LinearOperator((D ** 2 * (d - 1), D ** 2 * (d - 1)), matvec=map_effective_H), k=10, which='SR',
     #                 tol=1e-6)
     omega, X = eigs(LinearOperator((D ** 2 * (d - 1), D ** 2 * (d - 1)), matvec=map_effective_H), k=num_of_excite,
-                    which='LM', tol=1e-6)
+                    which='LM', tol=tol)
     return omega
 '''
 ########################################################################################################################
@@ -941,13 +1760,20 @@ if __name__ == '__main__':
     D = 10;
     d = 2
     A = np.random.rand(D, d, D)
+    ## canonical_form: time and gauge error ||A_L C - C A_R|| against method 2
+    t0 = time.perf_counter()
     lam, gamma = A_to_lam_gamma(A)
     lam, gamma = lam_gamma_to_canonical(lam, gamma)
-    A_L, A_R = canonical_to_Al_Ar(lam, gamma)
-    C = lam
-    Ac = ncon([A_L, C],
-              [[-1, -2, 1], [1, -3]])
-    A_L2, A_R2 = min_Ac_C(Ac, C)
+    A_L_old, A_R_old = canonical_to_Al_Ar(lam, gamma)
+    t1 = time.perf_counter()
+    A_L, A_R, C, Ac = canonical_form(A)
+    t2 = time.perf_counter()
+    C_Ar = ncon([C, A_R],
+                [[-1, 1], [-3, -2, 1]])
+    iso_L = linalg.norm(A_L_old.reshape(D*d, D).T @ np.conj(A_L_old.reshape(D*d, D)) - np.eye(D))
+    print('method 2: time = ', t1 - t0, 'isometry error of A_L = ', iso_L)
+    print('canonical_form: time = ', t2 - t1, 'gauge error = ', linalg.norm(Ac - C_Ar))
+    A_L2, A_R2, _ = min_Ac_C(Ac, C)
     del_AL = linalg.norm(A_L - A_L2) / linalg.norm(A_L)
     del_AR = linalg.norm(A_R - A_R2) / linalg.norm(A_R)
     print(del_AL, del_AR)